@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from concurrent.futures import ThreadPoolExecutor, Future
+from csv import reader
+from pathlib import Path
+from shutil import move, rmtree
+from sys import stderr
+from time import monotonic
+from typing import TypedDict
+
+from code.creation import create_mod_space, install_mod_files, write_import_metadata, \
+    TransferStats
+from code.dedupe import deduplicate_after_import
+from code.mod import validate_mod_id, mod_at_version_limit, meets_requirements, \
+    process_mod_subdir_argument, ValidModSettings
+from code.sharedstore import is_shared_version, release_shared_version
+from code.tools import current_date, format_byte_size
+
+
+class ImportManifestEntry(TypedDict):
+    """
+    a single line of a batch import manifest
+    """
+    mod_id: str
+    import_path: Path
+    subdir: str
+    author: str | None
+    name: str | None
+    link: str | None
+
+
+class BatchImportResult(TypedDict):
+    """
+    outcome of importing one manifest entry
+    """
+    mod_id: str
+    version: str | None
+    files: int
+    bytes: int
+    seconds: float
+    error: str | None
+
+
+def read_import_manifest(manifest_path: Path, default_subdir: str) -> list[ImportManifestEntry]:
+    """
+    Reads a tab-separated manifest with the columns mod_id, path, subdir, author, name and link.
+    Empty lines and lines starting with '#' are ignored. Trailing columns may be omitted and empty
+    columns fall back to the defaults of a regular import. Relative paths are interpreted
+    relative to the directory containing the manifest. The metadata columns are validated
+    like the corresponding mod settings.
+    """
+    entries: list[ImportManifestEntry] = []
+    with manifest_path.open(mode="rt", encoding="UTF-8", newline="") as f:
+        for line_number, fields in enumerate(reader(f, delimiter="\t"), start=1):
+            if len(fields) == 0 or len(fields[0].strip()) == 0 or fields[0].lstrip().startswith("#"):
+                continue
+            fields = [field.strip() for field in fields] + [""] * (6 - len(fields))
+            if len(fields) > 6:
+                raise ValueError(f"line {line_number} has more than six columns")
+            mod_id, raw_path, subdir, author, name, link = fields
+            if len(raw_path) == 0:
+                raise ValueError(f"line {line_number} does not specify an import path")
+            for value, setting, column in [(author, ValidModSettings.AUTHOR, "author"),
+                                           (name, ValidModSettings.PRETTY_NAME, "name"),
+                                           (link, ValidModSettings.HYPERLINK, "link")]:
+                if len(value) > 0 and not meets_requirements(value, setting.requirements):
+                    raise ValueError(f"line {line_number} has an invalid {column}: {value}")
+            import_path = Path(raw_path).expanduser()
+            if not import_path.is_absolute():
+                import_path = manifest_path.parent / import_path
+            entries.append(ImportManifestEntry(mod_id=mod_id,
+                                               import_path=import_path,
+                                               subdir=subdir if len(subdir) > 0 else default_subdir,
+                                               author=author if len(author) > 0 else None,
+                                               name=name if len(name) > 0 else None,
+                                               link=link if len(link) > 0 else None))
+    return entries
+
+
+def return_transferred_files(destination: Path, source: Path) -> None:
+    """
+    Moves the files of a failed import back into the source directory they were moved from
+    """
+    transferred_files = [p for p in destination.rglob("*") if p.is_symlink() or p.is_file()]
+    for transferred_file in transferred_files:
+        original = source / transferred_file.relative_to(destination)
+        original.parent.mkdir(parents=True, exist_ok=True)
+        move(transferred_file, original)
+
+
+def discard_reserved_version(version_dir: Path) -> None:
+    """
+    Removes a version directory of a failed import, so that it cannot become the latest version.
+    """
+    if is_shared_version(version_dir):
+        release_shared_version(version_dir)
+    else:
+        rmtree(version_dir, ignore_errors=True)
+    for parent in [version_dir.parent, version_dir.parent.parent]:
+        if parent.is_dir() and not any(parent.iterdir()):
+            parent.rmdir()
+
+
+def run_batch_import(entries: list[ImportManifestEntry],
+                     only_copy: bool,
+                     include_patterns: list[str],
+                     exclude_patterns: list[str],
+                     max_workers: int) -> list[BatchImportResult]:
+    """
+    Imports all manifest entries. Version directories are reserved one after another, the
+    extraction and copying runs in a bounded thread pool and the metadata of each mod is written
+    from the calling thread only, in manifest order.
+    """
+    results: list[BatchImportResult] = []
+    pending: list[tuple[ImportManifestEntry, Path, BatchImportResult, Future]] = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for entry in entries:
+            mod_id = entry["mod_id"]
+            result = BatchImportResult(mod_id=mod_id, version=None, files=0, bytes=0,
+                                       seconds=0.0, error=None)
+            results.append(result)
+            if not validate_mod_id(mod_id):
+                result["error"] = "invalid mod id"
+                continue
+            if mod_at_version_limit(mod_id, current_date()):
+                result["error"] = "subversion limit for today reached"
+                continue
+            try:
+                source = entry["import_path"].resolve(strict=True)
+            except OSError:
+                result["error"] = f"{entry['import_path']} does not exist"
+                continue
+            reserved_version = create_mod_space(mod_id)
+            raw_destination = reserved_version.resolve()
+            result["version"] = f"{reserved_version.parent.name}/{reserved_version.name}"
+            print(f"Importing mod {mod_id} as version {result['version']}", file=stderr)
+
+            def import_task(entry: ImportManifestEntry = entry,
+                            source: Path = source,
+                            raw_destination: Path = raw_destination) -> tuple[TransferStats, float]:
+                start = monotonic()
+                # Moving the files removes the source directory once it is empty
+                source_is_dir = source.is_dir()
+                destination = (raw_destination / process_mod_subdir_argument(
+                    entry["subdir"],
+                    mod_id=entry["mod_id"],
+                    src_dir=source if source_is_dir else None)).resolve()
+                try:
+                    _, stats = install_mod_files(entry["mod_id"], source, raw_destination,
+                                                 subdir=entry["subdir"],
+                                                 only_copy=only_copy,
+                                                 include_patterns=include_patterns,
+                                                 exclude_patterns=exclude_patterns)
+                except Exception:
+                    # The reserved version is discarded, so moved files must not stay in it
+                    if not only_copy and source_is_dir \
+                            and destination.is_relative_to(raw_destination):
+                        return_transferred_files(destination, source)
+                    raise
+                return stats, monotonic() - start
+
+            pending.append((entry, reserved_version, result, pool.submit(import_task)))
+
+        for entry, reserved_version, result, future in pending:
+            try:
+                stats, seconds = future.result()
+            except Exception as e:
+                result["error"] = str(e) if len(str(e)) > 0 else type(e).__name__
+                discard_reserved_version(reserved_version)
+                continue
+            result["files"] = stats["files_transferred"]
+            result["bytes"] = stats["bytes_transferred"]
+            result["seconds"] = seconds
+            try:
+                write_import_metadata(entry["mod_id"],
+                                      author=entry["author"],
+                                      name=entry["name"],
+                                      link=entry["link"])
+                deduplicate_after_import(entry["mod_id"])
+            except (OSError, ValueError) as e:
+                # The files have been imported, only the metadata or deduplication failed
+                result["error"] = f"imported, but finishing the import failed: {e}"
+    return results
+
+
+def print_batch_results(results: list[BatchImportResult], elapsed_seconds: float) -> None:
+    modid_width = max([len("MOD")] + [len(result["mod_id"]) for result in results])
+    print(f"{'MOD':<{modid_width}}  {'VERSION':<13}  {'FILES':>7}  {'SIZE':>10}  {'TIME':>8}  STATUS")
+    for result in results:
+        status = "ok" if result["error"] is None else f"FAILED: {result['error']}"
+        version = result["version"] if result["version"] is not None else "-"
+        print(f"{result['mod_id']:<{modid_width}}  {version:<13}  {result['files']:>7}  "
+              f"{format_byte_size(result['bytes']):>10}  {result['seconds']:>7.1f}s  {status}")
+    total_bytes = sum(result["bytes"] for result in results)
+    num_successful = len([result for result in results if result["error"] is None])
+    throughput = total_bytes / elapsed_seconds if elapsed_seconds > 0 else 0
+    print(f"Imported {num_successful} of {len(results)} mods, "
+          f"{format_byte_size(total_bytes)} in {elapsed_seconds:.1f}s "
+          f"({format_byte_size(int(throughput))}/s)")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from concurrent.futures import ThreadPoolExecutor
+from lzma import LZMAError
+from os import cpu_count
+from pathlib import Path
+from tempfile import mkdtemp
+import tarfile
+
+from code.mod import resolve_base_dir, get_mod_versions, select_latest_version, ModConfig, \
+    ValidModSettings, parse_version_tag, VERSION_ARCHIVE_SUFFIX
+from code.metrics import count
+from code.paths import get_trash_directory
+from code.reaper import move_to_trash, remove_tree, empty_trash_in_background
+from code.sharedstore import is_shared_version
+
+# What a damaged archive or a failing disk raises while packing or unpacking a version
+ARCHIVE_ERRORS = (OSError, tarfile.TarError, LZMAError)
+
+
+def get_version_directory(mod_id: str, version_date: str, version_sub: str,
+                          base_dir: Path | None = None) -> Path:
+    return resolve_base_dir(base_dir) / 'mods' / mod_id / version_date / version_sub
+
+
+def get_version_archive_path(mod_id: str, version_date: str, version_sub: str,
+                             base_dir: Path | None = None) -> Path:
+    return get_version_directory(mod_id, version_date, version_sub, base_dir).with_name(
+        version_sub + VERSION_ARCHIVE_SUFFIX)
+
+
+def is_version_archived(mod_id: str, version_date: str, version_sub: str,
+                        base_dir: Path | None = None) -> bool:
+    version_dir = get_version_directory(mod_id, version_date, version_sub, base_dir)
+    return (not version_dir.is_dir()
+            and get_version_archive_path(mod_id, version_date, version_sub, base_dir).is_file())
+
+
+def find_inactive_versions(mod_ids: list[str]) -> list[tuple[str, str, str]]:
+    """
+    :return: (mod id, date, subversion) of all unpacked versions that are neither the latest nor
+             the selected version of their mod. Versions from a shared store are not included.
+    """
+    inactive_versions: list[tuple[str, str, str]] = []
+    for mod_id in mod_ids:
+        active_versions = {select_latest_version(mod_id)}
+        pinned_version: str = ModConfig(mod_id).get(ValidModSettings.MOD_VERSION)
+        if pinned_version.lower() != "latest":
+            active_versions.add(parse_version_tag(pinned_version))
+        for date, subversions in sorted(get_mod_versions(mod_id).items()):
+            for sub in sorted(subversions):
+                version_dir = get_version_directory(mod_id, date, sub)
+                if ((date, sub) in active_versions or not version_dir.is_dir()
+                        or is_shared_version(version_dir)):
+                    continue
+                inactive_versions.append((mod_id, date, sub))
+    return inactive_versions
+
+
+def archive_version(mod_id: str, version_date: str, version_sub: str) -> int:
+    """
+    Packs a version directory into an xz-compressed tarball and removes the directory.
+    The archive is only put in place once it has been written completely.
+
+    :return: size of the created archive in bytes
+    """
+    version_dir = get_version_directory(mod_id, version_date, version_sub)
+    archive_path = get_version_archive_path(mod_id, version_date, version_sub)
+    partial_path = archive_path.with_name(archive_path.name + ".partial")
+    try:
+        with tarfile.open(partial_path, mode="w:xz") as archive:
+            for child in sorted(version_dir.iterdir()):
+                archive.add(child, arcname=child.name)
+        partial_path.rename(archive_path)
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+    trash_dir = get_trash_directory(resolve_base_dir())
+    move_to_trash(version_dir, trash_dir)
+    return archive_path.stat().st_size
+
+
+def archive_versions(versions: list[tuple[str, str, str]],
+                     max_workers: int | None = None) -> tuple[int, list[str]]:
+    """
+    Archives several versions in parallel. A version that cannot be archived stays a directory.
+
+    :return: the combined size of all created archives and a description of every failure
+    """
+    def archive(version: tuple[str, str, str]) -> int | str:
+        try:
+            return archive_version(*version)
+        except ARCHIVE_ERRORS as e:
+            return f"{version[0]} {version[1]}/{version[2]}: {e}"
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or cpu_count() or 1) as pool:
+            outcomes = list(pool.map(archive, versions))
+    finally:
+        empty_trash_in_background(get_trash_directory(resolve_base_dir()))
+    return (sum(outcome for outcome in outcomes if isinstance(outcome, int)),
+            [outcome for outcome in outcomes if isinstance(outcome, str)])
+
+
+def restore_version(mod_id: str, version_date: str, version_sub: str) -> None:
+    """
+    Unpacks an archived version. The archive is read as a stream and extracted into a temporary
+    directory, which is renamed to the version directory when the extraction is complete.
+    """
+    version_dir = get_version_directory(mod_id, version_date, version_sub)
+    archive_path = get_version_archive_path(mod_id, version_date, version_sub)
+    staging_dir = Path(mkdtemp(prefix=f".{version_sub}.restoring-", dir=version_dir.parent))
+    count("bytes_read", archive_path.stat().st_size)
+    try:
+        with tarfile.open(archive_path, mode="r|xz") as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(staging_dir, filter="data")
+            else:
+                archive.extractall(staging_dir)
+        staging_dir.rename(version_dir)
+    except ARCHIVE_ERRORS:
+        remove_tree(staging_dir)
+        if not version_dir.is_dir():
+            raise
+        # Another process restored the same version in the meantime
+    archive_path.unlink(missing_ok=True)
+
+
+def restore_versions(versions: list[tuple[str, str, str]], max_workers: int | None = None) -> None:
+    """
+    Restores several archived versions in parallel. Decompression releases the GIL, so threads
+    are sufficient to keep multiple cores busy.
+
+    :raises ValueError: naming every version that could not be restored
+    """
+    if len(versions) == 0:
+        return
+
+    def restore(version: tuple[str, str, str]) -> str | None:
+        try:
+            restore_version(*version)
+            return None
+        except ARCHIVE_ERRORS as e:
+            return f"{version[0]} {version[1]}/{version[2]}: {e}"
+
+    with ThreadPoolExecutor(max_workers=max_workers or cpu_count() or 1) as pool:
+        failures = [failure for failure in pool.map(restore, versions) if failure is not None]
+    if len(failures) > 0:
+        raise ValueError("Could not restore " + "; ".join(failures))
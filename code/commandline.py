@@ -3,7 +3,7 @@
 # SPDX-FileCopyrightText: 2023 Jonas Tobias Hopusch <git@jotoho.de>
 # SPDX-License-Identifier: AGPL-3.0-only
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace, REMAINDER
-from os import getcwd
+from os import getcwd, cpu_count
 from pathlib import Path
 
 from code.mod import cast_validate_mod_id
@@ -14,7 +14,7 @@ from code.instancepath import get_instance_path
 def get_pid_path() -> Path:
     return get_instance_path() / 'ns-pid.txt'
 
-def process_commandline_args() -> Namespace:
+def process_commandline_args(argv: list[str] | None = None) -> Namespace:
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
                             description="""
             modfs is a tool for simple game modding needs on Linux systems.
@@ -28,6 +28,20 @@ def process_commandline_args() -> Namespace:
     parser.add_argument("--show-args",
                         action="store_true",
                         help="Prints the evaluated CLI object to stdout for debugging")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Run the subcommand under cProfile, save the statistics in pstats "
+                             "format and print the functions with the highest cumulative time")
+    parser.add_argument("--profile-output",
+                        type=Path,
+                        default=None,
+                        metavar="PATH",
+                        help="Where --profile saves the statistics. Defaults to a new file in "
+                             ".modfs/logs.")
+    parser.add_argument("--profile-syscalls",
+                        action="store_true",
+                        help="Like --profile, but also count the filesystem calls (stat, "
+                             "iterdir, open, ...) made by the subcommand")
     subparsers = parser.add_subparsers(dest="subcommand", required=True)
     init_parser = subparsers.add_parser("init",
                                         formatter_class=ArgumentDefaultsHelpFormatter,
@@ -42,11 +56,35 @@ def process_commandline_args() -> Namespace:
     run_parser = subparsers.add_parser("run",
                                        formatter_class=ArgumentDefaultsHelpFormatter,
                                        help="Run a command with the modded filesystem")
+    run_parser.add_argument("--read-only",
+                            action="store_true",
+                            help="Mount the mods and the overflow directory without write access. "
+                                 "Read-only sessions can run next to a writable one and share "
+                                 "their mount with each other.")
+    run_parser.add_argument("--timings",
+                            action="store_true",
+                            help="Show how long each phase of the deployment took. The "
+                                 "recordDeployTimings setting records them without showing them.")
+    run_parser.add_argument("--prewarm",
+                            action="store_true",
+                            help="Load the deployed mod files into the page cache before running "
+                                 "the command, like the prewarmFiles setting does for every run. "
+                                 "See the prewarmSizeLimitMiB, prewarmIncludePatterns, "
+                                 "prewarmExcludePatterns and prewarmJobs settings.")
     run_parser.add_argument("command",
                             action='store',
                             type=str,
                             nargs=REMAINDER,
                             help="the bash command to execute within the virtual environment")
+    subparsers.add_parser("deploy",
+                          formatter_class=ArgumentDefaultsHelpFormatter,
+                          help="Place the enabled mods into the deployment directory as links, "
+                               "without mounting anything. Only the changes since the last "
+                               "deployment are applied.")
+    subparsers.add_parser("undeploy",
+                          formatter_class=ArgumentDefaultsHelpFormatter,
+                          help="Remove the files placed by deploy and restore the replaced game "
+                               "files")
     enable_parser = subparsers.add_parser("enable", help="Enables a mod")
     enable_parser.add_argument("mod_id",
                                type=cast_validate_mod_id)
@@ -93,16 +131,168 @@ def process_commandline_args() -> Namespace:
     import_parser.add_argument("--set-link",
                                type=str,
                                default=None)
+    import_parser.add_argument("--include",
+                               action="append",
+                               default=[],
+                               metavar="PATTERN",
+                               help="Only import files matching this glob pattern. May be given "
+                                    "multiple times and adds to the importIncludePatterns setting.")
+    import_parser.add_argument("--exclude",
+                               action="append",
+                               default=[],
+                               metavar="PATTERN",
+                               help="Skip files or folders matching this glob pattern. May be given "
+                                    "multiple times and adds to the importExcludePatterns setting.")
+    import_parser.add_argument("--batch",
+                               type=Path,
+                               default=None,
+                               metavar="MANIFEST",
+                               help="Import many mods at once. Each line of the manifest file "
+                                    "contains the tab-separated fields mod_id, path, subdir, "
+                                    "author, name and link. Only the first two are mandatory.")
+    import_parser.add_argument("--jobs",
+                               type=int,
+                               default=min(4, cpu_count() or 1),
+                               help="Number of mods extracted and copied in parallel during a "
+                                    "batch import")
     import_parser.add_argument("mod_id",
-                               type=str)
+                               type=str,
+                               nargs="?",
+                               default=None)
     import_parser.add_argument("import_path",
                                type=Path,
+                               nargs="?",
+                               default=None,
                                help="the source directory")
     delete_parser = subparsers.add_parser("delete",
                                           formatter_class=ArgumentDefaultsHelpFormatter,
                                           help="Delete a mod or one specific version.")
     delete_parser.add_argument("mod_id",
                                type=cast_validate_mod_id)
+    prune_parser = subparsers.add_parser("prune",
+                                         formatter_class=ArgumentDefaultsHelpFormatter,
+                                         help="Delete old mod versions according to the retention "
+                                              "policy. The latest and the selected version of a "
+                                              "mod are always kept.")
+    prune_parser.add_argument("--keep",
+                              type=int,
+                              default=None,
+                              help="Number of newest versions to keep per mod. Defaults to the "
+                                   "retainVersions setting.")
+    prune_parser.add_argument("--all",
+                              action="store_true",
+                              help="Process all mods")
+    prune_parser.add_argument("--dry-run",
+                              action="store_true",
+                              help="Only show what would be deleted")
+    prune_parser.add_argument("--yes",
+                              action="store_true",
+                              help="Do not ask for confirmation")
+    prune_parser.add_argument("modids",
+                              nargs='*',
+                              default=[],
+                              type=cast_validate_mod_id)
+    archive_parser = subparsers.add_parser("archive",
+                                           formatter_class=ArgumentDefaultsHelpFormatter,
+                                           help="Pack versions that are neither latest nor "
+                                                "selected into compressed archives. They are "
+                                                "restored automatically when selected or run.")
+    archive_parser.add_argument("--all",
+                                action="store_true",
+                                help="Process all mods")
+    archive_parser.add_argument("--jobs",
+                                type=int,
+                                default=cpu_count() or 1,
+                                help="Number of versions compressed in parallel")
+    archive_parser.add_argument("modids",
+                                nargs='*',
+                                default=[],
+                                type=cast_validate_mod_id)
+    usage_parser = subparsers.add_parser("usage",
+                                         formatter_class=ArgumentDefaultsHelpFormatter,
+                                         help="Show the disk space used by mods, versions, the "
+                                              "overflow and the work directory")
+    usage_parser.add_argument("--refresh",
+                              action="store_true",
+                              help="Ignore cached results and scan all versions again")
+    usage_parser.add_argument("modids",
+                              nargs='*',
+                              default=[],
+                              type=cast_validate_mod_id)
+    promote_parser = subparsers.add_parser("promote",
+                                           formatter_class=ArgumentDefaultsHelpFormatter,
+                                           help="Move files from the overflow directory into a "
+                                                "new version of a mod. The new version keeps "
+                                                "the files of the version it replaces.")
+    promote_parser.add_argument("--dry-run",
+                                action="store_true",
+                                help="Only list the files that would be promoted")
+    promote_parser.add_argument("--set-author",
+                                type=str,
+                                default=None)
+    promote_parser.add_argument("--set-name",
+                                type=str,
+                                default=None)
+    promote_parser.add_argument("--set-link",
+                                type=str,
+                                default=None)
+    promote_parser.add_argument("mod_id",
+                                type=str,
+                                help="The mod receiving the files. It is created, if it does "
+                                     "not exist yet.")
+    promote_parser.add_argument("patterns",
+                                nargs="+",
+                                metavar="PATTERN",
+                                help="Overflow paths to promote, with the same syntax as the "
+                                     "import filters")
+    snapshot_parser = subparsers.add_parser("snapshot",
+                                            formatter_class=ArgumentDefaultsHelpFormatter,
+                                            help="Manage snapshots of the overflow directory. "
+                                                 "The snapshotOverflow setting takes one before "
+                                                 "every writable run.")
+    snapshot_subparsers = snapshot_parser.add_subparsers(dest="snapshotaction", required=True)
+    snapshot_subparsers.add_parser("create",
+                                   formatter_class=ArgumentDefaultsHelpFormatter,
+                                   help="Take a snapshot now")
+    snapshot_subparsers.add_parser("list",
+                                   formatter_class=ArgumentDefaultsHelpFormatter,
+                                   help="List the kept snapshots, oldest first")
+    snapshot_restore_parser = snapshot_subparsers.add_parser(
+        "restore",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help="Replace the overflow directory with a snapshot. A snapshot of the current state "
+             "is taken first.")
+    snapshot_restore_parser.add_argument("snapshot_id",
+                                         metavar="ID")
+    serve_parser = subparsers.add_parser("serve",
+                                         formatter_class=ArgumentDefaultsHelpFormatter,
+                                         help="Keep the mods, their versions and settings, the "
+                                              "priority order and the conflicts of the instance "
+                                              "in memory and answer the read-only subcommands "
+                                              "(list, usage, stats, config get/list, mod info, "
+                                              "version) of other modfs invocations through a "
+                                              "socket in .modfs. Set MODFS_NO_DAEMON to bypass "
+                                              "it.")
+    serve_parser.add_argument("--idle-timeout",
+                              type=float,
+                              default=0,
+                              metavar="SECS",
+                              help="Stop after not receiving any request for this many seconds. "
+                                   "0 keeps running until terminated.")
+    stats_parser = subparsers.add_parser("stats",
+                                         formatter_class=ArgumentDefaultsHelpFormatter,
+                                         help="Summarize the recorded history of modfs "
+                                              "invocations (see the recordHistory setting)")
+    stats_parser.add_argument("--format",
+                              choices=["text", "json", "prometheus"],
+                              default="text",
+                              help="Output format. prometheus uses the text exposition format "
+                                   "understood by the node exporter's textfile collector")
+    stats_parser.add_argument("--subcommand",
+                              dest="subcommand_filter",
+                              metavar="SUBCOMMAND",
+                              default=None,
+                              help="Only include invocations of this subcommand")
     list_parser = subparsers.add_parser("list",
                                         formatter_class=ArgumentDefaultsHelpFormatter,
                                         help="List known resources")
@@ -164,6 +354,18 @@ def process_commandline_args() -> Namespace:
                                      nargs='*',
                                      default=[],
                                      type=cast_validate_mod_id)
+    list_subparsers.add_parser("shared",
+                               formatter_class=ArgumentDefaultsHelpFormatter,
+                               help="List the mod versions available in the shared mod store")
+    adopt_parser = subparsers.add_parser("adopt",
+                                         formatter_class=ArgumentDefaultsHelpFormatter,
+                                         help="Use a mod version from the shared mod store in this "
+                                              "instance without copying it")
+    adopt_parser.add_argument("mod_id")
+    adopt_parser.add_argument("version",
+                              nargs="?",
+                              default="latest",
+                              help="YYYY-MM-DD/XX or latest")
     version_select_parser = subparsers.add_parser("useversion",
                                                   formatter_class=ArgumentDefaultsHelpFormatter,
                                                   help="Make modfs use a different version.")
@@ -220,6 +422,10 @@ def process_commandline_args() -> Namespace:
     repair_subparser.add_parser("cleanoverflow",
                                 formatter_class=ArgumentDefaultsHelpFormatter,
                                 help="Deletes all files from the overflow directory that are present in any installed mod version")
+    repair_subparser.add_parser("dedupe",
+                                formatter_class=ArgumentDefaultsHelpFormatter,
+                                help="Links identical files of all mods and versions to a shared "
+                                     "content-addressed store to save disk space")
     dev_parser = subparsers.add_parser("developer", help="Advanced unstable subcommands for developers")
     dev_subparsers = dev_parser.add_subparsers(dest="developer_action", required=True)
     dev_blank_mod = dev_subparsers.add_parser("create-blank-mod")
@@ -243,7 +449,9 @@ def process_commandline_args() -> Namespace:
                           formatter_class=ArgumentDefaultsHelpFormatter,
                           help="Show the current version of modfs, if possible")
 
-    evaluated_args = parser.parse_args()
+    evaluated_args = parser.parse_args(argv)
+    if evaluated_args.profile_syscalls:
+        evaluated_args.profile = True
     if (not evaluated_args.subcommand) or (evaluated_args.subcommand == "help"):
         parser.print_help()
         from os import EX_OK
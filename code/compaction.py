@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from collections import OrderedDict
+from datetime import date
+from hashlib import sha256
+from os import link, readlink, symlink, walk, getpid
+from pathlib import Path
+from sys import stderr
+
+from code.deployer import list_layer_entries, get_layer_signature
+from code.mod import get_mod_mount_path, resolve_base_dir
+from code.paths import get_meta_directory, get_trash_directory
+from code.reaper import move_to_trash, remove_tree, empty_trash_in_background
+from code.settings import get_instance_settings, ValidInstanceSettings
+from code.tools import is_process_alive
+
+
+def get_layer_cache_directory(base_dir: Path | None = None) -> Path:
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'layers'
+
+
+def get_composite_layer_key(mod_versions: list[tuple[str, str, str, Path]]) -> str:
+    """
+    A composite layer is identified by the ordered list of (mod, date, subversion) it contains
+    and the signatures of their layers, so that it is rebuilt whenever any of them changes,
+    including renames within a version.
+    """
+    description = ""
+    for mod, version_date, version_sub, layer in mod_versions:
+        _, dirs = list_layer_entries(layer)
+        description += f"{mod}/{version_date}/{version_sub}\t{get_layer_signature(layer, dirs)}\n"
+    return sha256(description.encode(errors="surrogateescape")).hexdigest()[:32]
+
+
+def is_version_stable(version_date: str, stable_days: int) -> bool:
+    try:
+        return (date.today() - date.fromisoformat(version_date)).days >= stable_days
+    except ValueError:
+        return False
+
+
+def merge_layer_into(layer: Path, composite: Path) -> None:
+    """
+    Hardlinks all files of layer into composite. Existing entries are replaced, the same way a
+    higher overlayfs layer hides the contents of a lower one.
+    """
+    for root, dirs, files in walk(layer):
+        relative_root = Path(root).relative_to(layer)
+        for directory in dirs:
+            source = Path(root) / directory
+            destination = composite / relative_root / directory
+            if source.is_symlink():
+                if destination.is_dir() and not destination.is_symlink():
+                    remove_tree(destination)
+                destination.unlink(missing_ok=True)
+                symlink(readlink(source), destination)
+            elif not destination.is_dir() or destination.is_symlink():
+                destination.unlink(missing_ok=True)
+                destination.mkdir()
+        for file_name in files:
+            source = Path(root) / file_name
+            destination = composite / relative_root / file_name
+            if destination.is_dir() and not destination.is_symlink():
+                remove_tree(destination)
+            destination.unlink(missing_ok=True)
+            if source.is_symlink():
+                symlink(readlink(source), destination)
+            else:
+                link(source, destination)
+
+
+def is_unfinished_build_of_live_process(layer_path: Path) -> bool:
+    _, separator, pid = layer_path.name.partition(".building-")
+    return len(separator) > 0 and pid.isdigit() and is_process_alive(int(pid))
+
+
+def build_composite_layer(layers: list[Path], layer_path: Path) -> None:
+    building_path = layer_path.with_name(f"{layer_path.name}.building-{getpid()}")
+    remove_tree(building_path)
+    building_path.mkdir(parents=True)
+    for layer in layers:
+        merge_layer_into(layer, building_path)
+    try:
+        building_path.rename(layer_path)
+    except OSError:
+        # Another modfs process built the same layer in the meantime, which is just as good
+        if not layer_path.is_dir():
+            raise
+        remove_tree(building_path)
+
+
+def compact_deployment_layers(mods_to_deploy: OrderedDict[str, tuple[str, str]],
+                              layers_in_use: set[Path]) -> list[Path]:
+    """
+    Replaces every long enough run of consecutive mods, whose deployed version has not changed
+    for a while, with a single cached composite layer.
+
+    :param layers_in_use: resolved layers of running sessions, which must not be deleted
+
+    :return: the deployment layers in order of increasing priority
+    """
+    settings = get_instance_settings()
+    stable_days: int = settings.get(ValidInstanceSettings.COMPACTION_STABLE_DAYS)
+    minimum_layers: int = settings.get(ValidInstanceSettings.COMPACTION_MINIMUM_LAYERS)
+    cache_dir = get_layer_cache_directory()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_device = cache_dir.stat().st_dev
+
+    # Group consecutive mods into runs of stable and unstable ones
+    runs: list[list[tuple[str, str, str, Path]]] = []
+    previous_stable: bool | None = None
+    for mod, (version_date, version_sub) in mods_to_deploy.items():
+        layer = get_mod_mount_path(mod, version_date, version_sub)
+        if not layer.is_dir():
+            continue
+        # Hardlinks cannot cross filesystems, so such layers are never compacted
+        stable = (is_version_stable(version_date, stable_days)
+                  and layer.stat().st_dev == cache_device)
+        if stable != previous_stable or not stable:
+            runs.append([])
+        runs[-1].append((mod, version_date, version_sub, layer))
+        previous_stable = stable
+
+    layers: list[Path] = []
+    used_keys: set[str] = set()
+    for run in runs:
+        if len(run) < minimum_layers:
+            layers += [layer for _, _, _, layer in run]
+            continue
+        key = get_composite_layer_key(run)
+        layer_path = cache_dir / key
+        if not layer_path.is_dir():
+            print(f"Building composite layer of {len(run)} mods...", file=stderr)
+            build_composite_layer([layer for _, _, _, layer in run], layer_path)
+        used_keys.add(key)
+        layers.append(layer_path)
+
+    # Composite layers of previous mod combinations are no longer needed
+    stale_layers = [p for p in cache_dir.iterdir()
+                    if p.name not in used_keys and not is_unfinished_build_of_live_process(p)
+                    and p.resolve() not in layers_in_use]
+    if len(stale_layers) > 0:
+        trash_dir = get_trash_directory(resolve_base_dir())
+        for stale_layer in stale_layers:
+            move_to_trash(stale_layer, trash_dir)
+        empty_trash_in_background(trash_dir)
+    return layers
@@ -3,19 +3,46 @@
 # SPDX-FileCopyrightText: 2023 Jonas Tobias Hopusch <git@jotoho.de>
 # SPDX-License-Identifier: AGPL-3.0-only
 from filecmp import cmp
+from fnmatch import fnmatchcase
 from pathlib import Path
 from re import IGNORECASE, compile, Pattern
 from shutil import copy2, move, which
 from subprocess import run
 from sys import stderr
-from typing import Callable
+from tempfile import TemporaryDirectory
+from typing import Callable, Iterable, TypedDict
 
-from code.mod import resolve_base_dir, select_latest_version, attempt_instance_relative_cast
+from code.mod import resolve_base_dir, select_latest_version, attempt_instance_relative_cast, \
+    process_mod_subdir_argument, ModConfig, ValidModSettings
+from code.metrics import count
+from code.progress import ProgressReporter
 from code.settings import get_instance_settings, ValidInstanceSettings
-from code.tools import current_date
+from code.tools import current_date, split_pattern_list
+
+
+class TransferStats(TypedDict):
+    """
+    counters collected while moving or copying files into a mod version
+    """
+    files_transferred: int
+    bytes_transferred: int
+    files_skipped: int
+    bytes_skipped: int
+
+
+def new_transfer_stats() -> TransferStats:
+    return TransferStats(files_transferred=0,
+                         bytes_transferred=0,
+                         files_skipped=0,
+                         bytes_skipped=0)
 
 
 def create_mod_space(mod_id: str, base_dir: Path | None = None) -> Path:
+    from code.sharedstore import get_shared_store_directory, create_shared_mod_space
+    shared_store = get_shared_store_directory(base_dir)
+    if shared_store is not None:
+        return create_shared_mod_space(mod_id, shared_store, base_dir)
+
     mod_dir = resolve_base_dir(base_dir) / 'mods' / mod_id
     mod_dir.mkdir(parents=True, exist_ok=True)
     version_tuple = select_latest_version(mod_id)
@@ -32,7 +59,7 @@ def create_mod_space(mod_id: str, base_dir: Path | None = None) -> Path:
     return location
 
 
-def recursive_lower_case_rename(current_path: Path) -> None:
+def recursive_lower_case_rename(current_path: Path, progress: ProgressReporter | None = None) -> None:
     if current_path is None or not isinstance(current_path, Path) or not current_path.is_dir():
         return
 
@@ -42,6 +69,8 @@ def recursive_lower_case_rename(current_path: Path) -> None:
 
     # print("Processing all entries in directory: " + str(currentPath))
     for element in current_path.iterdir():
+        if progress is not None:
+            progress.advance()
         if element.exists():
             new_path = Path(
                 current_path.joinpath(Path(str(element.relative_to(current_path)).lower())))
@@ -52,8 +81,11 @@ def recursive_lower_case_rename(current_path: Path) -> None:
                     element.unlink(missing_ok=True)
                     continue
                 else:
-                    print(f"Path '{str(new_path)}' is already used. Cannot move '{str(element)}'",
-                          file=stderr)
+                    message = f"Path '{str(new_path)}' is already used. Cannot move '{str(element)}'"
+                    if progress is not None:
+                        progress.message(message)
+                    else:
+                        print(message, file=stderr)
                     continue
             else:
                 assert element.exists()
@@ -67,7 +99,7 @@ def recursive_lower_case_rename(current_path: Path) -> None:
             exit(EIO)
     for element in current_path.iterdir():
         if element.is_dir():
-            recursive_lower_case_rename(element)
+            recursive_lower_case_rename(element, progress)
 
 
 def ask_for_path(prompt: str, meets_requirements: Callable[[Path | None], bool]) -> Path:
@@ -92,13 +124,74 @@ def ask_for_path(prompt: str, meets_requirements: Callable[[Path | None], bool])
     return deployment_target_dir
 
 
-def transfer_mod_files(source_dir: Path, destination_dir: Path, only_copy: bool) -> None:
+def get_import_filter_patterns(cli_include: list[str] | None = None,
+                               cli_exclude: list[str] | None = None) -> tuple[list[str], list[str]]:
+    """
+    Combines the instance-wide import filters with the ones given for a single import.
+
+    :return: tuple of include patterns and exclude patterns
+    """
+    settings = get_instance_settings()
+    include_patterns = (split_pattern_list(settings.get(ValidInstanceSettings.IMPORT_INCLUDE_PATTERNS))
+                        + list(cli_include if cli_include is not None else []))
+    exclude_patterns = (split_pattern_list(settings.get(ValidInstanceSettings.IMPORT_EXCLUDE_PATTERNS))
+                        + list(cli_exclude if cli_exclude is not None else []))
+    return include_patterns, exclude_patterns
+
+
+def matches_import_pattern(relative_path: Path, patterns: Iterable[str]) -> bool:
+    """
+    Patterns without a slash are matched against every single path component, so that
+    '*.psd' or 'screenshots' apply at any depth. Patterns containing a slash are matched
+    against the path relative to the import root and all of its leading directories.
+    Matching ignores case, because imported files are case-folded afterward anyway.
+    """
+    components = [part.lower() for part in relative_path.parts]
+    prefixes = ["/".join(components[:i]) for i in range(1, len(components) + 1)]
+    for pattern in patterns:
+        pattern = pattern.lower().removeprefix("./").strip("/")
+        candidates = prefixes if "/" in pattern else components
+        if any(fnmatchcase(candidate, pattern) for candidate in candidates):
+            return True
+    return False
+
+
+def is_excluded_from_import(relative_path: Path,
+                            include_patterns: list[str],
+                            exclude_patterns: list[str]) -> bool:
+    if len(include_patterns) > 0 and not matches_import_pattern(relative_path, include_patterns):
+        return True
+    return matches_import_pattern(relative_path, exclude_patterns)
+
+
+def transfer_mod_files(source_dir: Path,
+                       destination_dir: Path,
+                       only_copy: bool,
+                       include_patterns: list[str] | None = None,
+                       exclude_patterns: list[str] | None = None,
+                       stats: TransferStats | None = None,
+                       filter_root: Path | None = None,
+                       progress: ProgressReporter | None = None) -> TransferStats:
+    if stats is None:
+        stats = new_transfer_stats()
+    if filter_root is None:
+        filter_root = source_dir
+    include_patterns = include_patterns if include_patterns is not None else []
+    exclude_patterns = exclude_patterns if exclude_patterns is not None else []
     if not source_dir.is_dir():
-        return
+        return stats
 
     for file_or_directory in source_dir.iterdir():
         special_destination = destination_dir / (file_or_directory.relative_to(source_dir))
+        relative_path = file_or_directory.relative_to(filter_root)
         if file_or_directory.is_file():
+            file_size = file_or_directory.stat().st_size
+            if is_excluded_from_import(relative_path, include_patterns, exclude_patterns):
+                stats["files_skipped"] += 1
+                stats["bytes_skipped"] += file_size
+                if progress is not None:
+                    progress.advance(1, file_size)
+                continue
             special_destination.parent.mkdir(parents=True, exist_ok=True)
             if only_copy:
                 copy2(file_or_directory, special_destination, follow_symlinks=True)
@@ -108,14 +201,34 @@ def transfer_mod_files(source_dir: Path, destination_dir: Path, only_copy: bool)
                 else:
                     copy2(file_or_directory, special_destination, follow_symlinks=True)
                     file_or_directory.unlink(missing_ok=True)
+            stats["files_transferred"] += 1
+            stats["bytes_transferred"] += file_size
+            count("bytes_copied", file_size)
+            if progress is not None:
+                progress.advance(1, file_size)
         elif file_or_directory.is_dir():
-            transfer_mod_files(file_or_directory, special_destination, only_copy=only_copy)
+            if matches_import_pattern(relative_path, exclude_patterns):
+                # Don't descend into excluded directories, just account for their contents
+                skipped_files = [p for p in file_or_directory.rglob("*") if p.is_file()]
+                skipped_bytes = sum(p.stat().st_size for p in skipped_files)
+                stats["files_skipped"] += len(skipped_files)
+                stats["bytes_skipped"] += skipped_bytes
+                if progress is not None:
+                    progress.advance(len(skipped_files), skipped_bytes)
+                continue
+            transfer_mod_files(file_or_directory, special_destination, only_copy=only_copy,
+                               include_patterns=include_patterns,
+                               exclude_patterns=exclude_patterns,
+                               stats=stats,
+                               filter_root=filter_root,
+                               progress=progress)
         else:
             print(f"Unrecognized type, neither file nor directory: {str(file_or_directory)}",
                   file=stderr)
 
     if not only_copy and source_dir.is_dir() and not any(source_dir.iterdir()):
         source_dir.rmdir()
+    return stats
 
 
 def extract_archive(archive_file: Path, destination_dir: Path) -> None:
@@ -144,3 +257,82 @@ def extract_archive(archive_file: Path, destination_dir: Path) -> None:
         run(command)
     else:
         raise f"extraction dependency {command[0]} is not installed"
+
+
+def install_mod_files(mod_id: str,
+                      source: Path,
+                      raw_destination: Path,
+                      subdir: str,
+                      only_copy: bool,
+                      include_patterns: list[str] | None = None,
+                      exclude_patterns: list[str] | None = None,
+                      progress: ProgressReporter | None = None) -> tuple[Path, TransferStats]:
+    """
+    Fills an already created mod version directory with the contents of a source directory or
+    archive. Does not touch the mod's metadata, so it is safe to run for several mods at once.
+    If a progress reporter is given, the files to transfer are counted first, so that it can
+    estimate the remaining time.
+
+    :return: the directory the files were placed in and the transfer statistics
+    """
+    processed_subdir = process_mod_subdir_argument(subdir,
+                                                   mod_id=mod_id,
+                                                   src_dir=source if source.is_dir() else None)
+    destination: Path = (raw_destination / processed_subdir).resolve()
+    if not destination.is_relative_to(raw_destination):
+        raise ValueError("Subdirectories must not break out of the assigned mod folder!")
+    destination.mkdir(parents=True, exist_ok=True)
+
+    def transfer_with_progress(transfer_source: Path, copy_only: bool) -> TransferStats:
+        if progress is not None:
+            from code.usage import scan_usage
+            usage = scan_usage(transfer_source)
+            progress.total_files = usage["files"]
+            progress.total_bytes = usage["apparent_bytes"]
+        return transfer_mod_files(transfer_source, destination, copy_only,
+                                  include_patterns=include_patterns,
+                                  exclude_patterns=exclude_patterns,
+                                  progress=progress)
+
+    transfer_stats: TransferStats
+    if source.is_dir():
+        transfer_stats = transfer_with_progress(source, only_copy)
+        unspool_dir = source.parent
+        while not only_copy and unspool_dir.is_dir() and not any(unspool_dir.iterdir()) and not Path.cwd().samefile(unspool_dir):
+            unspool_dir.rmdir()
+            unspool_dir = unspool_dir.parent
+    elif source.is_file():
+        with TemporaryDirectory() as tmpdir_str:
+            tmpdir = Path(tmpdir_str)
+            extract_archive(source, tmpdir)
+            if len(set(tmpdir.iterdir())) == 0:
+                raise ValueError("Extraction of archive failed. No files in extraction destination.")
+            source_subdirs: list[Path] = list(filter(lambda p: p.is_dir(),
+                                                     tmpdir.rglob(f"**/{subdir}")))
+            # The filters are applied while leaving the temporary extraction directory,
+            # so excluded archive members never reach the mod storage.
+            if len(source_subdirs) == 0:
+                transfer_stats = transfer_with_progress(tmpdir, copy_only=False)
+            elif len(source_subdirs) == 1:
+                transfer_stats = transfer_with_progress(source_subdirs[0], copy_only=False)
+            else:
+                raise ValueError("Multiple candidates for source within archive. You must prepare "
+                                 "these files manually.")
+    else:
+        raise ValueError("internal logic error: source is neither file nor directory")
+    recursive_lower_case_rename(raw_destination)
+    return destination, transfer_stats
+
+
+def write_import_metadata(mod_id: str,
+                          author: str | None = None,
+                          name: str | None = None,
+                          link: str | None = None) -> None:
+    cfg = ModConfig(mod_id)
+    cfg.set(ValidModSettings.LAST_UPDATE_CHECK, current_date())
+    if author is not None:
+        cfg.set(ValidModSettings.AUTHOR, author)
+    if name is not None:
+        cfg.set(ValidModSettings.PRETTY_NAME, name)
+    if link is not None:
+        cfg.set(ValidModSettings.HYPERLINK, link)
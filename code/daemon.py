@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from json import dumps, loads, JSONDecodeError
+from os import dup, dup2, close, environ, umask
+from pathlib import Path
+from socket import socket, AF_UNIX, SOCK_STREAM, send_fds, recv_fds
+from sys import stderr, stdout
+from typing import Any
+
+from code.journal import JournalPosition, JournalRecord
+from code.paths import get_meta_directory
+
+CONNECT_TIMEOUT_SECS = 1.0
+# How long a client waits for the daemon to accept its request, e.g. while the daemon is busy
+# with the request of another client, before running the command itself
+ACCEPT_TIMEOUT_SECS = 5.0
+MAX_REQUEST_BYTES = 1024 * 1024
+FORWARDED_FDS = [0, 1, 2]
+ACCEPTED_LINE = b'{"accepted": true}\n'
+
+# Subcommands the daemon answers. Anything else runs in the calling process, because it needs
+# the namespaces or the terminal of the caller, or it changes the instance. The values restrict
+# a subcommand to some of its actions.
+FORWARDED_SUBCOMMANDS: dict[str, tuple[str, set[str]] | None] = {
+    "list": None,
+    "usage": None,
+    "stats": None,
+    "version": None,
+    "mod": ("mod_action", {"info"}),
+    "config": ("config_actions", {"get", "list"}),
+}
+
+# The state the cache was filled from: a position in the journal, if a watcher is running, and
+# otherwise the deploy plan key, which has to look at every mod and version directory
+state_position: JournalPosition | None = None
+state_key: str | None = None
+state_date: str | None = None
+
+
+class DaemonStopRequested(BaseException):
+    """
+    Raised by the SIGTERM handler. Unlike SystemExit, it is not mistaken for the exit of the
+    command that is running, and unlike Exception, commands do not catch it.
+    """
+
+
+def request_stop(signal_number: int, frame: Any) -> None:
+    raise DaemonStopRequested()
+
+
+def get_socket_path(instance_dir: Path) -> Path:
+    return get_meta_directory(instance_dir) / 'daemon.sock'
+
+
+def is_forwardable(args: dict[str, Any]) -> bool:
+    if args["profile"] or args["subcommand"] not in FORWARDED_SUBCOMMANDS:
+        return False
+    restriction = FORWARDED_SUBCOMMANDS[args["subcommand"]]
+    return restriction is None or args.get(restriction[0]) in restriction[1]
+
+
+def receive_line(connection: socket) -> bytes:
+    data = b""
+    while not data.endswith(b"\n") and len(data) < MAX_REQUEST_BYTES:
+        chunk = connection.recv(65536)
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return data
+
+
+def forward_to_daemon(instance_dir: Path, argv: list[str]) -> int | None:
+    """
+    Lets the daemon of the instance run the command, if one is running. The daemon writes to
+    the standard streams of this process, which are passed along with the request. Only a
+    daemon that accepted the request in time runs it, afterwards the client waits for as long
+    as the command takes.
+
+    :param argv: the arguments of a command for which is_forwardable is true
+    :return: the exit code of the command or None, if it has to be run by this process
+    """
+    if "MODFS_NO_DAEMON" in environ:
+        return None
+    socket_path = get_socket_path(instance_dir)
+    if not socket_path.is_socket():
+        return None
+    with socket(AF_UNIX, SOCK_STREAM) as connection:
+        connection.settimeout(CONNECT_TIMEOUT_SECS)
+        try:
+            connection.connect(str(socket_path))
+        except OSError:
+            return None
+        request = {"argv": argv, "instance": str(instance_dir.resolve())}
+        stdout.flush()
+        stderr.flush()
+        with connection.makefile("rb") as reader:
+            try:
+                connection.settimeout(ACCEPT_TIMEOUT_SECS)
+                connection.sendall(dumps(request).encode() + b"\n")
+                acceptance = reader.readline(MAX_REQUEST_BYTES)
+            except OSError:
+                # Closing the connection withdraws the request
+                return None
+            if acceptance != ACCEPTED_LINE:
+                return None
+            connection.settimeout(None)
+            try:
+                send_fds(connection, [b"\0"], FORWARDED_FDS)
+                reply_data = reader.readline(MAX_REQUEST_BYTES)
+            except OSError:
+                reply_data = b""
+    try:
+        reply: dict[str, Any] = loads(reply_data)
+    except JSONDecodeError:
+        print("ERROR: The modfs daemon stopped while running the command.", file=stderr)
+        return 1
+    return reply["exit_code"] if reply.get("forwarded") else None
+
+
+def exit_code_of(exit_request: SystemExit) -> int:
+    return (exit_request.code if isinstance(exit_request.code, int)
+            else 0 if exit_request.code is None else 1)
+
+
+def run_request(request: dict[str, Any], instance_dir: Path, version_string: str) -> int | None:
+    """
+    Runs the requested command, while the standard streams are those of the client.
+
+    :return: the exit code or None, if the client has to run the command itself
+    """
+    from code.commandline import process_commandline_args
+    from code.metrics import begin_invocation, finish_invocation
+    from code.subcommands import get_subcommands_table
+    if request.get("instance") != str(instance_dir):
+        return None
+    try:
+        args = vars(process_commandline_args(request["argv"]))
+    except SystemExit as exit_request:
+        # Usage errors and the help output are printed the same way by the client
+        return exit_code_of(exit_request)
+    if not is_forwardable(args):
+        return None
+    update_state_cache(instance_dir)
+    args["instance"] = instance_dir
+    args["version_string"] = version_string
+    if args["show_args"]:
+        from pprint import pprint
+        pprint(args)
+    begin_invocation(args["subcommand"])
+    try:
+        get_subcommands_table()[args["subcommand"]](args)
+    except DaemonStopRequested:
+        finish_invocation(1)
+        raise
+    except SystemExit as exit_request:
+        finish_invocation(exit_code_of(exit_request))
+        return exit_code_of(exit_request)
+    except BrokenPipeError:
+        # The client stopped reading its output, e.g. when it is piped into head
+        finish_invocation(1)
+        return 1
+    except Exception:
+        from traceback import print_exc
+        print_exc()
+        finish_invocation(1)
+        return 1
+    finish_invocation(0)
+    return 0
+
+
+def invalidate_changed_state(instance_dir: Path, changes: list[JournalRecord]) -> None:
+    """
+    Forgets only the cached results affected by the recorded changes
+    """
+    from code.statecache import invalidate_cached_function, invalidate_state_cache
+    for change in changes:
+        if change["kind"] == "priority":
+            invalidate_cached_function("read_mod_priority")
+        elif change["kind"] in ("mod", "config", "version"):
+            mod_id = change["mod"]
+            if change["kind"] == "mod":
+                invalidate_cached_function("get_mod_ids")
+                invalidate_cached_function("read_mod_priority")
+            if change["kind"] != "version":
+                invalidate_cached_function("load_mod_config",
+                                           instance_dir / 'mods' / f"{mod_id}.json")
+            if change["kind"] != "config":
+                invalidate_cached_function("get_mod_versions", mod_id)
+            invalidate_cached_function("parse_mod_conflicts")
+        elif change["kind"] == "contents":
+            # Conflicts depend on the names of the files inside the versions
+            invalidate_cached_function("parse_mod_conflicts")
+        elif change["kind"] == "setting":
+            # Instance settings are not cached
+            continue
+        else:
+            invalidate_state_cache()
+
+
+def update_state_cache(instance_dir: Path) -> None:
+    global state_position, state_key, state_date
+    from code.deployplan import compute_deploy_plan_key
+    from code.journal import sync_journal, get_journal_changes
+    from code.statecache import invalidate_state_cache
+    from code.tools import current_date
+    position = sync_journal(instance_dir)
+    changes = (get_journal_changes(instance_dir, state_position, position)
+               if position is not None and state_position is not None
+               and state_date == current_date() else None)
+    if changes is not None:
+        invalidate_changed_state(instance_dir, changes)
+        state_key = None
+    elif position is not None:
+        invalidate_state_cache()
+        state_key = None
+    else:
+        current_key = compute_deploy_plan_key(instance_dir)
+        if current_key != state_key:
+            invalidate_state_cache()
+        state_key = current_key
+    state_position = position
+    state_date = current_date()
+
+
+def handle_connection(connection: socket, instance_dir: Path, version_string: str) -> None:
+    try:
+        request = loads(receive_line(connection))
+        connection.sendall(ACCEPTED_LINE)
+        # The standard streams follow the acceptance, so that a client which stopped waiting
+        # does not leave them open in the queue of this socket
+        _, fds, _, _ = recv_fds(connection, 1, len(FORWARDED_FDS))
+    except JSONDecodeError:
+        return
+    except OSError:
+        # The client stopped waiting and runs the command itself
+        return
+    connection.settimeout(None)
+    if len(fds) != len(FORWARDED_FDS):
+        for fd in fds:
+            close(fd)
+        return
+    saved_fds = [dup(fd) for fd in FORWARDED_FDS]
+    try:
+        for received_fd, standard_fd in zip(fds, FORWARDED_FDS):
+            dup2(received_fd, standard_fd)
+        exit_code = run_request(request, instance_dir, version_string)
+    finally:
+        for stream in [stdout, stderr]:
+            try:
+                stream.flush()
+            except OSError:
+                # The client may have closed its end of a pipe
+                pass
+        for saved_fd, standard_fd in zip(saved_fds, FORWARDED_FDS):
+            dup2(saved_fd, standard_fd)
+            close(saved_fd)
+        for fd in fds:
+            close(fd)
+    reply = {"forwarded": exit_code is not None, "exit_code": exit_code}
+    try:
+        connection.sendall(dumps(reply).encode() + b"\n")
+    except OSError:
+        pass
+
+
+def is_daemon_running(socket_path: Path) -> bool:
+    with socket(AF_UNIX, SOCK_STREAM) as connection:
+        connection.settimeout(CONNECT_TIMEOUT_SECS)
+        try:
+            connection.connect(str(socket_path))
+            return True
+        except OSError:
+            return False
+
+
+def serve(instance_dir: Path, version_string: str, idle_timeout: float) -> None:
+    """
+    Answers the requests of modfs invocations in this instance one after another, until the
+    process is terminated or no request arrived for idle_timeout seconds.
+    """
+    from signal import signal, SIGTERM
+    from socket import timeout as SocketTimeout
+    from code.journal import JournalWatcher
+    from code.statecache import enable_state_cache
+    socket_path = get_socket_path(instance_dir)
+    if is_daemon_running(socket_path):
+        print(f"ERROR: A modfs daemon is already serving this instance on {socket_path}",
+              file=stderr)
+        exit(1)
+    socket_path.unlink(missing_ok=True)
+    enable_state_cache()
+    watcher: JournalWatcher | None = None
+    with socket(AF_UNIX, SOCK_STREAM) as server:
+        # Only the owner of the instance may run commands through the daemon
+        previous_umask = umask(0o177)
+        try:
+            server.bind(str(socket_path))
+        finally:
+            umask(previous_umask)
+        try:
+            signal(SIGTERM, request_stop)
+            try:
+                watcher = JournalWatcher(instance_dir)
+                watcher.start()
+            except OSError as e:
+                print(f"WARNING: Cannot watch the instance for changes ({e}), every request "
+                      "has to check all mod directories instead", file=stderr)
+                watcher = None
+            server.listen()
+            server.settimeout(idle_timeout if idle_timeout > 0 else None)
+            print(f"Serving {instance_dir} on {socket_path}", file=stderr)
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except SocketTimeout:
+                    print("Stopping after being idle for "
+                          f"{idle_timeout:g} seconds", file=stderr)
+                    break
+                with connection:
+                    connection.settimeout(ACCEPT_TIMEOUT_SECS)
+                    handle_connection(connection, instance_dir, version_string)
+        except (KeyboardInterrupt, DaemonStopRequested):
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+            if watcher is not None:
+                watcher.stop()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from os import link, replace, stat_result
+from pathlib import Path
+from stat import S_ISREG
+from sys import stderr
+from typing import Iterable, TypedDict
+
+from code.mod import resolve_base_dir
+from code.paths import get_meta_directory, get_all_files, get_file_hash, clone_file
+from code.settings import get_instance_settings, ValidInstanceSettings
+from code.usage import invalidate_usage_cache
+
+
+class DeduplicationStats(TypedDict):
+    """
+    counters collected during a deduplication run
+    """
+    files_scanned: int
+    files_hashed: int
+    files_deduplicated: int
+    bytes_reclaimed: int
+    objects_removed: int
+
+
+def get_store_directory(base_dir: Path | None = None) -> Path:
+    """
+    :return: The content-addressed store of the instance. Every object is named by the hash of
+             its contents and shares its data with all identical mod files.
+    """
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'store'
+
+
+def get_store_object_path(store_dir: Path, digest: str) -> Path:
+    return store_dir / digest[:2] / digest
+
+
+def replace_with_store_object(file_path: Path, store_object: Path, method: str) -> bool:
+    """
+    Atomically swaps file_path for a hardlink or reflink of store_object. The path itself never
+    disappears, so overlay lowerdirs referencing the file stay valid.
+    """
+    temporary_path = file_path.with_name(f".{file_path.name}.modfs-dedupe")
+    temporary_path.unlink(missing_ok=True)
+    if method == "reflink":
+        if not clone_file(store_object, temporary_path):
+            return False
+    else:
+        link(store_object, temporary_path)
+    replace(temporary_path, file_path)
+    return True
+
+
+def add_to_store(file_path: Path, store_object: Path, method: str) -> bool:
+    store_object.parent.mkdir(parents=True, exist_ok=True)
+    if method == "reflink":
+        return clone_file(file_path, store_object)
+    link(file_path, store_object)
+    return True
+
+
+def deduplicate_files(files: Iterable[Path],
+                      method: str,
+                      base_dir: Path | None = None) -> DeduplicationStats:
+    """
+    Links identical files to a shared object in the content-addressed store.
+    Files are first grouped by size and only hashed, if another file or a store object of the
+    same size exists.
+    """
+    stats = DeduplicationStats(files_scanned=0, files_hashed=0, files_deduplicated=0,
+                               bytes_reclaimed=0, objects_removed=0)
+    store_dir = get_store_directory(base_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    mods_dir = resolve_base_dir(base_dir) / 'mods'
+    if store_dir.stat().st_dev != mods_dir.stat().st_dev:
+        raise ValueError(f"The store directory {store_dir} must be on the same filesystem as "
+                         f"{mods_dir} for deduplication to work")
+
+    store_sizes: set[int] = set()
+    store_inodes: set[tuple[int, int]] = set()
+    for store_object in store_dir.glob("*/*"):
+        object_stat = store_object.stat()
+        store_sizes.add(object_stat.st_size)
+        store_inodes.add((object_stat.st_dev, object_stat.st_ino))
+
+    size_buckets: dict[int, list[tuple[Path, stat_result]]] = dict()
+    for file_path in files:
+        file_stat = file_path.lstat()
+        stats["files_scanned"] += 1
+        if not S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+            continue
+        size_buckets.setdefault(file_stat.st_size, []).append((file_path, file_stat))
+
+    # Linking files changes which inodes are shared, also in versions that keep their files
+    invalidate_usage_cache(base_dir=base_dir)
+    for size, candidates in size_buckets.items():
+        if len(candidates) < 2 and size not in store_sizes:
+            continue
+        for file_path, file_stat in candidates:
+            if method == "hardlink" and (file_stat.st_dev, file_stat.st_ino) in store_inodes:
+                # Already linked to the store by a previous run
+                continue
+            digest = get_file_hash(file_path)
+            stats["files_hashed"] += 1
+            store_object = get_store_object_path(store_dir, digest)
+            if not store_object.exists():
+                if not add_to_store(file_path, store_object, method):
+                    raise ValueError(f"The filesystem of {store_dir} does not support reflinks. "
+                                     "Use the hardlink deduplication method instead.")
+                object_stat = store_object.stat()
+                store_sizes.add(object_stat.st_size)
+                store_inodes.add((object_stat.st_dev, object_stat.st_ino))
+                continue
+            if method == "hardlink" and store_object.samefile(file_path):
+                continue
+            if replace_with_store_object(file_path, store_object, method):
+                stats["files_deduplicated"] += 1
+                # Other hardlinks outside the store would keep the old data alive
+                if method == "reflink" or file_stat.st_nlink == 1:
+                    stats["bytes_reclaimed"] += file_stat.st_blocks * 512
+    return stats
+
+
+def remove_unused_store_objects(base_dir: Path | None = None) -> int:
+    """
+    Deletes hardlinked store objects that are no longer used by any mod file.
+    Reflinked objects cannot be tracked this way and are kept.
+
+    :return: number of removed objects
+    """
+    num_removed = 0
+    for store_object in get_store_directory(base_dir).glob("*/*"):
+        if store_object.stat().st_nlink == 1:
+            store_object.unlink()
+            num_removed += 1
+    return num_removed
+
+
+def deduplicate_instance(base_dir: Path | None = None) -> DeduplicationStats:
+    method: str = get_instance_settings().get(ValidInstanceSettings.DEDUPLICATION_METHOD)
+    # Only the files of the versions, the configuration files of the mods are rewritten in place
+    mod_files: set[Path] = set()
+    for mod_dir in (resolve_base_dir(base_dir) / 'mods').iterdir():
+        if not mod_dir.is_symlink() and mod_dir.is_dir():
+            mod_files |= get_all_files(mod_dir)
+    stats = deduplicate_files(mod_files, method, base_dir)
+    if method == "hardlink":
+        stats["objects_removed"] = remove_unused_store_objects(base_dir)
+    return stats
+
+
+def deduplicate_after_import(mod_id: str, base_dir: Path | None = None) -> None:
+    """
+    Runs the deduplication for all versions of a freshly imported mod, if the instance has
+    enabled the always-on deduplication mode.
+    """
+    settings = get_instance_settings()
+    if not settings.get(ValidInstanceSettings.DEDUPLICATE_ON_IMPORT):
+        return
+    try:
+        deduplicate_files(get_all_files(resolve_base_dir(base_dir) / 'mods' / mod_id),
+                          settings.get(ValidInstanceSettings.DEDUPLICATION_METHOD),
+                          base_dir)
+    except (OSError, ValueError) as e:
+        print(f"Deduplication of {mod_id} failed: {e}", file=stderr)
@@ -13,10 +13,12 @@ from time import time
 from functools import reduce
 from tempfile import NamedTemporaryFile
 from math import sqrt, ceil
+from typing import TextIO
 
 from code.mod import get_mod_mount_path
 from code.settings import InstanceSettings, ValidInstanceSettings, get_instance_settings
 from code.commandline import get_instance_path, get_pid_path
+from code.timings import PhaseTimer, get_timing_log_path, append_timing_record, print_timings
 
 
 def are_paths_on_same_filesystem(path1: Path, path2: Path) -> bool:
@@ -58,50 +60,489 @@ def clean_old_links(links_dir) -> None:
             old_link.unlink()
 
 
+def resolve_deployment_layers(mods_to_deploy: OrderedDict[str, tuple[str, str]]) -> list[Path]:
+    """
+    :return: the directories of the given mod versions in order of increasing priority
+    """
+    layers: list[Path] = []
+    for mod in mods_to_deploy.keys():
+        date, subversion = mods_to_deploy[mod]
+        mod_dir = get_mod_mount_path(mod, date, subversion)
+        if mod_dir.is_dir():
+            layers.append(mod_dir)
+    return layers
+
+
+def list_layer_entries(layer: Path) -> tuple[list[str], list[str]]:
+    """
+    :return: the relative paths of all non-directory entries and of all directories in a layer.
+             Symbolic links to directories count as files, the same way overlayfs treats them.
+    """
+    from os import scandir
+    from code.metrics import count
+    files: list[str] = []
+    dirs: list[str] = []
+    pending_dirs = [""]
+    while len(pending_dirs) > 0:
+        relative_dir = pending_dirs.pop()
+        with scandir(layer / relative_dir) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(relative_path)
+                    pending_dirs.append(relative_path)
+                else:
+                    files.append(relative_path)
+    count("files_scanned", len(files))
+    return files, dirs
+
+
+def get_layer_signature(layer: Path, dirs: list[str]) -> str | None:
+    """
+    Summarizes the modification times of all directories of a layer. Adding, removing or
+    renaming an entry changes the modification time of its directory, e.g. when a repair
+    renames files or deduplication replaces them.
+
+    :return: None, if one of the directories is gone
+    """
+    from hashlib import sha256
+    from os import stat
+    signature = sha256()
+    try:
+        for relative_dir in ["", *dirs]:
+            dir_stat = stat(layer / relative_dir)
+            signature.update(f"{relative_dir}\t{dir_stat.st_ino}\t{dir_stat.st_mtime_ns}\n"
+                             .encode(errors="surrogateescape"))
+    except FileNotFoundError:
+        return None
+    return signature.hexdigest()
+
+
+def resolve_winning_files(layer_entries: list[tuple[Path, list[str], list[str]]]) -> dict[str, Path]:
+    """
+    Determines which layer provides each file of the merged view, following the rules of
+    overlayfs: A file hides all entries at the same path or below it in lower layers and a
+    directory hides files of the same name in lower layers.
+
+    :param layer_entries: (layer, files, directories) in order of increasing priority
+    :return: mapping of relative file path to the layer providing it
+    """
+    winners: dict[str, Path] = dict()
+    higher_dirs: set[str] = set()
+    for layer, files, dirs in reversed(layer_entries):
+        for relative_path in files:
+            if relative_path in winners or relative_path in higher_dirs:
+                continue
+            parent, _, _ = relative_path.rpartition("/")
+            hidden = False
+            while len(parent) > 0 and not hidden:
+                hidden = parent in winners
+                parent, _, _ = parent.rpartition("/")
+            if not hidden:
+                winners[relative_path] = layer
+        higher_dirs.update(dirs)
+    return winners
+
+
+def get_namespace_directory() -> Path:
+    from code.mod import resolve_base_dir
+    from code.paths import get_meta_directory
+    return get_meta_directory(resolve_base_dir()) / 'namespace'
+
+
+def lock_instance() -> TextIO:
+    """
+    Waits until no other modfs process holds the lock of the instance, which serializes changes
+    to the deployment, e.g. starting a session or materializing the mods.
+
+    :return: the lock file, which holds the lock until it is closed
+    """
+    from fcntl import flock, LOCK_EX
+    lock_path = get_namespace_directory() / 'lock'
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = lock_path.open("a")
+    flock(lock_file, LOCK_EX)
+    return lock_file
+
+
+def get_session_directory(read_only: bool) -> Path:
+    """
+    There is at most one writable and one read-only session per instance. Each of them is a
+    namespace helper holding its mount, which any number of commands can use at the same time.
+    """
+    return get_namespace_directory() / ('read-only' if read_only else 'writable')
+
+
+def get_lease_directory(read_only: bool) -> Path:
+    """
+    :return: The directory holding one lease per command using the mount of the namespace helper
+    """
+    return get_session_directory(read_only) / 'leases'
+
+
+def get_namespace_state_path(read_only: bool) -> Path:
+    return get_session_directory(read_only) / 'state.json'
+
+
+def read_namespace_state(read_only: bool) -> dict | None:
+    """
+    :return: the state of the running namespace helper or None, if there is none
+    """
+    from json import loads, JSONDecodeError
+    from code.mountstate import find_overlay_mount
+    from code.tools import is_process_alive
+    try:
+        state = loads(get_namespace_state_path(read_only).read_text(encoding="UTF-8"))
+    except (FileNotFoundError, JSONDecodeError):
+        return None
+    if not is_process_alive(state["pid"]):
+        return None
+    # The pid may have been reused after the helper was killed. Joining or stopping that
+    # process would be wrong, so the helper must still hold the mount.
+    if "target" in state and find_overlay_mount(Path(state["target"]), state["pid"]) is None:
+        return None
+    return state
+
+
+def get_layers_in_use(target_dir: Path) -> set[Path]:
+    """
+    :return: the resolved layers mounted by running sessions. The layers recorded by helpers
+             that are still alive are included as well, in case their mounts cannot be read.
+    """
+    from json import loads, JSONDecodeError
+    from code.mountstate import get_mounted_layers
+    from code.tools import is_process_alive
+    layers = get_mounted_layers(target_dir)
+    for read_only in [False, True]:
+        try:
+            state = loads(get_namespace_state_path(read_only).read_text(encoding="UTF-8"))
+        except (FileNotFoundError, JSONDecodeError):
+            continue
+        if is_process_alive(state["pid"]):
+            layers |= {Path(layer).resolve() for layer in state.get("layers", [])}
+    return layers
+
+
+def find_namespace_helper(read_only: bool) -> tuple[int, str] | None:
+    """
+    :return: pid of the running namespace helper and the key of the deploy plan it has mounted
+    """
+    state = read_namespace_state(read_only)
+    return (state["pid"], state["key"]) if state is not None else None
+
+
+def reclaim_abandoned_work_dirs(work_dir: Path) -> None:
+    """
+    Hands everything in the work directory that does not belong to a running session over to
+    the reaper. This cleans up after sessions whose helper was killed before it could do so.
+    """
+    from code.nshelper import WORK_TRASH_NAME
+    from code.reaper import move_to_trash, empty_trash_in_background
+    state = read_namespace_state(read_only=False)
+    active_work_dir = state.get("work_dir") if state is not None else None
+    abandoned = [entry for entry in work_dir.iterdir()
+                 if entry.name != WORK_TRASH_NAME and str(entry) != active_work_dir]
+    if len(abandoned) == 0:
+        return
+    trash_dir = work_dir / WORK_TRASH_NAME
+    for entry in abandoned:
+        move_to_trash(entry, trash_dir)
+    empty_trash_in_background(trash_dir)
+
+
+def has_foreign_leases(read_only: bool) -> bool:
+    from os import getpid
+    from code.tools import is_process_alive
+    lease_dir = get_lease_directory(read_only)
+    return any(lease.name != str(getpid()) and lease.name.isdigit()
+               and is_process_alive(int(lease.name))
+               for lease in (lease_dir.iterdir() if lease_dir.is_dir() else []))
+
+
+def stop_namespace_helper(pid: int) -> None:
+    from time import sleep
+    from code.tools import is_process_alive
+    kill(pid, SIGTERM)
+    deadline = time() + 10
+    while is_process_alive(pid) and time() < deadline:
+        sleep(0.1)
+    if is_process_alive(pid):
+        print(f"Namespace helper {pid} did not exit. Refusing to mount a second time.", file=stderr)
+        exit(1)
+
+
+def supports_direct_namespace_setup() -> bool:
+    """
+    Python 3.12 added os.unshare and os.setns. Older versions use unshare(1) and nsenter(1).
+    """
+    import os
+    return hasattr(os, "unshare") and hasattr(os, "setns")
+
+
+def execute_in_namespace(helper_pid: int, command: list[str]) -> None:
+    """
+    Replaces the current process with the command, running inside the helper's namespaces.
+    The lease of this process stays valid, because the command keeps its pid.
+    """
+    from os import execvp
+    from code.nshelper import join_helper_namespaces
+    from code.metrics import finish_invocation
+    from code.profiling import finish_active_profile
+    finish_active_profile()
+    finish_invocation(0)
+    join_helper_namespaces(helper_pid)
+    stderr.flush()
+    try:
+        execvp(command[0], command)
+    except OSError as e:
+        print(f"Failed to execute {command[0]}: {e.strerror}", file=stderr)
+        exit(127)
+
+
+def run_in_namespace(helper_pid: int, command: list[str]) -> int:
+    """
+    Runs the command inside the helper's namespaces and waits for it to exit.
+
+    :return: exit code of the command
+    """
+    from os import fork, waitpid, waitstatus_to_exitcode, _exit
+    child_pid = fork()
+    if child_pid == 0:
+        try:
+            from code.metrics import discard_invocation
+            from code.profiling import discard_active_profile
+            discard_active_profile()
+            discard_invocation()
+            execute_in_namespace(helper_pid, command)
+        finally:
+            _exit(127)
+    _, wait_status = waitpid(child_pid, 0)
+    return waitstatus_to_exitcode(wait_status)
+
+
+def start_namespace_helper(target_dir: Path,
+                           layers: list[Path],
+                           overflow_dir: Path,
+                           work_dir: Path | None,
+                           plan_key: str,
+                           read_only: bool,
+                           timing_log: Path | None = None) -> tuple[int, dict[str, float]]:
+    """
+    Starts the process that mounts the overlay in new user and mount namespaces and keeps them
+    alive until no command has used them for namespaceHelperLifetimeSeconds.
+
+    :param timing_log: where the helper records how long the unmount took, if at all
+    :return: pid of the namespace helper and the durations of its setup phases
+    """
+    from json import dumps
+    from subprocess import DEVNULL
+    from sys import executable
+    lifetime_secs: int = get_instance_settings().get(
+        ValidInstanceSettings.NAMESPACE_HELPER_LIFETIME_SECS)
+    config = {
+        "target": str(target_dir.resolve()),
+        "layers": [str(layer) for layer in layers],
+        "overflow_dir": str(overflow_dir),
+        "work_dir": str(work_dir) if work_dir is not None else None,
+        "lease_dir": str(get_lease_directory(read_only)),
+        "lifetime_secs": lifetime_secs,
+        "read_only": read_only,
+        "timing_log": str(timing_log) if timing_log is not None else None,
+    }
+    log_path = get_session_directory(read_only) / 'helper.log'
+    if supports_direct_namespace_setup():
+        from code.nshelper import start_helper_in_new_namespaces
+        ready_report = start_helper_in_new_namespaces(config, log_path)
+    else:
+        from code.nshelper import parse_ready_report
+        with log_path.open("wt") as log_file:
+            helper_proc = Popen([
+                "unshare",
+                "--user",
+                "--mount",
+                "--map-root-user", "--",
+                executable, str(Path(__file__).with_name("nshelper.py")), dumps(config)
+            ], stdin=DEVNULL, stdout=PIPE, stderr=log_file, text=True, cwd="/",
+                start_new_session=True)
+        with helper_proc.stdout as helper_output:
+            ready_report = parse_ready_report(helper_output.readline())
+        if ready_report is None:
+            helper_proc.wait()
+    if ready_report is None:
+        print("Failed to mount the overlay:", file=stderr)
+        print(log_path.read_text(encoding="UTF-8"), file=stderr)
+        exit(1)
+    helper_pid: int = ready_report["pid"]
+    get_namespace_state_path(read_only).write_text(dumps({"pid": helper_pid,
+                                                          "key": plan_key,
+                                                          "target": config["target"],
+                                                          "work_dir": config["work_dir"],
+                                                          "layers": config["layers"]}),
+                                                   encoding="UTF-8")
+    if not read_only:
+        get_pid_path().write_text(str(helper_pid) + "\n")
+    return helper_pid, ready_report["phases"]
+
+
 def run_in_filesystem(target_dir: Path,
-                      mods_to_deploy: OrderedDict[str, tuple[str, str]],
-                      command: str) -> None:
+                      layers: list[Path],
+                      command: list[str],
+                      overflow_dir: Path | None = None,
+                      work_dir: Path | None = None,
+                      plan_key: str = "",
+                      read_only: bool = False,
+                      timer: PhaseTimer | None = None,
+                      show_timings: bool = False,
+                      report_changes: bool = False,
+                      snapshot_changes: bool = False) -> None:
+    """
+    Runs the command with the mods mounted over target_dir. If a namespace helper with the same
+    deploy plan is still alive from an earlier run, the command joins its namespace instead of
+    mounting everything again.
+
+    With a timer, the duration of every phase is appended to the timing log. In that case the
+    command runs as a child process, so that its runtime can be measured.
+
+    With report_changes, the metadata of the overflow directory is recorded before and after the
+    command of a writable session and the differences are saved as a report. The command runs
+    as a child process then, too.
+
+    With snapshot_changes, the overflow directory is snapshotted before a new writable session
+    mounts it, while no other session can change it.
+
+    Only one writable mount may use the overflow directory at a time, so a writable session with
+    a different deploy plan is refused while commands still use the current one. Read-only
+    sessions mount the overflow directory as their top layer and never write to it. Because
+    overlayfs does not support changes to its lower layers, read-only and writable sessions
+    exclude each other as well.
+    """
+    from os import getcwd, getpid
+    from uuid import uuid4
     assert target_dir is not None
     assert target_dir.is_dir()
-    num_mods = len(mods_to_deploy)
+    num_mods = len(layers)
     if num_mods < 1:
         print("Error: Must have at least one source folder for deployment", file=stderr)
         exit(1)
-    mod_dirs = []
-    for mod in mods_to_deploy.keys():
-        date, subversion = mods_to_deploy[mod]
-        mod_dir = get_mod_mount_path(mod, date, subversion)
-        if mod_dir.is_dir():
-            mod_dirs = [str(mod_dir)] + mod_dirs
-    overflow_dir = get_or_create_overflow_dir()
-    work_dir = get_or_create_work_dir()
+    if len(command) == 0:
+        print("Error: No command was given to run", file=stderr)
+        exit(1)
+    overflow_dir = overflow_dir if overflow_dir is not None else get_or_create_overflow_dir()
+    work_dir = work_dir if work_dir is not None else get_or_create_work_dir()
+    overflow_dir.mkdir(parents=True, exist_ok=True)
+    work_dir.mkdir(parents=True, exist_ok=True)
     if not are_paths_on_same_filesystem(overflow_dir, work_dir):
         print("work directory must be on the same filesystem as overflow", file=stderr)
         exit(1)
-    print("Source directories:", file=stderr)
-    pp(list(map(lambda s: str(s).replace(str(get_instance_path()), "."), mod_dirs)), stream=stderr)
-    pid_path = get_pid_path()
-    pid_path.touch(exist_ok=True)
-    mount_cmd = f"mount --exclusive --onlyonce -t overlay overlay -o nodev,nosuid,noatime,userxattr -o 'workdir={work_dir}' -o 'upperdir={overflow_dir}' -o 'lowerdir+="
-    print(f"Mounting {num_mods} sources for overlay...", file=stderr)
-    namespace_proc = Popen([
-        "unshare",
-        "--user",
-        "--mount",
-        "--map-root-user", "--", "/bin/bash"
-    ], stdin=PIPE, text=True)
-    pid_path.write_text(str(namespace_proc.pid) + "\n")
-    with namespace_proc.stdin as cmdrelay:
-        print("set -euo pipefail", file=cmdrelay)
-        lowerdir_concat_fn = lambda s1,s2: s1+"' -o lowerdir+='"+s2
-        print(mount_cmd + reduce(lowerdir_concat_fn, map(lambda p: str(p), mod_dirs)) + "' '" + str(target_dir) + "'", file=cmdrelay)
-        command_str = "'" + reduce(lambda s1,s2: s1+"' '"+s2, command) + "'"
-        print("Executing: " + command_str, file=stderr)
-        print(command_str, file=cmdrelay)
-        print("umount --lazy --read-only '" + str(target_dir) + "'", file=cmdrelay)
-        print("rm -rf '" + str(work_dir) + "/'*", file=cmdrelay)
-    exit_code = namespace_proc.wait()
+    session_name = "read-only" if read_only else "writable"
+    lease_dir = get_lease_directory(read_only)
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    lease_path = lease_dir / str(getpid())
+    timer = timer if timer is not None else (PhaseTimer() if show_timings else None)
+    joined_session = False
+    overflow_before = None
+    try:
+        lock_start = time()
+        # Serializes the decision to join, replace or start a session between concurrent runs
+        with lock_instance():
+            if timer is not None:
+                timer.add("lock", time() - lock_start)
+            # The lease must exist before a new helper starts, or it could exit right away
+            lease_path.touch()
+            other_helper = find_namespace_helper(not read_only)
+            if other_helper is not None:
+                other_session_name = "writable" if read_only else "read-only"
+                if has_foreign_leases(not read_only):
+                    print(f"A {other_session_name} session is still in use by another command. "
+                          f"A {session_name} session cannot use the overflow directory at the "
+                          "same time. Wait for it to exit and try again.", file=stderr)
+                    exit(1)
+                stop_start = time()
+                stop_namespace_helper(other_helper[0])
+                if timer is not None:
+                    timer.add("stop_previous_session", time() - stop_start)
+            helper = find_namespace_helper(read_only)
+            if helper is not None and helper[1] != plan_key:
+                if has_foreign_leases(read_only):
+                    print(f"A {session_name} session with a different mod configuration is "
+                          "still in use by another command. Wait for it to exit and try again.",
+                          file=stderr)
+                    exit(1)
+                stop_start = time()
+                stop_namespace_helper(helper[0])
+                if timer is not None:
+                    timer.add("stop_previous_session", time() - stop_start)
+                helper = None
+            if helper is None:
+                print("Source directories:", file=stderr)
+                pp([str(layer).replace(str(get_instance_path()), ".")
+                    for layer in reversed(layers)], stream=stderr)
+                print(f"Mounting {num_mods} sources for {session_name} overlay...", file=stderr)
+                session_work_dir = None
+                if not read_only:
+                    if snapshot_changes:
+                        from code.snapshots import snapshot_overflow
+                        snapshot_start = time()
+                        snapshot_overflow(overflow_dir, reason="run")
+                        if timer is not None:
+                            timer.add("snapshot", time() - snapshot_start)
+                    reclaim_abandoned_work_dirs(work_dir)
+                    session_work_dir = work_dir / f"session-{uuid4().hex[:12]}"
+                    session_work_dir.mkdir()
+                helper_start = time()
+                helper_pid, helper_phases = start_namespace_helper(
+                    target_dir, layers, overflow_dir, session_work_dir, plan_key, read_only,
+                    timing_log=get_timing_log_path() if timer is not None else None)
+                if timer is not None:
+                    helper_total = time() - helper_start
+                    for name, seconds in helper_phases.items():
+                        timer.add(name, seconds)
+                    timer.add("helper_startup", helper_total - sum(helper_phases.values()))
+            else:
+                helper_pid = helper[0]
+                joined_session = True
+                print(f"Joining the existing {session_name} session of namespace helper "
+                      f"{helper_pid}", file=stderr)
+        if report_changes and not read_only:
+            from code.overflowreport import index_overflow
+            index_start = time()
+            overflow_before = index_overflow(overflow_dir)
+            if timer is not None:
+                timer.add("overflow_index", time() - index_start)
+        print("Executing: " + " ".join(command), file=stderr)
+        command_start = time()
+        if not supports_direct_namespace_setup():
+            exit_code = call(["nsenter", "--target", str(helper_pid), "--user", "--mount",
+                              f"--wd={getcwd()}", "--", *command])
+        elif timer is not None or overflow_before is not None:
+            exit_code = run_in_namespace(helper_pid, command)
+        else:
+            execute_in_namespace(helper_pid, command)
+        if timer is not None:
+            timer.add("command", time() - command_start)
+    finally:
+        lease_path.unlink(missing_ok=True)
 
+    if overflow_before is not None:
+        from code.overflowreport import index_overflow, compare_overflow_indexes, has_changes, \
+            save_overflow_report, print_overflow_report_summary
+        index_start = time()
+        report = compare_overflow_indexes(overflow_before, index_overflow(overflow_dir), command)
+        if has_changes(report):
+            print_overflow_report_summary(report, save_overflow_report(report))
+        if timer is not None:
+            timer.add("overflow_index", time() - index_start)
+    if timer is not None:
+        details = {
+            "session": session_name,
+            "joined_existing_session": joined_session,
+            "layers": num_mods,
+            "lowerdir_length": len(":".join(str(layer) for layer in layers)),
+        }
+        append_timing_record({"event": "run", "phases": timer.phases, "exit_code": exit_code}
+                             | details)
+        if show_timings:
+            print_timings(timer, details)
     if exit_code != 0:
         print("Exiting with code " + str(exit_code), file=stderr)
     exit(exit_code)
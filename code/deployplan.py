@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from hashlib import sha256
+from json import load, dump, JSONDecodeError
+from os import scandir, stat
+from pathlib import Path
+from typing import TypedDict
+
+from code.journal import JournalPosition, get_journal_changes, get_contents_marker_directory
+from code.paths import get_meta_directory, get_cache_directory
+from code.tools import current_date
+
+DEPLOY_PLAN_FORMAT_VERSION = 2
+
+
+class DeployPlan(TypedDict):
+    """
+    everything run needs to know before it can mount the mods
+    """
+    key: str
+    target: str
+    layers: list[str]
+    overflow_dir: str
+    work_dir: str
+    # Where the journal stood when the plan was computed, if a watcher was running
+    journal: JournalPosition | None
+    date: str
+
+
+def get_deploy_plan_path(instance_dir: Path) -> Path:
+    return get_cache_directory(instance_dir) / 'deploy-plan.json'
+
+
+def compute_deploy_plan_key(instance_dir: Path) -> str:
+    """
+    Derives a key from the modification times of everything the deploy plan depends on: the
+    priority list, the instance settings, the mod configurations and the directories listing the
+    versions of each mod. Instead of checking the contents of all version directories, the
+    markers of record_contents_change are included.
+
+    The current date is part of the key, because it decides which layers count as stable for
+    compaction and which version a version tag without date refers to.
+    """
+    meta_dir = get_meta_directory(instance_dir)
+    settings_dir = meta_dir / 'settings'
+    mods_dir = instance_dir / 'mods'
+    paths: list[str] = [str(meta_dir / 'priority.txt'), str(settings_dir), str(mods_dir)]
+    contents_dir = get_contents_marker_directory(instance_dir)
+    paths.append(str(contents_dir))
+    for listed_dir in [settings_dir, contents_dir]:
+        try:
+            with scandir(listed_dir) as entries:
+                paths += [entry.path for entry in entries]
+        except FileNotFoundError:
+            pass
+    with scandir(mods_dir) as mod_entries:
+        for mod_entry in mod_entries:
+            paths.append(mod_entry.path)
+            if mod_entry.is_dir():
+                with scandir(mod_entry.path) as date_entries:
+                    paths += [date_entry.path for date_entry in date_entries]
+    key = sha256(f"{DEPLOY_PLAN_FORMAT_VERSION}\n{current_date()}\n".encode())
+    for path in sorted(paths):
+        try:
+            path_stat = stat(path)
+            key.update(f"{path}\t{path_stat.st_ino}\t{path_stat.st_mtime_ns}\n".encode())
+        except FileNotFoundError:
+            key.update(f"{path}\tmissing\n".encode())
+    return key.hexdigest()
+
+
+def load_deploy_plan(instance_dir: Path, journal: JournalPosition | None) -> DeployPlan | None:
+    """
+    Checks the journal for changes since the plan was saved, if both the plan and the caller
+    know a position in the same journal. Otherwise the key has to be recomputed.
+
+    :param journal: the current position in the journal as returned by sync_journal
+    :return: the cached deploy plan or None, if the instance changed since it was saved
+    """
+    try:
+        with get_deploy_plan_path(instance_dir).open("rt") as f:
+            plan: DeployPlan = load(f)
+    except (FileNotFoundError, JSONDecodeError):
+        return None
+    if journal is not None and plan.get("journal") is not None \
+            and plan.get("date") == current_date():
+        changes = get_journal_changes(instance_dir, plan["journal"], journal)
+        if changes is not None:
+            return plan if len(changes) == 0 else None
+    if plan.get("key") != compute_deploy_plan_key(instance_dir):
+        return None
+    return plan
+
+
+def save_deploy_plan(instance_dir: Path,
+                     target_dir: Path,
+                     layers: list[Path],
+                     overflow_dir: Path,
+                     work_dir: Path,
+                     journal: JournalPosition | None) -> DeployPlan:
+    """
+    :param journal: the position in the journal before the plan was computed
+    """
+    plan = DeployPlan(key=compute_deploy_plan_key(instance_dir),
+                      target=str(target_dir),
+                      layers=[str(layer) for layer in layers],
+                      overflow_dir=str(overflow_dir),
+                      work_dir=str(work_dir),
+                      journal=journal,
+                      date=current_date())
+    plan_path = get_deploy_plan_path(instance_dir)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = plan_path.with_suffix(".tmp")
+    with temporary_path.open("wt") as f:
+        dump(plan, f)
+    temporary_path.replace(plan_path)
+    return plan
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from json import dumps, loads, JSONDecodeError
+from os import getpid, kill, read, close, fsencode
+from pathlib import Path
+from struct import calcsize, unpack_from
+from threading import Event, Thread
+from time import monotonic, sleep, time_ns
+from typing import TypedDict, NotRequired
+from uuid import uuid4
+
+from code.paths import get_meta_directory
+
+JOURNAL_ROTATE_BYTES = 1024 * 1024
+SYNC_MARKER_PREFIX = ".journal-sync-"
+SYNC_TIMEOUT_SECS = 1.0
+CONTENTS_DIR_NAME = "contents"
+
+# See inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = "iIII"
+
+
+class JournalRecord(TypedDict):
+    """
+    one change noticed by the watcher. Records are numbered without gaps. The kinds are:
+
+    - start: a watcher began a new journal or rotated it, see watcher and pid
+    - sync: the marker file token was created, everything before it has been recorded
+    - priority: the priority list changed
+    - setting: the instance setting changed, all of them if setting is missing
+    - mod: the directory of mod appeared or disappeared
+    - config: the configuration file of mod changed
+    - version: version (a date or date/subversion) of mod appeared or disappeared
+    - contents: files inside the versions of mod changed, of all mods if mod is missing
+    - rescan: changes may have been lost, everything has to be checked again
+    """
+    seq: int
+    kind: str
+    watcher: NotRequired[str]
+    pid: NotRequired[int]
+    token: NotRequired[str]
+    mod: NotRequired[str]
+    version: NotRequired[str]
+    setting: NotRequired[str]
+
+
+class JournalPosition(TypedDict):
+    watcher: str
+    seq: int
+
+
+def get_contents_marker_directory(instance_dir: Path) -> Path:
+    return get_meta_directory(instance_dir) / CONTENTS_DIR_NAME
+
+
+def record_contents_change(instance_dir: Path, mod_id: str) -> None:
+    """
+    Marks that files inside the versions of a mod changed, e.g. because they were renamed.
+    The contents of versions are not watched, so the journal and the deploy plan key notice
+    the change through the marker file of the mod instead.
+    """
+    marker_dir = get_contents_marker_directory(instance_dir)
+    marker_dir.mkdir(parents=True, exist_ok=True)
+    (marker_dir / mod_id).write_text(f"{time_ns()}\n", encoding="UTF-8")
+
+
+def get_journal_path(instance_dir: Path) -> Path:
+    return get_meta_directory(instance_dir) / 'journal.jsonl'
+
+
+def parse_journal_lines(text: str) -> list[JournalRecord]:
+    records: list[JournalRecord] = []
+    for line in text.splitlines():
+        try:
+            records.append(loads(line))
+        except JSONDecodeError:
+            continue
+    return records
+
+
+def read_journal(instance_dir: Path) -> list[JournalRecord]:
+    try:
+        return parse_journal_lines(get_journal_path(instance_dir).read_text(encoding="UTF-8"))
+    except FileNotFoundError:
+        return []
+
+
+def is_watcher_running(instance_dir: Path) -> bool:
+    """
+    Only looks at the first record, so that the journal does not have to be read completely
+    """
+    try:
+        with get_journal_path(instance_dir).open("rt", encoding="UTF-8") as f:
+            start: JournalRecord = loads(f.readline())
+        kill(start["pid"], 0)
+        return True
+    except (FileNotFoundError, JSONDecodeError, KeyError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        return True
+
+
+def sync_journal(instance_dir: Path) -> JournalPosition | None:
+    """
+    Waits until the watcher has recorded all changes made so far. A marker file is created
+    in the watched metadata directory, because inotify reports the events of one watcher in
+    order: once the marker is in the journal, all earlier changes are as well.
+
+    :return: the position in the journal up to which all changes are recorded or None, if no
+             watcher is running and the state of the instance has to be checked directly
+    """
+    if not is_watcher_running(instance_dir):
+        return None
+    journal_path = get_journal_path(instance_dir)
+    token = f"{SYNC_MARKER_PREFIX}{getpid()}-{uuid4().hex}"
+    marker_path = get_meta_directory(instance_dir) / token
+    try:
+        with journal_path.open("rt", encoding="UTF-8") as journal:
+            start: JournalRecord = loads(journal.readline())
+            journal.seek(0, 2)
+            marker_path.touch(exist_ok=False)
+            pending = ""
+            deadline = monotonic() + SYNC_TIMEOUT_SECS
+            delay = 0.0005
+            while monotonic() < deadline:
+                pending += journal.read()
+                lines = pending.split("\n")
+                pending = lines.pop()
+                for record in parse_journal_lines("\n".join(lines)):
+                    if record["kind"] == "sync" and record.get("token") == token:
+                        return JournalPosition(watcher=start["watcher"], seq=record["seq"])
+                sleep(delay)
+                delay = min(delay * 2, 0.01)
+    except (OSError, JSONDecodeError, KeyError):
+        pass
+    finally:
+        marker_path.unlink(missing_ok=True)
+    # The watcher hung or rotated the journal in the meantime
+    return None
+
+
+def get_journal_changes(instance_dir: Path,
+                        since: JournalPosition,
+                        until: JournalPosition) -> list[JournalRecord] | None:
+    """
+    :return: the changes recorded after since up to until or None, if they are not all known,
+             because another watcher wrote the journal or the records were rotated away
+    """
+    if since["watcher"] != until["watcher"]:
+        return None
+    records = read_journal(instance_dir)
+    if len(records) == 0 or records[0].get("watcher") != since["watcher"] \
+            or since["seq"] < records[0]["seq"] - 1:
+        return None
+    return [record for record in records
+            if since["seq"] < record["seq"] <= until["seq"]
+            and record["kind"] not in ("start", "sync")]
+
+
+class WatchedDirectory(TypedDict):
+    """
+    what a directory watched by the journal watcher contains
+    """
+    kind: str
+    path: Path
+    mod: NotRequired[str]
+    date: NotRequired[str]
+
+
+class JournalWatcher:
+    """
+    Watches the mods directory, the directories of each mod and their dated version directories,
+    the settings and the priority list with inotify and appends the changes to the journal.
+    The contents of versions are not watched, because they rarely change after the import.
+    Commands changing them use record_contents_change instead.
+    """
+
+    def __init__(self, instance_dir: Path):
+        from ctypes import CDLL, get_errno
+        from ctypes.util import find_library
+        from os import strerror
+        self.instance_dir = instance_dir
+        self.meta_dir = get_meta_directory(instance_dir)
+        self.journal_path = get_journal_path(instance_dir)
+        self.libc = CDLL(find_library("c"), use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        self.watches: dict[int, WatchedDirectory] = dict()
+        self.watcher_id = uuid4().hex
+        self.next_seq = 0
+        self.stop_requested = Event()
+        self.thread: Thread | None = None
+
+    def add_watch(self, directory: WatchedDirectory) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(directory["path"]), WATCH_MASK)
+        # The directory may have been removed again in the meantime
+        if wd >= 0:
+            self.watches[wd] = directory
+
+    def remove_watches_below(self, path: Path) -> None:
+        for wd, directory in list(self.watches.items()):
+            if directory["path"].is_relative_to(path):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def watch_mod(self, mod_id: str) -> None:
+        mod_dir = self.instance_dir / 'mods' / mod_id
+        self.add_watch(WatchedDirectory(kind="mod", path=mod_dir, mod=mod_id))
+        try:
+            date_dirs = [entry for entry in mod_dir.iterdir() if entry.is_dir()]
+        except OSError:
+            return
+        for date_dir in date_dirs:
+            self.add_watch(WatchedDirectory(kind="date", path=date_dir, mod=mod_id,
+                                            date=date_dir.name))
+
+    def add_initial_watches(self) -> None:
+        mods_dir = self.instance_dir / 'mods'
+        self.add_watch(WatchedDirectory(kind="meta", path=self.meta_dir))
+        self.add_watch(WatchedDirectory(kind="settings", path=self.meta_dir / 'settings'))
+        self.add_watch(WatchedDirectory(kind="contents",
+                                        path=get_contents_marker_directory(self.instance_dir)))
+        self.add_watch(WatchedDirectory(kind="mods", path=mods_dir))
+        for mod_dir in mods_dir.iterdir():
+            if mod_dir.is_dir():
+                self.watch_mod(mod_dir.name)
+
+    def write_records(self, records: list[dict]) -> None:
+        lines = ""
+        for record in records:
+            record = {"seq": self.next_seq} | record
+            self.next_seq += 1
+            lines += dumps(record, separators=(",", ":")) + "\n"
+        with self.journal_path.open("at", encoding="UTF-8") as f:
+            f.write(lines)
+        if self.journal_path.stat().st_size > JOURNAL_ROTATE_BYTES:
+            self.start_journal()
+
+    def start_journal(self) -> None:
+        """
+        Starts the journal over with a start record. Readers notice the missing records by
+        its sequence number.
+        """
+        temporary_path = self.journal_path.with_suffix(".tmp")
+        temporary_path.write_text(dumps({"seq": self.next_seq, "kind": "start",
+                                         "watcher": self.watcher_id, "pid": getpid()},
+                                        separators=(",", ":")) + "\n", encoding="UTF-8")
+        self.next_seq += 1
+        temporary_path.replace(self.journal_path)
+
+    def translate_event(self, directory: WatchedDirectory, mask: int, name: str) -> dict | None:
+        """
+        Updates the watches for the event and describes the change for the journal.
+        """
+        from code.mod import VERSION_ARCHIVE_SUFFIX
+        is_dir = mask & IN_ISDIR != 0
+        # Files are only complete once they are closed after writing
+        appeared = mask & (IN_MOVED_TO | (IN_CREATE if is_dir else IN_CLOSE_WRITE)) != 0
+        disappeared = mask & (IN_DELETE | IN_MOVED_FROM) != 0
+        if directory["kind"] == "meta":
+            if name.startswith(SYNC_MARKER_PREFIX) and mask & IN_CREATE:
+                return {"kind": "sync", "token": name}
+            if name == "priority.txt" and (appeared or disappeared):
+                return {"kind": "priority"}
+            if name == "settings" and is_dir and appeared:
+                self.add_watch(WatchedDirectory(kind="settings", path=self.meta_dir / name))
+                return {"kind": "setting"}
+            if name == CONTENTS_DIR_NAME and is_dir and appeared:
+                self.add_watch(WatchedDirectory(kind="contents", path=self.meta_dir / name))
+                # Markers written before the watch was added would be missed otherwise
+                return {"kind": "contents"}
+            return None
+        if name.startswith(".") or not (appeared or disappeared):
+            return None
+        if directory["kind"] == "settings":
+            return {"kind": "setting", "setting": name}
+        if directory["kind"] == "contents":
+            return {"kind": "contents", "mod": name}
+        if directory["kind"] == "mods":
+            if not is_dir:
+                return {"kind": "config", "mod": name.removesuffix(".json")} \
+                    if name.endswith(".json") else None
+            if appeared:
+                self.watch_mod(name)
+            elif mask & IN_MOVED_FROM:
+                self.remove_watches_below(directory["path"] / name)
+            return {"kind": "mod", "mod": name} if appeared or disappeared else None
+        if directory["kind"] == "mod":
+            if not is_dir:
+                return None
+            if appeared:
+                self.add_watch(WatchedDirectory(kind="date", path=directory["path"] / name,
+                                                mod=directory["mod"], date=name))
+            elif mask & IN_MOVED_FROM:
+                self.remove_watches_below(directory["path"] / name)
+            return {"kind": "version", "mod": directory["mod"], "version": name} \
+                if appeared or disappeared else None
+        if directory["kind"] == "date" and (appeared or disappeared):
+            return {"kind": "version", "mod": directory["mod"],
+                    "version": f"{directory['date']}/{name.removesuffix(VERSION_ARCHIVE_SUFFIX)}"}
+        return None
+
+    def process_events(self, buffer: bytes) -> list[dict]:
+        records: list[dict] = []
+        offset = 0
+        header_size = calcsize(EVENT_HEADER)
+        while offset + header_size <= len(buffer):
+            wd, mask, _, name_length = unpack_from(EVENT_HEADER, buffer, offset)
+            name = buffer[offset + header_size:offset + header_size + name_length] \
+                .split(b"\0", 1)[0].decode("UTF-8", errors="surrogateescape")
+            offset += header_size + name_length
+            if mask & IN_Q_OVERFLOW:
+                records.append({"kind": "rescan"})
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                if directory["kind"] in ("meta", "settings", "contents", "mods"):
+                    records.append({"kind": "rescan"})
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            record = self.translate_event(directory, mask, name)
+            if record is not None and record not in records:
+                records.append(record)
+        return records
+
+    def watch(self) -> None:
+        from select import poll, POLLIN
+        poller = poll()
+        poller.register(self.fd, POLLIN)
+        while not self.stop_requested.is_set():
+            if len(poller.poll(250)) == 0:
+                continue
+            try:
+                buffer = read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            records = self.process_events(buffer)
+            if len(records) > 0:
+                self.write_records(records)
+
+    def start(self) -> None:
+        self.add_initial_watches()
+        self.start_journal()
+        self.thread = Thread(target=self.watch, name="journal-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Removes the journal, because nothing records the changes after this
+        """
+        self.stop_requested.set()
+        if self.thread is not None:
+            self.thread.join()
+        close(self.fd)
+        self.journal_path.unlink(missing_ok=True)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from json import load, dump, JSONDecodeError
+from os import lstat, readlink, symlink
+from pathlib import Path
+from shutil import copy2, move
+from typing import Iterable, TypedDict
+
+from code.deployer import list_layer_entries, resolve_winning_files, get_layer_signature
+from code.mod import resolve_base_dir
+from code.paths import get_meta_directory, clone_file
+from code.reaper import remove_tree
+
+MANIFEST_FORMAT_VERSION = 1
+
+
+class MaterializeStats(TypedDict):
+    """
+    summary of the changes made to the deployment directory by one deployment
+    """
+    placed: int
+    removed: int
+    unchanged: int
+    backed_up: int
+    restored: int
+    preserved: int
+
+
+def get_deployment_state_directory(base_dir: Path | None = None) -> Path:
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'deployment'
+
+
+def get_manifest_path(base_dir: Path | None = None) -> Path:
+    return get_deployment_state_directory(base_dir) / 'manifest.json'
+
+
+def get_backup_directory(base_dir: Path | None = None) -> Path:
+    """
+    :return: The directory holding the files of the deployment directory that were replaced by
+             mod files. They are put back once no mod provides them anymore.
+    """
+    return get_deployment_state_directory(base_dir) / 'backup'
+
+
+def empty_manifest(target_dir: Path) -> dict:
+    return {
+        "format": MANIFEST_FORMAT_VERSION,
+        "target": str(target_dir),
+        # layer path -> [files, directories, signature] of that layer
+        "layers": dict(),
+        # relative path -> [layer path, inode, size, mtime in ns] of the placed file
+        "files": dict(),
+        "created_dirs": [],
+        "backups": [],
+    }
+
+
+def read_manifest(base_dir: Path | None = None) -> dict | None:
+    try:
+        with get_manifest_path(base_dir).open("rt") as f:
+            manifest = load(f)
+    except (FileNotFoundError, JSONDecodeError):
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(manifest: dict, base_dir: Path | None = None) -> None:
+    manifest_path = get_manifest_path(base_dir)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = manifest_path.with_suffix(".tmp")
+    with temporary_path.open("wt") as f:
+        dump(manifest, f)
+    temporary_path.replace(manifest_path)
+
+
+def read_layer_entries(layer: Path,
+                       known_entries: list | None) -> tuple[list[str], list[str], str | None]:
+    """
+    :param known_entries: the entries of the layer recorded in the manifest, if any
+    :return: the files, directories and signature of the layer
+    """
+    if known_entries is not None and len(known_entries) == 3:
+        files, dirs, signature = known_entries
+        if signature is not None and get_layer_signature(layer, dirs) == signature:
+            return files, dirs, signature
+    files, dirs = list_layer_entries(layer)
+    return files, dirs, get_layer_signature(layer, dirs)
+
+
+def preserve_modified_file(target_dir: Path, relative_path: str, overflow_dir: Path) -> None:
+    """
+    Moves a placed file that a program has changed into the overflow directory, where the
+    overlay backend would have kept the change as well. It must not end up in the backup of
+    game files, because undeploy would then restore it as one.
+    """
+    destination = overflow_dir / relative_path
+    if destination.is_dir() and not destination.is_symlink():
+        remove_tree(destination)
+    destination.unlink(missing_ok=True)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    move(target_dir / relative_path, destination)
+
+
+def get_placement_record(layer: str, placed_file: Path) -> list:
+    file_stat = lstat(placed_file)
+    return [layer, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def is_placed_file_unchanged(record: list, placed_file: Path) -> bool:
+    try:
+        return get_placement_record(record[0], placed_file) == record
+    except FileNotFoundError:
+        return False
+
+
+def place_file(source: Path, destination: Path) -> None:
+    """
+    Puts a mod file into the deployment directory as a reflink, or as a copy where the
+    filesystem does not support them. Hardlinks are never used, because programs writing to a
+    deployed file in place would change the mod version and, through the deduplication store,
+    every identical file of other versions.
+    """
+    if source.is_symlink():
+        symlink(readlink(source), destination)
+        return
+    if not clone_file(source, destination):
+        copy2(source, destination)
+
+
+def move_into_backup(target_dir: Path, relative_path: str, manifest: dict) -> None:
+    backup_path = get_backup_directory() / relative_path
+    remove_tree(backup_path)
+    backup_path.parent.mkdir(parents=True, exist_ok=True)
+    move(target_dir / relative_path, backup_path)
+    manifest["backups"].append(relative_path)
+
+
+def prepare_parent_directories(target_dir: Path, relative_path: str, manifest: dict,
+                               stats: MaterializeStats) -> None:
+    """
+    Creates the missing parent directories of a file and records them, so they can be removed
+    again. Files of the game that stand in the way are moved into the backup.
+    """
+    current = ""
+    for component in relative_path.split("/")[:-1]:
+        current = f"{current}/{component}" if current else component
+        current_path = target_dir / current
+        if current_path.is_dir() and not current_path.is_symlink():
+            continue
+        if current_path.exists() or current_path.is_symlink():
+            move_into_backup(target_dir, current, manifest)
+            stats["backed_up"] += 1
+        current_path.mkdir()
+        manifest["created_dirs"].append(current)
+
+
+def get_parent_directories(relative_paths: Iterable[str]) -> set[str]:
+    parents: set[str] = set()
+    for relative_path in relative_paths:
+        parent, _, _ = relative_path.rpartition("/")
+        while len(parent) > 0 and parent not in parents:
+            parents.add(parent)
+            parent, _, _ = parent.rpartition("/")
+    return parents
+
+
+def is_hidden_by(relative_path: str, winners: dict[str, Path]) -> bool:
+    """
+    :return: whether a mod file in the new deployment takes the place of relative_path or of
+             one of its parent directories
+    """
+    if relative_path in winners:
+        return True
+    parent, _, _ = relative_path.rpartition("/")
+    while len(parent) > 0:
+        if parent in winners:
+            return True
+        parent, _, _ = parent.rpartition("/")
+    return False
+
+
+def is_real_directory(path: Path) -> bool:
+    return path.is_dir() and not path.is_symlink()
+
+
+def merge_backup_directory(backup_dir: Path, destination: Path, relative_dir: str) -> list[str]:
+    """
+    Moves the contents of a backed up directory into a directory of the same name, that has been
+    created for mod files in the meantime.
+
+    :return: the relative paths of entries that stay in the backup, because their place is taken
+    """
+    remaining: list[str] = []
+    for child in backup_dir.iterdir():
+        child_destination = destination / child.name
+        relative_path = f"{relative_dir}/{child.name}"
+        if is_real_directory(child) and is_real_directory(child_destination):
+            remaining += merge_backup_directory(child, child_destination, relative_path)
+        elif child_destination.exists() or child_destination.is_symlink():
+            remaining.append(relative_path)
+        else:
+            move(child, child_destination)
+    if len(remaining) == 0:
+        backup_dir.rmdir()
+    return remaining
+
+
+def materialize_deployment(target_dir: Path,
+                           layers: list[Path],
+                           overflow_dir: Path) -> MaterializeStats:
+    """
+    Builds the merged view of all layers directly in the deployment directory from reflinks to
+    the mod files. Everything placed is recorded in a manifest, so a later deployment only needs to
+    apply the difference between the old and the new set of mod versions. The contents of known
+    layers are taken from the manifest instead of scanning them again, as long as none of their
+    directories has changed.
+
+    Placed files changed by programs are moved into the overflow directory, once they are
+    replaced or removed.
+
+    :param layers: the directories to deploy in order of increasing priority
+    """
+    old_manifest = read_manifest()
+    if old_manifest is not None \
+            and Path(old_manifest["target"]).resolve() != target_dir.resolve():
+        # The deployment directory was changed, so clean up the old one first
+        materialize_deployment(Path(old_manifest["target"]), [], overflow_dir)
+        old_manifest = read_manifest()
+        if old_manifest is not None and len(old_manifest["backups"]) > 0:
+            raise ValueError(f"Some files could not be restored in {old_manifest['target']}. "
+                             f"They remain in {get_backup_directory()}")
+        old_manifest = None
+    if old_manifest is None:
+        old_manifest = empty_manifest(target_dir)
+
+    layer_entries: list[tuple[Path, list[str], list[str]]] = []
+    layer_signatures: dict[str, str | None] = dict()
+    for layer in layers:
+        files, dirs, signature = read_layer_entries(layer, old_manifest["layers"].get(str(layer)))
+        layer_entries.append((layer, files, dirs))
+        layer_signatures[str(layer)] = signature
+    winners = resolve_winning_files(layer_entries)
+    winner_dirs = get_parent_directories(winners.keys())
+
+    manifest = empty_manifest(target_dir)
+    manifest["layers"] = {str(layer): [files, dirs, layer_signatures[str(layer)]]
+                          for layer, files, dirs in layer_entries}
+    manifest["created_dirs"] = list(old_manifest["created_dirs"])
+    manifest["backups"] = list(old_manifest["backups"])
+    stats = MaterializeStats(placed=0, removed=0, unchanged=0, backed_up=0, restored=0,
+                             preserved=0)
+    try:
+        # Remove files that are no longer provided by the same layer
+        for relative_path, record in old_manifest["files"].items():
+            placed_file = target_dir / relative_path
+            new_layer = winners.get(relative_path)
+            if new_layer is not None and str(new_layer) == record[0]:
+                if is_placed_file_unchanged(record, placed_file):
+                    manifest["files"][relative_path] = record
+                    stats["unchanged"] += 1
+                    continue
+            if is_placed_file_unchanged(record, placed_file):
+                placed_file.unlink()
+                stats["removed"] += 1
+            elif placed_file.exists() or placed_file.is_symlink():
+                preserve_modified_file(target_dir, relative_path, overflow_dir)
+                stats["preserved"] += 1
+
+        # Remove directories that were created for files that no longer exist
+        for relative_dir in sorted(manifest["created_dirs"], key=len, reverse=True):
+            directory = target_dir / relative_dir
+            if relative_dir in winner_dirs or not directory.is_dir():
+                continue
+            if not any(directory.iterdir()):
+                directory.rmdir()
+                manifest["created_dirs"].remove(relative_dir)
+
+        # Put back files of the game that are not covered by a mod anymore
+        for relative_path in sorted(manifest["backups"]):
+            backup_path = get_backup_directory() / relative_path
+            if is_hidden_by(relative_path, winners):
+                continue
+            if relative_path in winner_dirs and not is_real_directory(backup_path):
+                continue
+            destination = target_dir / relative_path
+            if is_real_directory(backup_path) and is_real_directory(destination):
+                # Directories are merged, the same way overlayfs merges them
+                manifest["backups"].remove(relative_path)
+                manifest["backups"] += merge_backup_directory(backup_path, destination,
+                                                              relative_path)
+                stats["restored"] += 1
+                continue
+            if destination.exists() or destination.is_symlink():
+                continue
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            move(backup_path, destination)
+            manifest["backups"].remove(relative_path)
+            stats["restored"] += 1
+
+        # Place the new files
+        for relative_path, layer in winners.items():
+            if relative_path in manifest["files"]:
+                continue
+            destination = target_dir / relative_path
+            prepare_parent_directories(target_dir, relative_path, manifest, stats)
+            if destination.exists() or destination.is_symlink():
+                move_into_backup(target_dir, relative_path, manifest)
+                stats["backed_up"] += 1
+            place_file(layer / relative_path, destination)
+            manifest["files"][relative_path] = get_placement_record(str(layer), destination)
+            stats["placed"] += 1
+    finally:
+        # Even an interrupted deployment must remember which files it has placed
+        write_manifest(manifest)
+    return stats
+
+
+def remove_materialized_deployment(overflow_dir: Path) -> MaterializeStats | None:
+    """
+    Removes all placed mod files and restores the files of the game.
+
+    :return: None, if nothing is deployed
+    """
+    manifest = read_manifest()
+    if manifest is None:
+        return None
+    stats = materialize_deployment(Path(manifest["target"]), [], overflow_dir)
+    remaining_manifest = read_manifest()
+    # Keep the manifest, if game files could not be put back, so they are not forgotten
+    if remaining_manifest is None or len(remaining_manifest["backups"]) == 0:
+        get_manifest_path().unlink(missing_ok=True)
+    return stats
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from collections import Counter
+from datetime import datetime
+from json import dumps, loads, JSONDecodeError
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import TypedDict
+
+from code.settings import get_instance_settings, ValidInstanceSettings
+from code.timings import get_log_directory
+
+HISTORY_ROTATE_BYTES = 1024 * 1024
+HISTORY_KEPT_ROTATIONS = 3
+COUNTER_NAMES = ["files_scanned", "bytes_read", "bytes_hashed", "bytes_copied"]
+
+counters: Counter[str] = Counter()
+counters_lock = Lock()
+invocation: dict | None = None
+
+
+class HistoryRecord(TypedDict):
+    """
+    summary of one modfs invocation in the performance history
+    """
+    time: str
+    subcommand: str
+    duration_secs: float
+    exit_code: int
+    peak_rss_bytes: int
+    files_scanned: int
+    bytes_read: int
+    bytes_hashed: int
+    bytes_copied: int
+
+
+def count(name: str, amount: int = 1) -> None:
+    """
+    Adds to one of the counters in COUNTER_NAMES. Safe to call from several threads.
+    """
+    with counters_lock:
+        counters[name] += amount
+
+
+def get_history_path(base_dir: Path | None = None) -> Path:
+    return get_log_directory(base_dir) / 'history.jsonl'
+
+
+def get_peak_rss_bytes() -> int:
+    from resource import getrusage, RUSAGE_SELF
+    # Linux reports the maximum resident set size in KiB
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def begin_invocation(subcommand: str) -> None:
+    global invocation
+    invocation = {"subcommand": subcommand, "start": monotonic()}
+    # The modfs daemon handles many invocations in one process
+    with counters_lock:
+        counters.clear()
+
+
+def discard_invocation() -> None:
+    """
+    Must be called in forked child processes, so that only the parent records the invocation.
+    """
+    global invocation
+    invocation = None
+
+
+def rotate_history(history_path: Path) -> None:
+    """
+    Keeps the history log below HISTORY_ROTATE_BYTES by moving it to history.jsonl.1, which in
+    turn moves to history.jsonl.2 and so on. The oldest rotation is dropped.
+    """
+    for index in range(HISTORY_KEPT_ROTATIONS - 1, 0, -1):
+        rotated = history_path.with_name(f"{history_path.name}.{index}")
+        if rotated.exists():
+            rotated.replace(history_path.with_name(f"{history_path.name}.{index + 1}"))
+    history_path.replace(history_path.with_name(f"{history_path.name}.1"))
+
+
+def finish_invocation(exit_code: int) -> None:
+    """
+    Appends the record of the current invocation to the history, if the recordHistory setting
+    is enabled. Later calls do nothing.
+    """
+    global invocation
+    if invocation is None:
+        return
+    subcommand = invocation["subcommand"]
+    duration = monotonic() - invocation["start"]
+    invocation = None
+    if not get_instance_settings().get(ValidInstanceSettings.RECORD_HISTORY):
+        return
+    record = HistoryRecord(time=datetime.now().astimezone().isoformat(timespec="seconds"),
+                           subcommand=subcommand,
+                           duration_secs=round(duration, 6),
+                           exit_code=exit_code,
+                           peak_rss_bytes=get_peak_rss_bytes(),
+                           files_scanned=counters["files_scanned"],
+                           bytes_read=counters["bytes_read"],
+                           bytes_hashed=counters["bytes_hashed"],
+                           bytes_copied=counters["bytes_copied"])
+    history_path = get_history_path()
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    if history_path.exists() and history_path.stat().st_size >= HISTORY_ROTATE_BYTES:
+        rotate_history(history_path)
+    with history_path.open("at", encoding="UTF-8") as history_file:
+        history_file.write(dumps(record, separators=(",", ":")) + "\n")
+
+
+def read_history(base_dir: Path | None = None) -> list[HistoryRecord]:
+    """
+    :return: all records of the history including its rotations, oldest first
+    """
+    history_path = get_history_path(base_dir)
+    paths = [history_path.with_name(f"{history_path.name}.{index}")
+             for index in range(HISTORY_KEPT_ROTATIONS, 0, -1)] + [history_path]
+    records: list[HistoryRecord] = []
+    for path in paths:
+        try:
+            with path.open("rt", encoding="UTF-8") as history_file:
+                for line in history_file:
+                    try:
+                        records.append(loads(line))
+                    except JSONDecodeError:
+                        # The last line can be incomplete after a crash
+                        continue
+        except FileNotFoundError:
+            continue
+    return records
+
+
+def summarize_history(records: list[HistoryRecord]) -> dict[str, dict[str, float | int]]:
+    """
+    :return: per subcommand the number of invocations, the sum, mean, median and maximum of
+             their durations, the sum of every counter and the highest peak RSS
+    """
+    from statistics import mean, median
+    durations: dict[str, list[float]] = dict()
+    summary: dict[str, dict[str, float | int]] = dict()
+    for record in records:
+        subcommand = record["subcommand"]
+        durations.setdefault(subcommand, []).append(record["duration_secs"])
+        entry = summary.setdefault(subcommand, {name: 0 for name in COUNTER_NAMES}
+                                   | {"peak_rss_bytes": 0, "failures": 0})
+        for name in COUNTER_NAMES:
+            entry[name] += record.get(name, 0)
+        entry["peak_rss_bytes"] = max(entry["peak_rss_bytes"], record.get("peak_rss_bytes", 0))
+        if record.get("exit_code", 0) != 0:
+            entry["failures"] += 1
+    for subcommand, subcommand_durations in durations.items():
+        summary[subcommand] |= {
+            "invocations": len(subcommand_durations),
+            "duration_secs_sum": sum(subcommand_durations),
+            "duration_secs_mean": mean(subcommand_durations),
+            "duration_secs_median": median(subcommand_durations),
+            "duration_secs_max": max(subcommand_durations),
+        }
+    return summary
+
+
+def format_prometheus(summary: dict[str, dict[str, float | int]]) -> str:
+    """
+    :return: the summary in the Prometheus text exposition format
+    """
+    metrics = [
+        ("modfs_invocations_total", "counter", "Number of recorded modfs invocations",
+         "invocations"),
+        ("modfs_failed_invocations_total", "counter",
+         "Number of recorded modfs invocations with a non-zero exit code", "failures"),
+        ("modfs_duration_seconds_sum", "counter", "Total runtime of modfs invocations",
+         "duration_secs_sum"),
+        ("modfs_duration_seconds_max", "gauge", "Longest runtime of a modfs invocation",
+         "duration_secs_max"),
+        ("modfs_peak_rss_bytes", "gauge", "Highest peak resident set size of an invocation",
+         "peak_rss_bytes"),
+    ] + [(f"modfs_{name}_total", "counter", f"Sum of {name.replace('_', ' ')}", name)
+         for name in COUNTER_NAMES]
+    lines: list[str] = []
+    for metric_name, metric_type, description, key in metrics:
+        lines.append(f"# HELP {metric_name} {description}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for subcommand, entry in sorted(summary.items()):
+            lines.append(f'{metric_name}{{subcommand="{subcommand}"}} {entry[key]}')
+    return "\n".join(lines) + "\n"
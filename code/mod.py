@@ -13,10 +13,15 @@ from typing import Iterable, TypeVar, Callable, Type, Any
 from urllib.parse import urlparse
 
 from code.paths import get_meta_directory
+from code.progress import ProgressReporter
+from code.statecache import cached_state, invalidate_state_cache
 from code.tools import current_date
 
 base_directory: Path | None = None
 
+# Inactive versions can be packed into a compressed archive stored next to their directory
+VERSION_ARCHIVE_SUFFIX = ".tar.xz"
+
 
 def resolve_base_dir(base_dir: Path | None = None) -> Path:
     if base_dir is not None:
@@ -32,6 +37,7 @@ def set_mod_base_path(base_dir: Path) -> None:
     base_directory = base_dir
 
 
+@cached_state
 def get_mod_ids(base_dir: Path | None = None) -> list[str]:
     real_base_dir: Path = resolve_base_dir(base_dir)
 
@@ -40,6 +46,7 @@ def get_mod_ids(base_dir: Path | None = None) -> list[str]:
     return mod_ids
 
 
+@cached_state
 def get_mod_versions(mod_id: str, base_dir: Path | None = None) -> dict[str, set[str]]:
     real_base_dir = resolve_base_dir(base_dir)
     if not mod_exists(mod_id, real_base_dir):
@@ -50,9 +57,13 @@ def get_mod_versions(mod_id: str, base_dir: Path | None = None) -> dict[str, set
     for dated_dir in sorted(dated_dirs):
         date = dated_dir.parts[-1]
         dated_set: set[str] = results.get(date, set())
-        subversion_dirs = sorted(list(filter(lambda p: p.is_dir(), dated_dir.iterdir())), key=(lambda s: s.name.lower()))
+        # Hidden entries are temporary directories, e.g. of a version restore in progress
+        subversion_dirs = sorted(list(filter(lambda p: p.is_dir() and not p.name.startswith('.'),
+                                             dated_dir.iterdir())), key=(lambda s: s.name.lower()))
         for subversion in subversion_dirs:
             dated_set.add(subversion.parts[-1])
+        for archived_subversion in dated_dir.glob(f"*{VERSION_ARCHIVE_SUFFIX}"):
+            dated_set.add(archived_subversion.name.removesuffix(VERSION_ARCHIVE_SUFFIX))
         results[date] = dated_set
     return results
 
@@ -88,7 +99,8 @@ def version_exists(mod_id: str,
     base_dir = resolve_base_dir(base_dir)
     subversion = subversion if isinstance(subversion, str) else str(subversion).zfill(2)
     version_dir = base_dir / 'mods' / mod_id / date_version / subversion
-    return version_dir.is_dir()
+    version_archive = version_dir.with_name(subversion + VERSION_ARCHIVE_SUFFIX)
+    return version_dir.is_dir() or version_archive.is_file()
 
 
 def parse_version_tag(version_tag: str) -> tuple[str, str]:
@@ -116,7 +128,7 @@ def select_latest_version(mod_id: str,
     if not mod_exists(mod_id, real_base_dir):
         raise ValueError("Mod {mod_id} does not exist")
     versions = get_mod_versions(mod_id, real_base_dir)
-    list_of_dates = list(filter(lambda d: has_subversion(mod_id, d), sorted(versions.keys())))
+    list_of_dates = [d for d in sorted(versions.keys()) if len(versions[d]) > 0]
     if len(list_of_dates) == 0:
         return None
     date = list_of_dates[-1]
@@ -145,7 +157,9 @@ def cast_validate_mod_id(mod_id: str) -> str:
 
 
 def get_mod_mount_path(mod_id: str, version_date: str, version_sub: str) -> Path:
-    return base_directory / 'mods' / mod_id / version_date / version_sub
+    version_path = base_directory / 'mods' / mod_id / version_date / version_sub
+    # Versions adopted from a shared mod store are symbolic links into that store
+    return version_path.resolve() if version_path.is_symlink() else version_path
 
 
 def mod_at_version_limit(mod_id: str, version_date: str, base_dir: Path | None = None) -> bool:
@@ -171,6 +185,7 @@ def create_mod_priority_list(base_dir: Path | None = None) -> None:
         pass
 
 
+@cached_state
 def read_mod_priority(base_dir: Path | None = None) -> OrderedDict[str, None]:
     resolved_base_dir = resolve_base_dir(base_dir)
     prio_file = get_meta_directory(resolved_base_dir) / 'priority.txt'
@@ -196,6 +211,7 @@ def write_mod_priority(mod_order: OrderedDict[str, None], base_dir: Path | None
     with open(prio_file, mode='wt') as f:
         for mod_id in mod_order.keys():
             f.write(mod_id + '\n')
+    invalidate_state_cache()
 
 
 def build_mod_order(order_template: Iterable[str]) -> OrderedDict[str, None]:
@@ -217,7 +233,8 @@ def identical_files(path1: Path | None, path2: Path) -> Path | None:
         return None
 
 
-def remove_harmless_conflicts(mapping: dict[frozenset[str], set[Path]]) \
+def remove_harmless_conflicts(mapping: dict[frozenset[str], set[Path]],
+                              progress: ProgressReporter | None = None) \
         -> dict[frozenset[str], set[Path]]:
     for mods, file_patterns in mapping.items():
         mod_dirs: set[Path] = set()
@@ -226,6 +243,9 @@ def remove_harmless_conflicts(mapping: dict[frozenset[str], set[Path]]) \
             mod_dirs.add(resolve_base_dir() / 'mods' / mod / date / subversion)
 
         def pattern_filter(pattern: Path) -> bool:
+            if progress is not None:
+                progress.advance(1, sum(mod_dir.joinpath(pattern).stat().st_size
+                                        for mod_dir in mod_dirs))
             return reduce(identical_files, {mod_dir / pattern for mod_dir in mod_dirs}) is not None
 
         for former_pattern in set(filter(pattern_filter, file_patterns)):
@@ -234,7 +254,8 @@ def remove_harmless_conflicts(mapping: dict[frozenset[str], set[Path]]) \
     return dict(filter(lambda t: len(t[1]) > 0, mapping.items()))
 
 
-def parse_mod_conflicts() -> dict[frozenset[str], set[Path]]:
+@cached_state
+def parse_mod_conflicts(show_progress: bool = False) -> dict[frozenset[str], set[Path]]:
     mod_dirs: set[Path] = set()
     for mod_id in get_mod_ids():
         if not is_mod_active(mod_id):
@@ -245,9 +266,12 @@ def parse_mod_conflicts() -> dict[frozenset[str], set[Path]]:
         date, sub = version_tuple
         mod_dirs.add(get_mod_mount_path(mod_id, date, sub))
     file_mapping: dict[Path, set[str]] = dict()
+    scan_progress = ProgressReporter("Scanning mod files") if show_progress else None
     for mod_dir in mod_dirs:
         for found_path in mod_dir.rglob("*"):
             if found_path.is_file():
+                if scan_progress is not None:
+                    scan_progress.advance()
                 found_path = found_path.relative_to(mod_dir)
                 if found_path in file_mapping.keys():
                     file_mapping[found_path].add(mod_dir.parts[-3])
@@ -262,7 +286,13 @@ def parse_mod_conflicts() -> dict[frozenset[str], set[Path]]:
             mod_mapping[frozen_mod_set].add(path)
         else:
             mod_mapping[frozen_mod_set] = {path}
-    return remove_harmless_conflicts(mod_mapping)
+    if scan_progress is None:
+        return remove_harmless_conflicts(mod_mapping)
+    scan_progress.finish()
+    with ProgressReporter("Comparing conflicting files",
+                          total_files=sum(len(paths) for paths in mod_mapping.values())) \
+            as compare_progress:
+        return remove_harmless_conflicts(mod_mapping, compare_progress)
 
 
 def process_mod_subdir_argument(raw_subdir: str,
@@ -337,6 +367,19 @@ def meets_requirements(value: ReqVal, conditions: Iterable[Callable[[ReqVal], bo
         return False
 
 
+@cached_state
+def load_mod_config(conf_file: Path) -> dict[str, Any] | None:
+    """
+    :return: the values stored in the configuration file of a mod or None, if it does not exist
+    """
+    try:
+        with conf_file.open("rt") as f:
+            from json import load
+            return load(f)
+    except FileNotFoundError:
+        return None
+
+
 class ModConfig:
     def __init__(self, mod_id: str, base_dir: Path | None = None):
         self.base_dir: Path = resolve_base_dir(base_dir)
@@ -348,34 +391,25 @@ class ModConfig:
         return self.base_dir / 'mods' / f"{self.mod_id}.json"
 
     def get_all(self, insert_defaults: bool = True) -> dict[str, Any]:
-        try:
-            with self.conf_file().open("rt") as f:
-                from json import load
-                values: dict[str, Any] = load(f)
-                if insert_defaults:
-                    return default_mod_settings() | values
-                else:
-                    return values
-        except FileNotFoundError:
+        values = load_mod_config(self.conf_file())
+        if values is None:
             return default_mod_settings() if insert_defaults else {}
+        return default_mod_settings() | values if insert_defaults else values
 
     def get(self, setting: ValidModSettings) -> Any:
-        try:
-            with self.conf_file().open("rt") as f:
-                from json import load
-                values: dict[str, Any] = load(f)
-                value = values[setting.key] if setting.key in values.keys() else setting.default
-                if meets_requirements(value, setting.requirements):
-                    return value
-                else:
-                    raise ValueError(f"Value {setting.default} for setting {setting.key} of mod "
-                                     f"{self.mod_id} is invalid")
-        except FileNotFoundError:
+        values = load_mod_config(self.conf_file())
+        if values is None:
             if meets_requirements(setting.default, setting.requirements):
                 return setting.default
             else:
                 raise ValueError(f"Value {setting.default} for setting {setting.key} of mod "
                                  f"{self.mod_id} is invalid")
+        value = values[setting.key] if setting.key in values.keys() else setting.default
+        if meets_requirements(value, setting.requirements):
+            return value
+        else:
+            raise ValueError(f"Value {setting.default} for setting {setting.key} of mod "
+                             f"{self.mod_id} is invalid")
 
     def set(self, setting: ValidModSettings, value: Any) -> None:
         if not meets_requirements(value, setting.requirements):
@@ -388,6 +422,7 @@ class ModConfig:
             dump(prev_settings | {setting.key: value}, f, indent=2, sort_keys=True)
             from os import linesep
             f.write(linesep)
+        invalidate_state_cache()
 
 
 def mod_change_activation(mod_id: str, enable_status: bool, base_dir: Path | None = None) -> None:
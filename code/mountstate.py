@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from pathlib import Path
+from re import sub
+from typing import TypedDict
+
+OVERLAY_FILESYSTEM_TYPES = {"overlay", "fuse.fuse-overlayfs"}
+
+
+class MountEntry(TypedDict):
+    """
+    one line of /proc/<pid>/mountinfo, see proc_pid_mountinfo(5)
+    """
+    mount_id: int
+    parent_id: int
+    mount_point: str
+    filesystem_type: str
+    source: str
+    super_options: list[str]
+
+
+class MountinfoCacheEntry(TypedDict):
+    namespace: int
+    fd: int
+    mounts: list[MountEntry]
+
+
+# Open mountinfo files by pid. The kernel signals POLLPRI on them whenever the mount table of the
+# namespace changes, so they only need to be read again after such a change.
+mountinfo_cache: dict[int | str, MountinfoCacheEntry] = dict()
+
+
+def unescape_mountinfo_field(field: str) -> str:
+    """
+    The kernel writes space, tab, newline, backslash and, in mount options, the comma as
+    three-digit octal escapes
+    """
+    return sub(r"\\([0-7]{3})", lambda octal: chr(int(octal[1], 8)), field)
+
+
+def parse_mountinfo(text: str) -> list[MountEntry]:
+    mounts: list[MountEntry] = []
+    for line in text.splitlines():
+        fields = line.split(" ")
+        if "-" not in fields:
+            continue
+        separator = fields.index("-", 6)
+        if len(fields) < separator + 4:
+            continue
+        mounts.append(MountEntry(
+            mount_id=int(fields[0]),
+            parent_id=int(fields[1]),
+            mount_point=unescape_mountinfo_field(fields[4]),
+            filesystem_type=unescape_mountinfo_field(fields[separator + 1]),
+            source=unescape_mountinfo_field(fields[separator + 2]),
+            super_options=[unescape_mountinfo_field(option)
+                           for option in fields[separator + 3].split(",")]))
+    return mounts
+
+
+def read_fd_from_start(fd: int) -> str:
+    from os import lseek, read, SEEK_SET
+    lseek(fd, 0, SEEK_SET)
+    chunks: list[bytes] = []
+    while True:
+        chunk = read(fd, 65536)
+        if len(chunk) == 0:
+            return b"".join(chunks).decode("UTF-8", errors="surrogateescape")
+        chunks.append(chunk)
+
+
+def forget_mountinfo(pid: int | str) -> None:
+    from os import close
+    cached = mountinfo_cache.pop(pid, None)
+    if cached is not None:
+        close(cached["fd"])
+
+
+def read_mountinfo(pid: int | str = "self") -> list[MountEntry] | None:
+    """
+    :return: the mounts of the mount namespace the process is in or None, if it is not
+             accessible, e.g. because the process has exited
+    """
+    from os import open as os_open, stat, O_RDONLY, O_CLOEXEC
+    from select import poll, POLLPRI, POLLERR
+    try:
+        namespace = stat(f"/proc/{pid}/ns/mnt").st_ino
+    except OSError:
+        forget_mountinfo(pid)
+        return None
+    cached = mountinfo_cache.get(pid)
+    if cached is not None and cached["namespace"] == namespace:
+        poller = poll()
+        poller.register(cached["fd"], POLLPRI | POLLERR)
+        if len(poller.poll(0)) == 0:
+            return cached["mounts"]
+        try:
+            cached["mounts"] = parse_mountinfo(read_fd_from_start(cached["fd"]))
+        except OSError:
+            forget_mountinfo(pid)
+            return None
+        return cached["mounts"]
+    # Either nothing is cached or the pid now belongs to a process in another namespace
+    forget_mountinfo(pid)
+    try:
+        fd = os_open(f"/proc/{pid}/mountinfo", O_RDONLY | O_CLOEXEC)
+    except OSError:
+        return None
+    try:
+        mounts = parse_mountinfo(read_fd_from_start(fd))
+    except OSError:
+        from os import close
+        close(fd)
+        return None
+    mountinfo_cache[pid] = MountinfoCacheEntry(namespace=namespace, fd=fd, mounts=mounts)
+    return mounts
+
+
+def find_mount(mount_point: Path, pid: int | str = "self") -> MountEntry | None:
+    """
+    :return: the topmost mount at exactly this path in the namespace of the process. The path
+             is resolved first, because mountinfo lists the canonical paths of mount points.
+    """
+    mounts = read_mountinfo(pid)
+    if mounts is None:
+        return None
+    path = str(mount_point.resolve())
+    matches = [mount for mount in mounts if mount["mount_point"] == path]
+    return matches[-1] if len(matches) > 0 else None
+
+
+def find_overlay_mount(mount_point: Path, pid: int | str = "self") -> MountEntry | None:
+    mount = find_mount(mount_point, pid)
+    return mount if mount is not None and mount["filesystem_type"] in OVERLAY_FILESYSTEM_TYPES \
+        else None
+
+
+def split_lowerdir_option(value: str) -> list[str]:
+    """
+    Layers in the lowerdir option are separated by colons. Colons within a path are escaped
+    with a backslash.
+    """
+    layers: list[str] = []
+    current = ""
+    escaped = False
+    for character in value:
+        if escaped:
+            current += character
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == ":":
+            layers.append(current)
+            current = ""
+        else:
+            current += character
+    layers.append(current)
+    return layers
+
+
+def get_overlay_layers(mount: MountEntry) -> list[Path]:
+    """
+    :return: the lower layers of an overlay mount in order of decreasing priority, followed by
+             the upper directory, if the mount is writable
+    """
+    layers: list[Path] = []
+    upper: list[Path] = []
+    for option in mount["super_options"]:
+        name, _, value = option.partition("=")
+        if name == "lowerdir":
+            layers += [Path(layer) for layer in split_lowerdir_option(value)]
+        elif name == "lowerdir+":
+            layers.append(Path(value))
+        elif name == "upperdir":
+            upper.append(Path(value))
+    return layers + upper
+
+
+def read_namespace_pid() -> int | None:
+    """
+    :return: the pid recorded in ns-pid.txt by the last writable session
+    """
+    from code.commandline import get_pid_path
+    try:
+        return int(get_pid_path().read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def get_session_mounts(target_dir: Path) -> dict[str, MountEntry]:
+    """
+    Looks up the overlay mounts of the running modfs sessions without starting any programs.
+    The namespace helpers are found through ns-pid.txt and the session state files.
+
+    :return: the overlay mount at target_dir by session name ("writable", "read-only" or
+             "outside" for a mount in the namespace of modfs itself)
+    """
+    from code.deployer import read_namespace_state
+    mounts: dict[str, MountEntry] = dict()
+    for session_name, read_only in [("writable", False), ("read-only", True)]:
+        state = read_namespace_state(read_only)
+        pids = [state["pid"]] if state is not None else []
+        if not read_only:
+            recorded_pid = read_namespace_pid()
+            if recorded_pid is not None and recorded_pid not in pids:
+                pids.append(recorded_pid)
+        for pid in pids:
+            mount = find_overlay_mount(target_dir, pid)
+            if mount is not None:
+                mounts[session_name] = mount
+                break
+    outside_mount = find_overlay_mount(target_dir)
+    if outside_mount is not None:
+        mounts["outside"] = outside_mount
+    return mounts
+
+
+def is_deployment_mounted(target_dir: Path) -> bool:
+    return len(get_session_mounts(target_dir)) > 0
+
+
+def get_mounted_layers(target_dir: Path) -> set[Path]:
+    """
+    :return: the resolved paths of all layers and upper directories of the running sessions
+    """
+    return {layer.resolve()
+            for mount in get_session_mounts(target_dir).values()
+            for layer in get_overlay_layers(mount)}
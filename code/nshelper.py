@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# This module is executed as a standalone script inside the user and mount namespace of a
+# deployment. It holds the overlay mount for as long as commands are using it, so that further
+# commands can join the namespace instead of mounting everything again.
+# It must therefore only depend on the standard library and the reaper module.
+#
+# On Python 3.12 and newer, modfs does not start this module as a script. It forks, creates the
+# namespaces with os.unshare and mounts the overlay with the new mount API syscalls instead.
+from ctypes import CDLL, get_errno
+from json import loads
+from os import kill, close, fsencode, strerror, getuid, getgid, getpid
+from pathlib import Path
+from signal import signal, SIGTERM, SIGHUP, SIGINT
+from subprocess import run
+from sys import argv, stdout, stderr, exit
+from time import monotonic, sleep
+
+try:
+    from code.reaper import move_to_trash, empty_trash_in_background
+except ImportError:
+    # Executed as a script, with the code directory as first entry of the module search path
+    from reaper import move_to_trash, empty_trash_in_background
+
+LEASE_POLL_INTERVAL_SECS = 0.5
+# Name of the directory inside the configured work directory, that holds the work directories
+# of ended sessions until the reaper has deleted them
+WORK_TRASH_NAME = ".trash"
+
+# The syscall numbers of the new mount API are the same on all architectures except alpha
+SYS_MOVE_MOUNT = 429
+SYS_FSOPEN = 430
+SYS_FSCONFIG = 431
+SYS_FSMOUNT = 432
+FSOPEN_CLOEXEC = 0x1
+FSCONFIG_SET_FLAG = 0
+FSCONFIG_SET_STRING = 1
+FSCONFIG_CMD_CREATE = 6
+FSMOUNT_CLOEXEC = 0x1
+MOUNT_ATTR_RDONLY = 0x1
+MOUNT_ATTR_NOSUID = 0x2
+MOUNT_ATTR_NODEV = 0x4
+MOUNT_ATTR_NOATIME = 0x10
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+AT_FDCWD = -100
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+MNT_DETACH = 0x2
+
+libc = CDLL(None, use_errno=True)
+
+
+def is_lease_holder_alive(lease: Path) -> bool:
+    try:
+        kill(int(lease.name), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def count_active_leases(lease_dir: Path) -> int:
+    """
+    Every command using the mount holds a lease, which is a file named after the pid of the modfs
+    process that started the command. Leases of processes that are gone are removed.
+    """
+    active_leases = 0
+    for lease in lease_dir.iterdir() if lease_dir.is_dir() else []:
+        if is_lease_holder_alive(lease):
+            active_leases += 1
+        else:
+            lease.unlink(missing_ok=True)
+    return active_leases
+
+
+def wait_until_unused(lease_dir: Path, lifetime_secs: int) -> None:
+    idle_since = monotonic()
+    while True:
+        if count_active_leases(lease_dir) > 0:
+            idle_since = monotonic()
+        elif monotonic() - idle_since >= lifetime_secs:
+            return
+        sleep(LEASE_POLL_INTERVAL_SECS)
+
+
+def get_lower_layers(config: dict) -> list[str]:
+    """
+    :return: the lower layers in the order overlayfs expects them, highest priority first.
+             Read-only mounts have no upper directory, so the overflow becomes the top layer.
+    """
+    layers = list(reversed(config["layers"]))
+    if config["read_only"]:
+        layers.insert(0, config["overflow_dir"])
+    return layers
+
+
+def check_libc_result(result: int, description: str) -> int:
+    if result < 0:
+        error_number = get_errno()
+        raise OSError(error_number, f"{description}: {strerror(error_number)}")
+    return result
+
+
+def make_mounts_private() -> None:
+    """
+    Stops mount events from propagating between the new mount namespace and its parent,
+    the same way unshare(1) does by default.
+    """
+    check_libc_result(libc.mount(None, b"/", None, MS_REC | MS_PRIVATE, None),
+                      "Failed to make mounts private")
+
+
+def mount_overlay_with_syscalls(config: dict) -> None:
+    """
+    Creates the overlay with fsopen, fsconfig, fsmount and move_mount. Every layer is passed as
+    a separate parameter, so paths do not need any quoting or escaping.
+    Requires Linux 6.8 or newer for the lowerdir+ parameter.
+    """
+    fs_fd = check_libc_result(libc.syscall(SYS_FSOPEN, b"overlay", FSOPEN_CLOEXEC), "fsopen")
+    try:
+        def set_parameter(key: str, value: str | None) -> None:
+            if value is None:
+                result = libc.syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_SET_FLAG, key.encode(), None, 0)
+            else:
+                result = libc.syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_SET_STRING, key.encode(),
+                                      fsencode(value), 0)
+            check_libc_result(result, f"Failed to set overlay parameter {key}")
+
+        set_parameter("userxattr", None)
+        if not config["read_only"]:
+            set_parameter("workdir", config["work_dir"])
+            set_parameter("upperdir", config["overflow_dir"])
+        # overlayfs expects the layer with the highest priority first
+        for layer in get_lower_layers(config):
+            set_parameter("lowerdir+", layer)
+        check_libc_result(libc.syscall(SYS_FSCONFIG, fs_fd, FSCONFIG_CMD_CREATE, None, None, 0),
+                          "Failed to create overlay")
+        mount_attributes = MOUNT_ATTR_NODEV | MOUNT_ATTR_NOSUID | MOUNT_ATTR_NOATIME
+        if config["read_only"]:
+            mount_attributes |= MOUNT_ATTR_RDONLY
+        mount_fd = check_libc_result(libc.syscall(SYS_FSMOUNT, fs_fd, FSMOUNT_CLOEXEC,
+                                                  mount_attributes),
+                                     "fsmount")
+        try:
+            check_libc_result(libc.syscall(SYS_MOVE_MOUNT, mount_fd, b"", AT_FDCWD,
+                                           fsencode(config["target"]), MOVE_MOUNT_F_EMPTY_PATH),
+                              "Failed to attach overlay to the deployment directory")
+        finally:
+            close(mount_fd)
+    finally:
+        close(fs_fd)
+
+
+def mount_overlay_with_command(config: dict) -> None:
+    mount_cmd = ["mount", "--exclusive", "--onlyonce", "-t", "overlay", "overlay",
+                 "-o", "nodev,nosuid,noatime,userxattr"]
+    if config["read_only"]:
+        mount_cmd += ["-o", "ro"]
+    else:
+        mount_cmd += ["-o", f"workdir={config['work_dir']}",
+                      "-o", f"upperdir={config['overflow_dir']}"]
+    for layer in get_lower_layers(config):
+        mount_cmd += ["-o", f"lowerdir+={layer}"]
+    run(mount_cmd + [config["target"]], check=True)
+
+
+def mount_overlay(config: dict) -> None:
+    try:
+        mount_overlay_with_syscalls(config)
+    except OSError as e:
+        print(f"{e}, falling back to mount(8)", file=stderr)
+        mount_overlay_with_command(config)
+
+
+def unmount_overlay(config: dict) -> None:
+    if libc.umount2(fsencode(config["target"]), MNT_DETACH) < 0:
+        run(["umount", "--lazy", "--read-only", config["target"]])
+    if config["work_dir"] is not None:
+        # Every session has a work directory of its own. Deleting it can take a while after the
+        # game left many files behind, so it is moved aside and deleted in the background.
+        work_dir = Path(config["work_dir"])
+        trash_dir = work_dir.parent / WORK_TRASH_NAME
+        move_to_trash(work_dir, trash_dir)
+        empty_trash_in_background(trash_dir)
+
+
+def terminate(signal_number, frame) -> None:
+    exit(0)
+
+
+def append_session_end_record(config: dict, phases: dict[str, float]) -> None:
+    if config.get("timing_log") is None:
+        return
+    from datetime import datetime
+    from json import dumps
+    record = {
+        "time": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "event": "session-end",
+        "session": "read-only" if config["read_only"] else "writable",
+        "phases": phases,
+    }
+    with open(config["timing_log"], "at", encoding="UTF-8") as log_file:
+        log_file.write(dumps(record) + "\n")
+
+
+def serve(config: dict, report_ready, phases: dict[str, float]) -> None:
+    """
+    Mounts the overlay in the current namespaces and keeps it until it has not been used for
+    the configured lifetime.
+
+    :param report_ready: called with the measured phases once commands can join the namespace
+    :param phases: durations of the phases of the helper's startup measured so far
+    """
+    for signal_number in [SIGTERM, SIGHUP, SIGINT]:
+        signal(signal_number, terminate)
+    mount_start = monotonic()
+    mount_overlay(config)
+    phases["mount"] = monotonic() - mount_start
+    try:
+        report_ready(phases)
+        wait_until_unused(Path(config["lease_dir"]), config["lifetime_secs"])
+    finally:
+        unmount_start = monotonic()
+        unmount_overlay(config)
+        append_session_end_record(config, {"unmount_and_cleanup": monotonic() - unmount_start})
+
+
+def format_ready_report(phases: dict[str, float]) -> str:
+    """
+    The line the helper sends to the modfs process that started it, once the mount is ready
+    """
+    from json import dumps
+    return dumps({"pid": getpid(), "phases": phases}) + "\n"
+
+
+def enter_new_namespaces() -> None:
+    """
+    Moves the calling process into new user and mount namespaces, in which it is mapped to root.
+    """
+    from os import unshare, CLONE_NEWUSER, CLONE_NEWNS
+    uid = getuid()
+    gid = getgid()
+    unshare(CLONE_NEWUSER | CLONE_NEWNS)
+    Path("/proc/self/setgroups").write_text("deny")
+    Path("/proc/self/uid_map").write_text(f"0 {uid} 1")
+    Path("/proc/self/gid_map").write_text(f"0 {gid} 1")
+    make_mounts_private()
+
+
+def parse_ready_report(line: str) -> dict | None:
+    from json import JSONDecodeError
+    try:
+        report = loads(line)
+    except JSONDecodeError:
+        return None
+    return report if isinstance(report, dict) and isinstance(report.get("pid"), int) else None
+
+
+def start_helper_in_new_namespaces(config: dict, log_path: Path) -> dict | None:
+    """
+    Forks the namespace helper from the current process, which avoids starting unshare(1) and
+    a new Python interpreter. The helper is forked twice, so it is not a child of the command
+    that modfs executes afterwards.
+
+    :return: the ready report of the helper or None, if it failed
+    """
+    from os import fork, pipe, write, setsid, waitpid, dup2, chdir, closerange, sysconf, _exit, \
+        open as os_open, O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC
+    read_fd, write_fd = pipe()
+    intermediate_pid = fork()
+    if intermediate_pid == 0:
+        exit_code = 1
+        try:
+            close(read_fd)
+            setsid()
+            if fork() == 0:
+                devnull_fd = os_open("/dev/null", O_RDONLY)
+                log_fd = os_open(log_path, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+                dup2(devnull_fd, 0)
+                dup2(log_fd, 1)
+                dup2(log_fd, 2)
+                # Do not hold on to files of modfs, e.g. the lock of the instance
+                closerange(3, write_fd)
+                closerange(write_fd + 1, sysconf("SC_OPEN_MAX"))
+                chdir("/")
+                namespace_start = monotonic()
+                enter_new_namespaces()
+                serve(config,
+                      lambda phases: write(write_fd, format_ready_report(phases).encode()),
+                      {"namespace": monotonic() - namespace_start})
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            from traceback import print_exc
+            print_exc()
+        finally:
+            stderr.flush()
+            _exit(exit_code)
+    close(write_fd)
+    waitpid(intermediate_pid, 0)
+    with open(read_fd, "rt") as ready_pipe:
+        return parse_ready_report(ready_pipe.readline())
+
+
+def join_helper_namespaces(helper_pid: int) -> None:
+    """
+    Moves the calling process into the user and mount namespace of the helper. The working
+    directory is looked up again afterwards, so it shows the mounted view.
+    """
+    from os import open as os_open, setns, getcwd, chdir, CLONE_NEWUSER, CLONE_NEWNS, O_RDONLY
+    working_dir = getcwd()
+    user_ns_fd = os_open(f"/proc/{helper_pid}/ns/user", O_RDONLY)
+    mount_ns_fd = os_open(f"/proc/{helper_pid}/ns/mnt", O_RDONLY)
+    try:
+        setns(user_ns_fd, CLONE_NEWUSER)
+        setns(mount_ns_fd, CLONE_NEWNS)
+    finally:
+        close(user_ns_fd)
+        close(mount_ns_fd)
+    chdir(working_dir)
+
+
+def main(config: dict) -> None:
+    def report_ready(phases: dict[str, float]) -> None:
+        # Tells the modfs process that started the helper that commands can join the namespace
+        stdout.write(format_ready_report(phases))
+        stdout.close()
+    serve(config, report_ready, dict())
+
+
+if __name__ == "__main__":
+    if len(argv) != 2:
+        print(f"Usage: {argv[0]} CONFIG_JSON", file=stderr)
+        exit(2)
+    main(loads(argv[1]))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from datetime import datetime
+from json import dumps
+from os import scandir
+from pathlib import Path
+from stat import S_ISCHR, S_ISDIR
+from sys import stderr
+from typing import TypedDict
+
+from code.mod import resolve_base_dir
+from code.paths import get_meta_directory
+
+OVERFLOW_REPORTS_KEPT = 100
+
+# relative path -> (mode, size, mtime in nanoseconds, inode)
+OverflowIndex = dict[str, tuple[int, int, int, int]]
+
+
+class OverflowChangeReport(TypedDict):
+    """
+    what a session changed in the upper directory of the overlay. Whiteouts are the entries
+    overlayfs creates, when a file of a mod or of the game is deleted.
+    """
+    time: str
+    command: list[str]
+    added: list[str]
+    modified: list[str]
+    deleted: list[str]
+    whiteouts: list[str]
+    bytes_added: int
+
+
+def get_report_directory(base_dir: Path | None = None) -> Path:
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'reports'
+
+
+def is_whiteout(mode: int, device: int) -> bool:
+    return S_ISCHR(mode) and device == 0
+
+
+def index_overflow(overflow_dir: Path) -> OverflowIndex:
+    """
+    Records the metadata of every entry in the directory. File contents are not read.
+    """
+    index: OverflowIndex = dict()
+    pending_dirs = [""]
+    while len(pending_dirs) > 0:
+        relative_dir = pending_dirs.pop()
+        try:
+            with scandir(overflow_dir / relative_dir) as entries:
+                for entry in entries:
+                    relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    # Whiteouts are recognized by their device number, which would be lost
+                    mode = entry_stat.st_mode if not is_whiteout(entry_stat.st_mode,
+                                                                 entry_stat.st_rdev) else 0
+                    index[relative_path] = (mode, entry_stat.st_size, entry_stat.st_mtime_ns,
+                                            entry_stat.st_ino)
+                    if S_ISDIR(entry_stat.st_mode):
+                        pending_dirs.append(relative_path)
+        except FileNotFoundError:
+            continue
+    return index
+
+
+def compare_overflow_indexes(before: OverflowIndex,
+                             after: OverflowIndex,
+                             command: list[str]) -> OverflowChangeReport:
+    report = OverflowChangeReport(time=datetime.now().astimezone().isoformat(timespec="seconds"),
+                                  command=command,
+                                  added=[],
+                                  modified=[],
+                                  deleted=sorted(path for path in before if path not in after),
+                                  whiteouts=[],
+                                  bytes_added=0)
+    for path, metadata in sorted(after.items()):
+        mode, size, _, _ = metadata
+        previous = before.get(path)
+        if mode == 0:
+            if previous is None or previous[0] != 0:
+                report["whiteouts"].append(path)
+        elif S_ISDIR(mode):
+            # Directories only show up when they are new, changes of their contents are
+            # listed as the entries themselves
+            if previous is None:
+                report["added"].append(path + "/")
+        elif previous is None or previous[0] == 0:
+            report["added"].append(path)
+            report["bytes_added"] += size
+        elif previous != metadata:
+            report["modified"].append(path)
+            report["bytes_added"] += max(size - previous[1], 0)
+    return report
+
+
+def has_changes(report: OverflowChangeReport) -> bool:
+    return any(len(report[category]) > 0
+               for category in ["added", "modified", "deleted", "whiteouts"])
+
+
+def save_overflow_report(report: OverflowChangeReport) -> Path:
+    """
+    Stores the report as a JSON file. Only the newest OVERFLOW_REPORTS_KEPT reports are kept.
+    """
+    report_dir = get_report_directory()
+    report_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    report_path = report_dir / f"overflow-{timestamp}.json"
+    report_path.write_text(dumps(report, separators=(",", ":")) + "\n", encoding="UTF-8")
+    for old_report in sorted(report_dir.glob("overflow-*.json"))[:-OVERFLOW_REPORTS_KEPT]:
+        old_report.unlink(missing_ok=True)
+    return report_path
+
+
+def print_overflow_report_summary(report: OverflowChangeReport, report_path: Path) -> None:
+    from code.tools import format_byte_size
+    print(f"Overflow changes: {len(report['added'])} added, {len(report['modified'])} modified, "
+          f"{len(report['deleted'])} deleted, {len(report['whiteouts'])} whiteouts "
+          f"({format_byte_size(report['bytes_added'])} written)", file=stderr)
+    print(f"Report written to {report_path}", file=stderr)
@@ -2,6 +2,7 @@
 #
 # SPDX-FileCopyrightText: 2023 Jonas Tobias Hopusch <git@jotoho.de>
 # SPDX-License-Identifier: AGPL-3.0-only
+from os import scandir
 from pathlib import Path
 
 
@@ -23,20 +24,79 @@ def get_meta_directory(instance_dir: Path) -> Path:
     else:
         return new_path_spec
 
+def get_cache_directory(instance_dir: Path) -> Path:
+    """
+    :return: The directory for data that modfs can recompute at any time, if it gets deleted
+    """
+    return get_meta_directory(instance_dir) / 'cache'
+
+
+def get_trash_directory(instance_dir: Path) -> Path:
+    """
+    :return: The directory where data waits for deletion by the background reaper.
+             It is on the same filesystem as the instance's mods directory.
+    """
+    return get_meta_directory(instance_dir) / 'trash'
+
+
 def get_all_files(containing_dir: Path) -> set[Path]:
+    from code.metrics import count
     result = set()
-    if isinstance(containing_dir, Path) and containing_dir.is_dir(follow_symlinks=False):
-        for child in containing_dir.iterdir():
-            if child.is_file(follow_symlinks=False):
-                result.add(child)
-            elif child.is_dir(follow_symlinks=False):
-                result |= get_all_files(child)
+    # Path.is_dir and Path.is_file only accept follow_symlinks since Python 3.13
+    if isinstance(containing_dir, Path) and not containing_dir.is_symlink() \
+            and containing_dir.is_dir():
+        with scandir(containing_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    count("files_scanned")
+                    result.add(Path(entry.path))
+                elif entry.is_dir(follow_symlinks=False):
+                    result |= get_all_files(Path(entry.path))
     return result
 
 def trim_emptied_directory(directory_path: Path) -> None:
-    if not isinstance(directory_path, Path) or not directory_path.is_dir(follow_symlinks=False):
+    if not isinstance(directory_path, Path) or directory_path.is_symlink() \
+            or not directory_path.is_dir():
         return
     if not any(directory_path.iterdir()):
         parent_dir = directory_path.parent
         directory_path.rmdir()
         trim_emptied_directory(parent_dir)
+
+
+def get_file_hash(file_path: Path) -> str:
+    from hashlib import sha3_512, file_digest
+    from code.metrics import count
+    with file_path.open(mode='rb') as f:
+        digest = file_digest(f, sha3_512).hexdigest()
+        file_size = f.tell()
+    count("bytes_read", file_size)
+    count("bytes_hashed", file_size)
+    return digest
+
+
+def clone_file(source: Path, destination: Path) -> bool:
+    """
+    Creates destination as a copy-on-write clone (reflink) of source.
+
+    :return: False, if the filesystem does not support reflinks. destination is not left behind
+             in that case.
+    """
+    from fcntl import ioctl
+    from os import open as os_open, close, O_RDONLY, O_WRONLY, O_CREAT, O_EXCL
+    from shutil import copystat
+    ficlone = 0x40049409
+    source_fd = os_open(source, O_RDONLY)
+    try:
+        destination_fd = os_open(destination, O_WRONLY | O_CREAT | O_EXCL, 0o644)
+        try:
+            ioctl(destination_fd, ficlone, source_fd)
+        except OSError:
+            close(destination_fd)
+            destination.unlink(missing_ok=True)
+            return False
+        close(destination_fd)
+    finally:
+        close(source_fd)
+    copystat(source, destination)
+    return True
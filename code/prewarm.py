@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic
+from typing import TypedDict
+
+from code.creation import is_excluded_from_import
+from code.deployer import list_layer_entries, resolve_winning_files
+
+
+class PrewarmStats(TypedDict):
+    files: int
+    bytes: int
+    skipped_files: int
+    seconds: float
+
+
+def select_prewarm_files(layers: list[Path],
+                         size_limit: int,
+                         include_patterns: list[str],
+                         exclude_patterns: list[str],
+                         deployed_dir: Path | None = None) -> tuple[list[tuple[Path, int]], int]:
+    """
+    Picks the files visible in the deployment that should be loaded into the page cache. Files of
+    the layer with the highest priority come first, so the size limit cuts off the least
+    important files. Files that would exceed the limit are skipped, but smaller ones after them
+    are still taken.
+
+    :param layers: layers in order of increasing priority, as passed to the overlay
+    :param size_limit: maximum number of bytes to select
+    :param deployed_dir: if given, the files are selected at their place in this directory
+                         instead of in the layers. Materialized deployments need this, because
+                         reflinked copies do not share the page cache with the originals.
+    :return: the selected files with their sizes and the number of files left out by the limit
+    """
+    from os import stat
+    from stat import S_ISREG
+    layer_entries = [(layer, *list_layer_entries(layer)) for layer in layers]
+    winners = resolve_winning_files(layer_entries)
+    files_by_layer: dict[Path, list[str]] = dict()
+    for relative_path, layer in winners.items():
+        files_by_layer.setdefault(layer, []).append(relative_path)
+    selected: list[tuple[Path, int]] = []
+    selected_bytes = 0
+    skipped = 0
+    for layer in reversed(layers):
+        for relative_path in sorted(files_by_layer.get(layer, [])):
+            if is_excluded_from_import(Path(relative_path), include_patterns, exclude_patterns):
+                continue
+            file_path = (deployed_dir if deployed_dir is not None else layer) / relative_path
+            try:
+                file_stat = stat(file_path)
+            except OSError:
+                continue
+            if not S_ISREG(file_stat.st_mode):
+                continue
+            if selected_bytes + file_stat.st_size > size_limit:
+                skipped += 1
+                continue
+            selected.append((file_path, file_stat.st_size))
+            selected_bytes += file_stat.st_size
+    return selected, skipped
+
+
+def prewarm_file(file_path: Path) -> bool:
+    """
+    Asks the kernel to read the whole file into the page cache in the background.
+
+    :return: False, if the file could not be opened
+    """
+    from os import open as os_open, close, posix_fadvise, O_RDONLY, POSIX_FADV_WILLNEED
+    try:
+        fd = os_open(file_path, O_RDONLY)
+    except OSError:
+        return False
+    try:
+        posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    except OSError:
+        return False
+    finally:
+        close(fd)
+    return True
+
+
+def prewarm_deployment(layers: list[Path],
+                       size_limit: int,
+                       include_patterns: list[str],
+                       exclude_patterns: list[str],
+                       max_workers: int,
+                       deployed_dir: Path | None = None) -> PrewarmStats:
+    """
+    Loads the files of the deployment into the page cache, so that the first access through the
+    overlay does not have to wait for the disk. The readahead requests are issued by a bounded
+    number of threads, which keeps slow network filesystems busy without flooding them.
+    """
+    start = monotonic()
+    selected, skipped = select_prewarm_files(layers, size_limit, include_patterns,
+                                             exclude_patterns, deployed_dir)
+    stats = PrewarmStats(files=0, bytes=0, skipped_files=skipped, seconds=0.0)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        results = pool.map(prewarm_file, [file_path for file_path, _ in selected])
+        for (_, file_size), prewarmed in zip(selected, results):
+            if prewarmed:
+                stats["files"] += 1
+                stats["bytes"] += file_size
+    stats["seconds"] = monotonic() - start
+    return stats
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from collections import Counter
+from cProfile import Profile
+from datetime import datetime
+from pathlib import Path
+from pstats import Stats, SortKey
+from sys import stderr, addaudithook
+from typing import Any, Callable
+
+# audit events raised by the standard library for filesystem access, see the
+# "Audit events table" of the Python documentation
+AUDITED_FILESYSTEM_CALLS: dict[str, str] = {
+    "open": "open",
+    "os.scandir": "iterdir",
+    "os.listdir": "iterdir",
+    "os.walk": "walk",
+    "os.mkdir": "mkdir",
+    "os.rmdir": "rmdir",
+    "os.remove": "unlink",
+    "os.rename": "rename",
+    "os.link": "link",
+    "os.symlink": "symlink",
+    "os.chmod": "chmod",
+    "os.utime": "utime",
+    "shutil.copyfile": "copy",
+    "shutil.rmtree": "rmtree",
+}
+PROFILE_TOP_ENTRIES = 25
+
+
+class FilesystemCallCounter:
+    """
+    Counts filesystem calls made through the standard library. There is no audit event for stat,
+    so os.stat and os.lstat are replaced by counting wrappers while the counter is active.
+    Audit hooks cannot be removed again, so the hook only counts while the counter is active.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Counter[str] = Counter()
+        self.active = False
+        self.original_functions: dict[str, Callable] = dict()
+        addaudithook(self.audit)
+
+    def audit(self, event: str, event_args: tuple) -> None:
+        if self.active and event in AUDITED_FILESYSTEM_CALLS:
+            self.counts[AUDITED_FILESYSTEM_CALLS[event]] += 1
+
+    def start(self) -> None:
+        import os
+        for name in ["stat", "lstat"]:
+            original = getattr(os, name)
+            self.original_functions[name] = original
+
+            def counting_wrapper(*wrapper_args, wrapped=original, **wrapper_kwargs):
+                if self.active:
+                    self.counts["stat"] += 1
+                return wrapped(*wrapper_args, **wrapper_kwargs)
+            setattr(os, name, counting_wrapper)
+        self.active = True
+
+    def stop(self) -> None:
+        import os
+        self.active = False
+        for name, original in self.original_functions.items():
+            setattr(os, name, original)
+        self.original_functions.clear()
+
+
+class ProfilingSession:
+    def __init__(self, subcommand: str, output_path: Path, count_filesystem_calls: bool) -> None:
+        self.subcommand = subcommand
+        self.output_path = output_path
+        self.profile = Profile()
+        self.counter = FilesystemCallCounter() if count_filesystem_calls else None
+        self.finished = False
+
+    def start(self) -> None:
+        if self.counter is not None:
+            self.counter.start()
+        self.profile.enable()
+
+    def finish(self) -> None:
+        """
+        Stops profiling, writes the pstats file and prints a summary. Later calls do nothing.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.profile.disable()
+        if self.counter is not None:
+            self.counter.stop()
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        self.profile.dump_stats(self.output_path)
+        print(f"Profile of {self.subcommand} written to {self.output_path}", file=stderr)
+        Stats(self.profile, stream=stderr).sort_stats(SortKey.CUMULATIVE).print_stats(
+            PROFILE_TOP_ENTRIES)
+        if self.counter is not None:
+            print(f"Filesystem calls during {self.subcommand}:", file=stderr)
+            for call_type, count in self.counter.counts.most_common():
+                print(f"  {call_type.ljust(8)} {count:>10}", file=stderr)
+        stderr.flush()
+
+
+active_session: ProfilingSession | None = None
+
+
+def get_default_profile_path(instance_dir: Path, subcommand: str) -> Path:
+    from code.paths import get_meta_directory
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return get_meta_directory(instance_dir) / 'logs' / f"profile-{subcommand}-{timestamp}.pstats"
+
+
+def run_profiled(function: Callable[[Any], None],
+                 argument: Any,
+                 subcommand: str,
+                 output_path: Path,
+                 count_filesystem_calls: bool) -> None:
+    """
+    Calls function(argument) under cProfile. The results are also written, if the subcommand
+    ends through exit().
+    """
+    global active_session
+    active_session = ProfilingSession(subcommand, output_path, count_filesystem_calls)
+    active_session.start()
+    try:
+        function(argument)
+    finally:
+        finish_active_profile()
+
+
+def finish_active_profile() -> None:
+    """
+    Must be called before modfs replaces its process with another program, as the profile would
+    be lost otherwise.
+    """
+    if active_session is not None:
+        active_session.finish()
+
+
+def discard_active_profile() -> None:
+    """
+    Must be called in forked child processes, so that only the parent writes the profile.
+    """
+    global active_session
+    active_session = None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from json import dumps
+from sys import stderr
+from threading import Lock
+from time import monotonic
+from typing import TextIO
+
+from code.tools import format_byte_size
+
+TERMINAL_REDRAW_INTERVAL_SECS = 0.1
+EVENT_INTERVAL_SECS = 5.0
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a long-running operation on stderr. On a terminal a single status
+    line with the processed files and bytes, the rate and the remaining time is redrawn. Otherwise,
+    a JSON object is written as a line every EVENT_INTERVAL_SECS, so that scripts and log files
+    are not flooded. Operations that end before the first event stay silent. The totals are
+    optional; without them no remaining time can be estimated.
+    advance() may be called from several threads.
+    """
+
+    def __init__(self,
+                 operation: str,
+                 total_files: int | None = None,
+                 total_bytes: int | None = None,
+                 stream: TextIO = stderr) -> None:
+        self.operation = operation
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.files = 0
+        self.bytes = 0
+        self.start = monotonic()
+        self.last_report = self.start
+        self.line_visible = False
+        self.lock = Lock()
+
+    def __enter__(self) -> "ProgressReporter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.finish()
+
+    def advance(self, files: int = 1, bytes_processed: int = 0) -> None:
+        with self.lock:
+            self.files += files
+            self.bytes += bytes_processed
+            now = monotonic()
+            interval = TERMINAL_REDRAW_INTERVAL_SECS if self.interactive else EVENT_INTERVAL_SECS
+            if now - self.last_report >= interval:
+                self.last_report = now
+                self.report("progress", now)
+
+    def message(self, text: str, file: TextIO | None = None) -> None:
+        """
+        Prints a line without mixing it into the status line on a terminal.
+
+        :param file: stream to print to, by default the stream of the progress reports
+        """
+        with self.lock:
+            self.clear_line()
+            print(text, file=file if file is not None else self.stream, flush=True)
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.interactive:
+                self.clear_line()
+            elif self.last_report > self.start:
+                self.report("done", monotonic())
+
+    def clear_line(self) -> None:
+        if self.line_visible:
+            self.stream.write("\r\033[K")
+            self.line_visible = False
+
+    def estimate_remaining_secs(self, elapsed: float) -> float | None:
+        if elapsed <= 0:
+            return None
+        # Bytes are the better measure of the work left, if the operation processes file contents
+        if self.total_bytes is not None and self.bytes > 0:
+            return max(self.total_bytes - self.bytes, 0) / (self.bytes / elapsed)
+        if self.total_files is not None and self.files > 0:
+            return max(self.total_files - self.files, 0) / (self.files / elapsed)
+        return None
+
+    def report(self, event: str, now: float) -> None:
+        elapsed = now - self.start
+        remaining = self.estimate_remaining_secs(elapsed) if event == "progress" else 0.0
+        if not self.interactive:
+            self.stream.write(dumps({
+                "event": event,
+                "operation": self.operation,
+                "files": self.files,
+                "total_files": self.total_files,
+                "bytes": self.bytes,
+                "total_bytes": self.total_bytes,
+                "elapsed_secs": round(elapsed, 3),
+                "bytes_per_sec": round(self.bytes / elapsed) if elapsed > 0 else None,
+                "eta_secs": round(remaining, 1) if remaining is not None else None,
+            }) + "\n")
+            self.stream.flush()
+            return
+        files = f"{self.files}" + (f"/{self.total_files}" if self.total_files is not None else "")
+        status = f"{self.operation}: {files} files"
+        if self.bytes > 0 or self.total_bytes is not None:
+            status += f", {format_byte_size(self.bytes)}"
+            if self.total_bytes is not None:
+                status += f"/{format_byte_size(self.total_bytes)}"
+            if elapsed > 0:
+                status += f", {format_byte_size(round(self.bytes / elapsed))}/s"
+        elif elapsed > 0:
+            status += f", {self.files / elapsed:.0f} files/s"
+        if remaining is not None:
+            status += f", ETA {format_duration(remaining)}"
+        self.stream.write("\r\033[K" + status)
+        self.stream.flush()
+        self.line_visible = True
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from errno import EXDEV
+from os import link, rename, readlink, symlink, scandir
+from pathlib import Path
+from shutil import copy2, move
+from stat import S_ISDIR
+from tempfile import mkdtemp
+from typing import TypedDict
+
+from code.creation import matches_import_pattern
+from code.overflowreport import index_overflow
+from code.reaper import remove_tree
+
+
+class PromoteSelection(TypedDict):
+    """
+    the overflow entries matched by the patterns of a promotion. Whiteouts cannot be promoted,
+    because a mod version has no way of deleting files of other mods or the game.
+    """
+    files: list[str]
+    bytes: int
+    whiteouts: list[str]
+
+
+class PromoteStats(TypedDict):
+    seeded_files: int
+    moved_files: int
+    copied_files: int
+
+
+def select_overflow_files(overflow_dir: Path, patterns: list[str]) -> PromoteSelection:
+    """
+    Patterns follow the rules of the import filters. A pattern matching a directory selects
+    everything below it.
+    """
+    selection = PromoteSelection(files=[], bytes=0, whiteouts=[])
+    for relative_path, (mode, size, _, _) in sorted(index_overflow(overflow_dir).items()):
+        if S_ISDIR(mode) or not matches_import_pattern(Path(relative_path), patterns):
+            continue
+        if mode == 0:
+            selection["whiteouts"].append(relative_path)
+        else:
+            selection["files"].append(relative_path)
+            selection["bytes"] += size
+    return selection
+
+
+def seed_version(source_dir: Path, destination_dir: Path) -> int:
+    """
+    Fills destination_dir with hardlinks to the files of source_dir, so that the new version
+    starts out as a copy of the old one without using any space. Files on another filesystem,
+    e.g. in a shared mod store, are copied instead.
+
+    :return: number of files placed
+    """
+    placed = 0
+    pending_dirs = [""]
+    while len(pending_dirs) > 0:
+        relative_dir = pending_dirs.pop()
+        (destination_dir / relative_dir).mkdir(parents=True, exist_ok=True)
+        with scandir(source_dir / relative_dir) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                destination = destination_dir / relative_path
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(relative_path)
+                elif entry.is_symlink():
+                    symlink(readlink(entry.path), destination)
+                    placed += 1
+                else:
+                    try:
+                        link(entry.path, destination)
+                    except OSError:
+                        copy2(entry.path, destination)
+                    placed += 1
+    return placed
+
+
+def remove_emptied_directories(directory: Path, root: Path) -> None:
+    """
+    Removes directory and its parents as long as they are empty, but never root itself
+    """
+    while directory != root and directory.is_relative_to(root) and not any(directory.iterdir()):
+        directory.rmdir()
+        directory = directory.parent
+
+
+def move_overflow_files(overflow_dir: Path,
+                        files: list[str],
+                        version_dir: Path,
+                        stats: PromoteStats,
+                        moved_files: list[str]) -> None:
+    """
+    Moves the files into the version. Files replace the ones the version was seeded with.
+    A rename is used wherever possible, so the contents are never copied on one filesystem.
+
+    :param moved_files: receives the files that have been moved so far
+    """
+    for relative_path in files:
+        source = overflow_dir / relative_path
+        destination = version_dir / relative_path
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if destination.is_dir() and not destination.is_symlink():
+            raise ValueError(f"{relative_path} is a directory in the promoted version")
+        try:
+            rename(source, destination)
+            stats["moved_files"] += 1
+        except OSError as e:
+            if e.errno != EXDEV:
+                raise
+            destination.unlink(missing_ok=True)
+            move(source, destination)
+            stats["copied_files"] += 1
+        moved_files.append(relative_path)
+        remove_emptied_directories(source.parent, overflow_dir)
+
+
+def return_overflow_files(version_dir: Path, moved_files: list[str], overflow_dir: Path) -> None:
+    """
+    Moves the files of a failed promotion back to where they were in the overflow directory
+    """
+    for relative_path in reversed(moved_files):
+        destination = overflow_dir / relative_path
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        move(version_dir / relative_path, destination)
+
+
+def promote_overflow_files(overflow_dir: Path,
+                           files: list[str],
+                           seed_dir: Path | None,
+                           version_dir: Path) -> PromoteStats:
+    """
+    Creates the contents of a new mod version from the version it replaces and the selected
+    overflow files. The version is assembled in a temporary directory, which replaces the empty
+    version directory once it is complete. If anything fails, the files are moved back into the
+    overflow directory and the version stays empty.
+
+    :param seed_dir: directory of the version the new one is based on or None for a new mod
+    :param version_dir: the empty directory of the new version
+    """
+    stats = PromoteStats(seeded_files=0, moved_files=0, copied_files=0)
+    staging_dir = Path(mkdtemp(prefix=f".{version_dir.name}.promoting-", dir=version_dir.parent))
+    moved_files: list[str] = []
+    try:
+        if seed_dir is not None:
+            stats["seeded_files"] = seed_version(seed_dir, staging_dir)
+        move_overflow_files(overflow_dir, files, staging_dir, stats, moved_files)
+        staging_dir.rename(version_dir)
+    except (OSError, ValueError):
+        return_overflow_files(staging_dir, moved_files, overflow_dir)
+        remove_tree(staging_dir)
+        raise
+    return stats
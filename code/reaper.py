@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+#
+# This module is also executed as a standalone script by the background reaper process.
+# It must therefore only depend on the standard library.
+from os import chmod, walk
+from pathlib import Path
+from shutil import rmtree
+from sys import argv
+from uuid import uuid4
+
+REAPER_LOCK_NAME = ".reaper.lock"
+
+
+def move_to_trash(path: Path, trash_dir: Path) -> Path:
+    """
+    Atomically moves a file or directory out of the way, so it can be deleted later.
+    trash_dir must be on the same filesystem as path.
+
+    :return: the new location of the moved path
+    """
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    trashed_path = trash_dir / f"{path.name}.{uuid4().hex}"
+    path.rename(trashed_path)
+    return trashed_path
+
+
+def make_tree_writable(path: Path) -> None:
+    """
+    overlayfs leaves directories without any permissions behind in its work directory,
+    which would otherwise stop the deletion.
+    """
+    chmod(path, 0o700)
+    for root, dirs, _ in walk(path):
+        for directory in dirs:
+            chmod(Path(root) / directory, 0o700)
+
+
+def remove_tree(path: Path) -> None:
+    if path.is_symlink() or not path.is_dir():
+        path.unlink(missing_ok=True)
+        return
+    try:
+        rmtree(path)
+    except OSError:
+        make_tree_writable(path)
+        rmtree(path, ignore_errors=True)
+
+
+def empty_trash(trash_dir: Path) -> None:
+    """
+    Deletes everything in trash_dir. Only one reaper works on a directory at a time, the others
+    return immediately. The active reaper keeps going until no more entries are left.
+    """
+    from fcntl import flock, LOCK_EX, LOCK_NB
+    if not trash_dir.is_dir():
+        return
+    with (trash_dir / REAPER_LOCK_NAME).open(mode="a") as lock_file:
+        try:
+            flock(lock_file, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            return
+        while True:
+            entries = [entry for entry in trash_dir.iterdir() if entry.name != REAPER_LOCK_NAME]
+            if len(entries) == 0:
+                break
+            for entry in entries:
+                remove_tree(entry)
+            if any(entry.exists() or entry.is_symlink() for entry in entries):
+                # Entries that cannot be deleted are left for a later attempt
+                break
+
+
+def empty_trash_in_background(trash_dir: Path) -> None:
+    """
+    Starts a detached process that empties trash_dir, so the caller does not have to wait for
+    the deletion to finish.
+    """
+    from subprocess import Popen, DEVNULL
+    from sys import executable
+    Popen([executable, str(Path(__file__).resolve()), str(trash_dir)],
+          stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+          start_new_session=True)
+
+
+if __name__ == "__main__":
+    for trash_dir_arg in argv[1:]:
+        empty_trash(Path(trash_dir_arg))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from errno import EXDEV
+from os import walk, lstat
+from pathlib import Path
+from typing import TypedDict
+
+from code.coldstorage import is_version_archived, get_version_archive_path
+from code.mod import get_mod_versions, select_latest_version, parse_version_tag, ModConfig, \
+    ValidModSettings, resolve_base_dir
+from code.paths import get_trash_directory
+from code.reaper import move_to_trash, remove_tree, empty_trash_in_background
+from code.sharedstore import is_shared_version, release_shared_version
+
+
+class PruneCandidate(TypedDict):
+    """
+    a mod version selected for deletion by the retention policy
+    """
+    mod_id: str
+    version_date: str
+    version_sub: str
+    path: Path
+    shared: bool
+
+
+def get_protected_versions(mod_id: str, keep: int) -> set[tuple[str, str]]:
+    """
+    :return: The versions of a mod that the retention policy must not delete. These are the
+             newest keep versions, the latest version and the version pinned in the mod config.
+    """
+    all_versions = sorted((date, sub)
+                          for date, subversions in get_mod_versions(mod_id).items()
+                          for sub in subversions)
+    protected: set[tuple[str, str]] = set(all_versions[-keep:]) if keep > 0 else set(all_versions)
+    latest_version = select_latest_version(mod_id)
+    if latest_version is not None:
+        protected.add(latest_version)
+    pinned_version: str = ModConfig(mod_id).get(ValidModSettings.MOD_VERSION)
+    if pinned_version.lower() != "latest":
+        protected.add(parse_version_tag(pinned_version))
+    return protected
+
+
+def find_prunable_versions(mod_ids: list[str], keep: int) -> list[PruneCandidate]:
+    candidates: list[PruneCandidate] = []
+    for mod_id in mod_ids:
+        protected = get_protected_versions(mod_id, keep)
+        for date, subversions in sorted(get_mod_versions(mod_id).items()):
+            for sub in sorted(subversions):
+                if (date, sub) in protected:
+                    continue
+                path = resolve_base_dir() / 'mods' / mod_id / date / sub
+                if is_version_archived(mod_id, date, sub):
+                    path = get_version_archive_path(mod_id, date, sub)
+                candidates.append(PruneCandidate(mod_id=mod_id,
+                                                 version_date=date,
+                                                 version_sub=sub,
+                                                 path=path,
+                                                 shared=is_shared_version(path)))
+    return candidates
+
+
+def calculate_reclaimable_bytes(candidates: list[PruneCandidate]) -> int:
+    """
+    Only counts data whose every hardlink is part of the pruned versions. Files that were
+    deduplicated into the store are therefore not counted, until the store is cleaned.
+    Shared versions only count, if this instance holds their last reference.
+    """
+    from code.sharedstore import get_shared_store_directory, count_shared_references
+    store_dir = get_shared_store_directory()
+    inodes: dict[tuple[int, int], list[int]] = dict()
+    for candidate in candidates:
+        if candidate["shared"]:
+            if store_dir is None or count_shared_references(store_dir,
+                                                            candidate["mod_id"],
+                                                            candidate["version_date"],
+                                                            candidate["version_sub"]) > 1:
+                continue
+        if candidate["path"].is_file():
+            file_paths = [candidate["path"]]
+        else:
+            file_paths = [Path(root) / file_name
+                          for root, _, files in walk(candidate["path"].resolve())
+                          for file_name in files]
+        for file_path in file_paths:
+            file_stat = lstat(file_path)
+            seen = inodes.setdefault((file_stat.st_dev, file_stat.st_ino),
+                                     [file_stat.st_blocks * 512, file_stat.st_nlink, 0])
+            seen[2] += 1
+    return sum(size for size, nlink, seen in inodes.values() if seen >= nlink)
+
+
+def delete_versions(candidates: list[PruneCandidate]) -> None:
+    """
+    Moves the pruned versions into the trash and deletes them from a background process.
+    The versions disappear from the instance before this function returns.
+    """
+    trash_dir = get_trash_directory(resolve_base_dir())
+    for candidate in candidates:
+        path = candidate["path"]
+        if candidate["shared"]:
+            release_shared_version(path)
+        else:
+            try:
+                move_to_trash(path, trash_dir)
+            except OSError as e:
+                if e.errno != EXDEV:
+                    raise
+                remove_tree(path)
+        date_dir = path.parent
+        if date_dir.is_dir() and not any(date_dir.iterdir()):
+            date_dir.rmdir()
+    empty_trash_in_background(trash_dir)
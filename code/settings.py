@@ -92,6 +92,93 @@ class ValidInstanceSettings(Enum):
                                       int,
                                       30,
                                       [lambda i: i >= 1 and i <= 3600])
+    IMPORT_INCLUDE_PATTERNS = ("importIncludePatterns",
+                               str,
+                               "",
+                               [])
+    IMPORT_EXCLUDE_PATTERNS = ("importExcludePatterns",
+                               str,
+                               "",
+                               [])
+    DEDUPLICATE_ON_IMPORT = ("deduplicateOnImport",
+                             bool,
+                             False,
+                             [],
+                             True)
+    DEDUPLICATION_METHOD = ("deduplicationMethod",
+                            str,
+                            "hardlink",
+                            [lambda s: s in ["hardlink", "reflink"]])
+    SHARED_MOD_STORE = ("sharedModStore",
+                        Path,
+                        None,
+                        [lambda val: val is None or val.is_dir()])
+    RETAINED_VERSIONS = ("retainVersions",
+                         int,
+                         0,
+                         [lambda i: i >= 0])
+    LAYER_COMPACTION = ("compactStableLayers",
+                        bool,
+                        False,
+                        [],
+                        True)
+    COMPACTION_STABLE_DAYS = ("compactionStableDays",
+                              int,
+                              30,
+                              [lambda i: i >= 0])
+    COMPACTION_MINIMUM_LAYERS = ("compactionMinimumLayers",
+                                 int,
+                                 4,
+                                 [lambda i: i >= 2])
+    DEPLOYMENT_BACKEND = ("deploymentBackend",
+                          str,
+                          "overlay",
+                          [lambda s: s in ["overlay", "materialize"]])
+    RECORD_DEPLOY_TIMINGS = ("recordDeployTimings",
+                             bool,
+                             False,
+                             [],
+                             True)
+    RECORD_HISTORY = ("recordHistory",
+                      bool,
+                      False,
+                      [],
+                      True)
+    PREWARM_FILES = ("prewarmFiles",
+                     bool,
+                     False,
+                     [],
+                     True)
+    PREWARM_SIZE_LIMIT_MIB = ("prewarmSizeLimitMiB",
+                              int,
+                              2048,
+                              [lambda i: i >= 0])
+    PREWARM_INCLUDE_PATTERNS = ("prewarmIncludePatterns",
+                                str,
+                                "",
+                                [])
+    PREWARM_EXCLUDE_PATTERNS = ("prewarmExcludePatterns",
+                                str,
+                                "",
+                                [])
+    PREWARM_JOBS = ("prewarmJobs",
+                    int,
+                    4,
+                    [lambda i: i >= 1 and i <= 64])
+    REPORT_OVERFLOW_CHANGES = ("reportOverflowChanges",
+                               bool,
+                               False,
+                               [],
+                               True)
+    SNAPSHOT_OVERFLOW = ("snapshotOverflow",
+                         bool,
+                         False,
+                         [],
+                         True)
+    OVERFLOW_SNAPSHOTS_KEPT = ("overflowSnapshotsKept",
+                               int,
+                               10,
+                               [lambda i: i >= 1])
 
 
 class InstanceSettings:
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from hashlib import sha256
+from pathlib import Path
+from shutil import rmtree
+
+from code.mod import resolve_base_dir, VERSION_ARCHIVE_SUFFIX
+from code.settings import InstanceSettings, ValidInstanceSettings
+from code.tools import current_date
+
+
+def get_shared_store_directory(base_dir: Path | None = None) -> Path | None:
+    """
+    :return: The mod store shared between several instances or None, if this instance keeps all
+             mod versions to itself.
+    """
+    instance_dir = resolve_base_dir(base_dir)
+    store_dir: Path | None = InstanceSettings(instance_dir).get(ValidInstanceSettings.SHARED_MOD_STORE)
+    if store_dir is None:
+        return None
+    if not store_dir.is_absolute():
+        store_dir = instance_dir / store_dir
+    return store_dir.resolve()
+
+
+def get_shared_version_path(store_dir: Path, mod_id: str, version_date: str, version_sub: str) -> Path:
+    return store_dir / 'mods' / mod_id / version_date / version_sub
+
+
+def get_reference_directory(store_dir: Path, mod_id: str, version_date: str, version_sub: str) -> Path:
+    return store_dir / 'refs' / mod_id / version_date / version_sub
+
+
+def get_instance_reference_name(base_dir: Path | None = None) -> str:
+    return sha256(str(resolve_base_dir(base_dir)).encode()).hexdigest()[:16]
+
+
+def is_shared_version(version_path: Path) -> bool:
+    """
+    Versions provided by a shared store are symbolic links into the store's mods directory.
+    """
+    return version_path.is_symlink()
+
+
+def is_adopted_version(store_dir: Path,
+                       mod_id: str,
+                       version_date: str,
+                       version_sub: str,
+                       base_dir: Path | None = None) -> bool:
+    """
+    :return: whether this instance links to the version in the shared store. A local version
+             with the same name does not count.
+    """
+    version_path = resolve_base_dir(base_dir) / 'mods' / mod_id / version_date / version_sub
+    shared_path = get_shared_version_path(store_dir, mod_id, version_date, version_sub)
+    return is_shared_version(version_path) and version_path.resolve() == shared_path.resolve()
+
+
+def count_shared_references(store_dir: Path, mod_id: str, version_date: str, version_sub: str) -> int:
+    reference_dir = get_reference_directory(store_dir, mod_id, version_date, version_sub)
+    return len(list(reference_dir.iterdir())) if reference_dir.is_dir() else 0
+
+
+def add_shared_reference(store_dir: Path,
+                         mod_id: str,
+                         version_date: str,
+                         version_sub: str,
+                         base_dir: Path | None = None) -> None:
+    reference_dir = get_reference_directory(store_dir, mod_id, version_date, version_sub)
+    reference_dir.mkdir(parents=True, exist_ok=True)
+    (reference_dir / get_instance_reference_name(base_dir)).write_text(
+        str(resolve_base_dir(base_dir)) + "\n", encoding="UTF-8")
+
+
+def remove_empty_parents(directory: Path, stop_at: Path) -> None:
+    while directory != stop_at and directory.is_dir() and not any(directory.iterdir()):
+        directory.rmdir()
+        directory = directory.parent
+
+
+def release_shared_version(version_path: Path, base_dir: Path | None = None) -> None:
+    """
+    Removes this instance's link to a shared version and drops its reference. The version itself
+    is deleted from the store once no instance references it anymore.
+    """
+    store_dir = get_shared_store_directory(base_dir)
+    version_sub = version_path.name
+    version_date = version_path.parent.name
+    mod_id = version_path.parent.parent.name
+    version_path.unlink(missing_ok=True)
+    if store_dir is None:
+        return
+    reference_dir = get_reference_directory(store_dir, mod_id, version_date, version_sub)
+    (reference_dir / get_instance_reference_name(base_dir)).unlink(missing_ok=True)
+    if count_shared_references(store_dir, mod_id, version_date, version_sub) == 0:
+        shared_version = get_shared_version_path(store_dir, mod_id, version_date, version_sub)
+        rmtree(shared_version, ignore_errors=True)
+        remove_empty_parents(shared_version.parent, store_dir / 'mods')
+        remove_empty_parents(reference_dir, store_dir / 'refs')
+
+
+def release_shared_versions_of_mod(mod_id: str, base_dir: Path | None = None) -> None:
+    mod_dir = resolve_base_dir(base_dir) / 'mods' / mod_id
+    if not mod_dir.is_dir():
+        return
+    for date_dir in mod_dir.iterdir():
+        if date_dir.is_dir() and not date_dir.is_symlink():
+            for version_path in date_dir.iterdir():
+                if is_shared_version(version_path):
+                    release_shared_version(version_path, base_dir)
+
+
+def create_shared_mod_space(mod_id: str, store_dir: Path, base_dir: Path | None = None) -> Path:
+    """
+    Reserves a new version of a mod in the shared store and links it into the instance.
+    The subversion is chosen so that it is free in both the store and the instance.
+
+    :return: the instance-side path of the new version
+    """
+    version_date = current_date()
+    local_date_dir = resolve_base_dir(base_dir) / 'mods' / mod_id / version_date
+    shared_date_dir = store_dir / 'mods' / mod_id / version_date
+    local_date_dir.mkdir(parents=True, exist_ok=True)
+    shared_date_dir.mkdir(parents=True, exist_ok=True)
+    while True:
+        used_subversions = {int(p.name.removesuffix(VERSION_ARCHIVE_SUFFIX))
+                            for d in [local_date_dir, shared_date_dir] for p in d.iterdir()
+                            if p.name.removesuffix(VERSION_ARCHIVE_SUFFIX).isdigit()}
+        version_sub = str(max(used_subversions, default=-1) + 1).zfill(2)
+        try:
+            # mkdir without exist_ok doubles as a lock against other instances importing
+            (shared_date_dir / version_sub).mkdir()
+            break
+        except FileExistsError:
+            continue
+    local_version = local_date_dir / version_sub
+    local_version.symlink_to(shared_date_dir / version_sub, target_is_directory=True)
+    add_shared_reference(store_dir, mod_id, version_date, version_sub, base_dir)
+    return local_version
+
+
+def adopt_shared_version(mod_id: str,
+                         version_date: str,
+                         version_sub: str,
+                         base_dir: Path | None = None) -> Path:
+    """
+    Makes a version from the shared store available in this instance without copying any files.
+    """
+    store_dir = get_shared_store_directory(base_dir)
+    if store_dir is None:
+        raise ValueError("This instance is not configured to use a shared mod store")
+    shared_version = get_shared_version_path(store_dir, mod_id, version_date, version_sub)
+    if not shared_version.is_dir():
+        raise ValueError(f"Version {version_date}/{version_sub} of {mod_id} does not exist in the "
+                         "shared store")
+    local_version = resolve_base_dir(base_dir) / 'mods' / mod_id / version_date / version_sub
+    if local_version.is_symlink() and local_version.resolve() == shared_version.resolve():
+        return local_version
+    if (local_version.exists() or local_version.is_symlink()
+            or local_version.with_name(version_sub + VERSION_ARCHIVE_SUFFIX).exists()):
+        raise ValueError(f"A different version {version_date}/{version_sub} of {mod_id} already "
+                         "exists in this instance")
+    local_version.parent.mkdir(parents=True, exist_ok=True)
+    local_version.symlink_to(shared_version, target_is_directory=True)
+    add_shared_reference(store_dir, mod_id, version_date, version_sub, base_dir)
+    return local_version
+
+
+def get_shared_mod_versions(store_dir: Path) -> dict[str, dict[str, set[str]]]:
+    results: dict[str, dict[str, set[str]]] = dict()
+    shared_mods_dir = store_dir / 'mods'
+    if not shared_mods_dir.is_dir():
+        return results
+    for mod_dir in sorted(filter(lambda p: p.is_dir(), shared_mods_dir.iterdir())):
+        for date_dir in sorted(filter(lambda p: p.is_dir(), mod_dir.iterdir())):
+            subversions = {p.name for p in date_dir.iterdir() if p.is_dir()}
+            if len(subversions) > 0:
+                results.setdefault(mod_dir.name, dict())[date_dir.name] = subversions
+    return results
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from datetime import datetime
+from json import dumps, loads, JSONDecodeError
+from os import scandir, link, symlink, readlink, mknod, makedev, listxattr, getxattr, setxattr
+from pathlib import Path
+from shutil import copy2
+from sys import stderr
+from stat import S_ISCHR, S_ISDIR, S_ISLNK, S_ISREG, S_IFCHR
+from tempfile import mkdtemp
+from time import monotonic
+from typing import TypedDict
+
+from code.mod import resolve_base_dir
+from code.paths import get_meta_directory, get_trash_directory, clone_file
+from code.reaper import move_to_trash, remove_tree, empty_trash_in_background
+from code.settings import get_instance_settings, ValidInstanceSettings
+
+SNAPSHOT_FILES_DIR = "files"
+SNAPSHOT_MANIFEST = "manifest.json"
+
+
+class SnapshotManifest(TypedDict):
+    """
+    Describes a snapshot of the overflow directory. The files are stored below the files
+    directory of the snapshot. Whiteouts and the extended attributes overlayfs uses to mark
+    directories are recorded here, because they cannot always be recreated by a normal user.
+    """
+    id: str
+    time: str
+    reason: str
+    seconds: float
+    # relative path -> (size, modification time in nanoseconds, inode in the overflow directory)
+    files: dict[str, tuple[int, int, int]]
+    # relative path -> target of the symbolic link
+    symlinks: dict[str, str]
+    directories: list[str]
+    whiteouts: list[str]
+    overlay_xattrs: dict[str, dict[str, str]]
+    linked_files: int
+    cloned_files: int
+    copied_files: int
+    copied_bytes: int
+
+
+def get_snapshot_directory(base_dir: Path | None = None) -> Path:
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'snapshots'
+
+
+def read_snapshot_manifest(snapshot_dir: Path) -> SnapshotManifest | None:
+    try:
+        return loads((snapshot_dir / SNAPSHOT_MANIFEST).read_text(encoding="UTF-8"))
+    except (FileNotFoundError, JSONDecodeError):
+        return None
+
+
+def list_snapshots(base_dir: Path | None = None) -> list[SnapshotManifest]:
+    """
+    :return: the complete snapshots, oldest first. Snapshots without a manifest were interrupted.
+    """
+    snapshot_root = get_snapshot_directory(base_dir)
+    if not snapshot_root.is_dir():
+        return []
+    manifests = [read_snapshot_manifest(snapshot_dir)
+                 for snapshot_dir in sorted(snapshot_root.iterdir())
+                 if not snapshot_dir.name.startswith(".")]
+    return [manifest for manifest in manifests if manifest is not None]
+
+
+def read_overlay_xattrs(path: str) -> dict[str, str]:
+    """
+    :return: the extended attributes overlayfs stores on entries of the upper directory,
+             e.g. the one marking a directory as opaque, with hex encoded values
+    """
+    try:
+        return {name: getxattr(path, name, follow_symlinks=False).hex()
+                for name in listxattr(path, follow_symlinks=False)
+                if ".overlay." in name}
+    except OSError:
+        return dict()
+
+
+def is_unchanged(manifest: SnapshotManifest, previous: SnapshotManifest | None) -> bool:
+    return (previous is not None
+            and manifest["linked_files"] == len(manifest["files"])
+            and manifest["files"].keys() == previous["files"].keys()
+            and manifest["symlinks"] == previous.get("symlinks")
+            and sorted(manifest["directories"]) == sorted(previous.get("directories", []))
+            and manifest["whiteouts"] == previous["whiteouts"]
+            and manifest["overlay_xattrs"] == previous["overlay_xattrs"])
+
+
+def create_snapshot(overflow_dir: Path, reason: str) -> SnapshotManifest | None:
+    """
+    Snapshots the overflow directory. Files that did not change since the previous snapshot
+    are hardlinked to its copy, all others are cloned with a reflink where the filesystem
+    supports it and copied otherwise. The snapshot therefore only needs space for the changes.
+    Files are never hardlinked to the overflow directory itself, because the game changes those
+    in place.
+
+    :return: the manifest of the new snapshot or None, if nothing changed since the previous
+             one. No snapshot is stored in that case, so that the retention count is not used
+             up by identical snapshots.
+    """
+    start = monotonic()
+    snapshot_root = get_snapshot_directory()
+    snapshot_root.mkdir(parents=True, exist_ok=True)
+    previous = list_snapshots()
+    previous_manifest = previous[-1] if len(previous) > 0 else None
+    previous_files_dir = (snapshot_root / previous_manifest["id"] / SNAPSHOT_FILES_DIR
+                          if previous_manifest is not None else None)
+    # The snapshot is built under a hidden name, so an interrupted one is never listed
+    staging_dir = Path(mkdtemp(prefix=".creating-", dir=snapshot_root))
+    files_dir = staging_dir / SNAPSHOT_FILES_DIR
+    files_dir.mkdir()
+    snapshot_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    manifest = SnapshotManifest(id=snapshot_id,
+                                time=datetime.now().astimezone().isoformat(timespec="seconds"),
+                                reason=reason, seconds=0.0, files=dict(), symlinks=dict(),
+                                directories=[], whiteouts=[],
+                                overlay_xattrs=dict(), linked_files=0, cloned_files=0,
+                                copied_files=0, copied_bytes=0)
+    reflinks_supported = True
+    pending_dirs = [""]
+    try:
+        while len(pending_dirs) > 0:
+            relative_dir = pending_dirs.pop()
+            with scandir(overflow_dir / relative_dir) as entries:
+                for entry in entries:
+                    relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                    destination = files_dir / relative_path
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    xattrs = read_overlay_xattrs(entry.path)
+                    if len(xattrs) > 0:
+                        manifest["overlay_xattrs"][relative_path] = xattrs
+                    if S_ISDIR(entry_stat.st_mode):
+                        destination.mkdir(mode=entry_stat.st_mode & 0o7777)
+                        manifest["directories"].append(relative_path)
+                        pending_dirs.append(relative_path)
+                    elif S_ISLNK(entry_stat.st_mode):
+                        manifest["symlinks"][relative_path] = readlink(entry.path)
+                        symlink(manifest["symlinks"][relative_path], destination)
+                    elif S_ISCHR(entry_stat.st_mode) and entry_stat.st_rdev == 0:
+                        manifest["whiteouts"].append(relative_path)
+                    elif S_ISREG(entry_stat.st_mode):
+                        identity = (entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ino)
+                        manifest["files"][relative_path] = identity
+                        if previous_manifest is not None \
+                                and tuple(previous_manifest["files"].get(relative_path, ())) \
+                                == identity:
+                            try:
+                                link(previous_files_dir / relative_path, destination)
+                                manifest["linked_files"] += 1
+                                continue
+                            except OSError:
+                                pass
+                        if reflinks_supported:
+                            try:
+                                reflinks_supported = clone_file(Path(entry.path), destination)
+                            except OSError:
+                                reflinks_supported = False
+                            if reflinks_supported:
+                                manifest["cloned_files"] += 1
+                                continue
+                        copy2(entry.path, destination)
+                        manifest["copied_files"] += 1
+                        manifest["copied_bytes"] += entry_stat.st_size
+    except BaseException:
+        remove_tree(staging_dir)
+        raise
+    manifest["seconds"] = monotonic() - start
+    if is_unchanged(manifest, previous_manifest):
+        remove_tree(staging_dir)
+        return None
+    (staging_dir / SNAPSHOT_MANIFEST).write_text(dumps(manifest, separators=(",", ":")),
+                                                 encoding="UTF-8")
+    staging_dir.rename(snapshot_root / snapshot_id)
+    return manifest
+
+
+def snapshot_overflow(overflow_dir: Path, reason: str) -> None:
+    """
+    Creates a snapshot and prunes the oldest ones beyond the configured number
+    """
+    manifest = create_snapshot(overflow_dir, reason)
+    if manifest is None:
+        return
+    print(f"Snapshot {manifest['id']} of the overflow directory took "
+          f"{manifest['seconds'] * 1000:.0f} ms ({manifest['linked_files']} unchanged, "
+          f"{manifest['cloned_files']} cloned, {manifest['copied_files']} copied files)",
+          file=stderr)
+    prune_snapshots(get_instance_settings().get(ValidInstanceSettings.OVERFLOW_SNAPSHOTS_KEPT))
+
+
+def prune_snapshots(keep: int) -> int:
+    """
+    Deletes all but the newest keep snapshots in the background.
+
+    :return: the number of deleted snapshots
+    """
+    snapshot_root = get_snapshot_directory()
+    snapshots = list_snapshots()
+    trash_dir = get_trash_directory(resolve_base_dir())
+    outdated = snapshots[:-keep] if keep > 0 else snapshots
+    for manifest in outdated:
+        move_to_trash(snapshot_root / manifest["id"], trash_dir)
+    # Also clean up after snapshots that were interrupted
+    for interrupted in snapshot_root.glob(".creating-*"):
+        move_to_trash(interrupted, trash_dir)
+    if len(outdated) > 0:
+        empty_trash_in_background(trash_dir)
+    return len(outdated)
+
+
+def restore_snapshot(snapshot_id: str, overflow_dir: Path) -> SnapshotManifest:
+    """
+    Replaces the contents of the overflow directory with the snapshot. The restored tree is
+    built next to the overflow directory and swapped in by renaming, so an interrupted restore
+    leaves the overflow directory untouched. Restored files are reflinks or copies, never
+    hardlinks to the snapshot.
+    """
+    from code.deployer import are_paths_on_same_filesystem
+    snapshot_dir = get_snapshot_directory() / snapshot_id
+    manifest = read_snapshot_manifest(snapshot_dir)
+    if manifest is None:
+        raise ValueError(f"There is no snapshot {snapshot_id}")
+    files_dir = snapshot_dir / SNAPSHOT_FILES_DIR
+    staging_dir = Path(mkdtemp(prefix=f".{overflow_dir.name}.restoring-", dir=overflow_dir.parent))
+    try:
+        staging_dir.chmod(overflow_dir.stat().st_mode & 0o7777)
+        pending_dirs = [""]
+        while len(pending_dirs) > 0:
+            relative_dir = pending_dirs.pop()
+            with scandir(files_dir / relative_dir) as entries:
+                for entry in entries:
+                    relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                    destination = staging_dir / relative_path
+                    if entry.is_dir(follow_symlinks=False):
+                        destination.mkdir(mode=entry.stat(follow_symlinks=False).st_mode & 0o7777)
+                        pending_dirs.append(relative_path)
+                    elif entry.is_symlink():
+                        symlink(readlink(entry.path), destination)
+                    else:
+                        try:
+                            cloned = clone_file(Path(entry.path), destination)
+                        except OSError:
+                            cloned = False
+                        if not cloned:
+                            copy2(entry.path, destination)
+        for relative_path in manifest["whiteouts"]:
+            # Linux allows everybody to create whiteouts, which are character devices 0:0
+            mknod(staging_dir / relative_path, S_IFCHR, makedev(0, 0))
+        for relative_path, xattrs in manifest["overlay_xattrs"].items():
+            for name, value in xattrs.items():
+                setxattr(staging_dir / relative_path, name, bytes.fromhex(value),
+                         follow_symlinks=False)
+    except BaseException:
+        remove_tree(staging_dir)
+        raise
+    trash_dir = get_trash_directory(resolve_base_dir())
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    if are_paths_on_same_filesystem(overflow_dir, trash_dir):
+        move_to_trash(overflow_dir, trash_dir)
+        staging_dir.rename(overflow_dir)
+        empty_trash_in_background(trash_dir)
+    else:
+        replaced_dir = overflow_dir.with_name(staging_dir.name.replace(".restoring-", ".replaced-"))
+        overflow_dir.rename(replaced_dir)
+        staging_dir.rename(overflow_dir)
+        remove_tree(replaced_dir)
+    return manifest
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from copy import deepcopy
+from functools import wraps
+from typing import Any, Callable, TypeVar
+
+TFunction = TypeVar("TFunction", bound=Callable)
+
+# Results of functions reading the state of the instance by function and arguments. Caching is
+# only enabled in the modfs daemon, which clears the cache whenever the instance changes. A
+# normal invocation of modfs is too short-lived to benefit from it.
+state_cache: dict[tuple, Any] | None = None
+
+
+def enable_state_cache() -> None:
+    global state_cache
+    state_cache = dict()
+
+
+def invalidate_state_cache() -> None:
+    if state_cache is not None:
+        state_cache.clear()
+
+
+def invalidate_cached_function(function_name: str, first_argument: Any = None) -> None:
+    """
+    Forgets the cached results of one function, only those for first_argument if it is given
+    """
+    if state_cache is None:
+        return
+    for key in list(state_cache.keys()):
+        name, args, _ = key
+        if name == function_name and (first_argument is None
+                                      or (len(args) > 0 and args[0] == first_argument)):
+            del state_cache[key]
+
+
+def cached_state(function: TFunction) -> TFunction:
+    """
+    Caches the results of the decorated function while the state cache is enabled. Callers
+    receive copies, so they may modify the results.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if state_cache is None:
+            return function(*args, **kwargs)
+        key = (function.__qualname__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return function(*args, **kwargs)
+        if key not in state_cache:
+            state_cache[key] = function(*args, **kwargs)
+        return deepcopy(state_cache[key])
+    return wrapper
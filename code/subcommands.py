@@ -6,23 +6,27 @@
 from collections import OrderedDict
 from pathlib import Path
 from sys import stderr, stdout
-from tempfile import TemporaryDirectory
 from typing import Callable, Literal, TypedDict, NotRequired, Required
 from os import get_terminal_size
 from functools import reduce
 from math import ceil
 from pprint import pp
+from time import monotonic
 
 from code.mod import mod_change_activation, ModConfig, ValidModSettings, mod_exists, \
-    process_mod_subdir_argument, get_mod_last_update_check
+    get_mod_last_update_check
 from code.creation import create_mod_space, recursive_lower_case_rename, ask_for_path, \
-    transfer_mod_files, extract_archive
-from code.deployer import run_in_filesystem, are_paths_on_same_filesystem
+    get_import_filter_patterns, install_mod_files, write_import_metadata
+from code.coldstorage import is_version_archived, restore_versions
+from code.dedupe import deduplicate_after_import
+from code.deployer import run_in_filesystem, are_paths_on_same_filesystem, \
+    resolve_deployment_layers, get_or_create_overflow_dir, get_or_create_work_dir
 from code.mod import get_mod_ids, get_mod_versions, select_latest_version, validate_mod_id, \
     mod_at_version_limit, write_mod_priority, read_mod_priority, build_mod_order, \
     parse_mod_conflicts, version_exists, parse_version_tag
+from code.progress import ProgressReporter
 from code.settings import InstanceSettings, ValidInstanceSettings, get_instance_settings
-from code.tools import current_date
+from code.tools import current_date, format_byte_size
 
 
 class SubcommandArgDict(TypedDict, total=False):
@@ -30,11 +34,14 @@ class SubcommandArgDict(TypedDict, total=False):
     type information for cli argument information that may be passed to subcommands of modfs
     """
     show_args: Required[bool]
+    profile: Required[bool]
+    profile_output: Required[Path | None]
+    profile_syscalls: Required[bool]
     mod_id: Required[str]
     instance: Required[Path]
     version_string: NotRequired[str]
     subcommand: NotRequired[str]
-    listtype: NotRequired[Literal["mods", "conflicts", "versions", "priority", "updatecheck"]]
+    listtype: NotRequired[Literal["mods", "conflicts", "versions", "priority", "updatecheck", "shared"]]
     all: NotRequired[bool]
     preserve_source: NotRequired[bool]
     subdir: NotRequired[str]
@@ -42,6 +49,10 @@ class SubcommandArgDict(TypedDict, total=False):
     set_author: NotRequired[str]
     set_name: NotRequired[str]
     set_link: NotRequired[str]
+    include: NotRequired[list[str]]
+    exclude: NotRequired[list[str]]
+    batch: NotRequired[Path | None]
+    jobs: NotRequired[int]
     repairaction: NotRequired[str]
     modids: NotRequired[list[str]]
     gamefiles: NotRequired[bool]
@@ -64,6 +75,19 @@ class SubcommandArgDict(TypedDict, total=False):
     only_enabled: NotRequired[bool]
     only_disabled: NotRequired[bool]
     command: NotRequired[str]
+    keep: NotRequired[int | None]
+    dry_run: NotRequired[bool]
+    yes: NotRequired[bool]
+    refresh: NotRequired[bool]
+    read_only: NotRequired[bool]
+    timings: NotRequired[bool]
+    prewarm: NotRequired[bool]
+    patterns: NotRequired[list[str]]
+    snapshotaction: NotRequired[Literal["create", "list", "restore"]]
+    snapshot_id: NotRequired[str]
+    format: NotRequired[str]
+    subcommand_filter: NotRequired[str | None]
+    idle_timeout: NotRequired[float]
 
 
 def subcommand_list(args: SubcommandArgDict) -> None:
@@ -140,6 +164,8 @@ def subcommand_list(args: SubcommandArgDict) -> None:
                                       else is_latest)
                     if is_selected_ver:
                         tags.add("selected")
+                    if is_version_archived(mod, date, subver):
+                        tags.add("archived")
                     print(ver_str, *tags)
     elif args["listtype"] == "priority":
         for mod_id in read_mod_priority().keys():
@@ -151,7 +177,7 @@ def subcommand_list(args: SubcommandArgDict) -> None:
             print(mod_id)
     elif args["listtype"] == "conflicts":
         priority_list = read_mod_priority().keys()
-        for mods, files in parse_mod_conflicts().items():
+        for mods, files in parse_mod_conflicts(show_progress=True).items():
             print(str(sorted(set(mods))) + " ➔ " + list(filter(lambda m: m in mods, priority_list))[-1])
             for file in files:
                 print((" " * 4) + str(file))
@@ -188,29 +214,47 @@ def subcommand_list(args: SubcommandArgDict) -> None:
             print((date + ":") if date is not None else "Never:")
             for mod in sorted(mods):
                 print((12 * " ") + mod)
+    elif args["listtype"] == "shared":
+        from code.sharedstore import get_shared_store_directory, get_shared_mod_versions, \
+            count_shared_references, is_adopted_version
+        store_dir = get_shared_store_directory()
+        if store_dir is None:
+            print("This instance does not use a shared mod store. See the sharedModStore setting.",
+                  file=stderr)
+            exit(1)
+        for mod, versions in get_shared_mod_versions(store_dir).items():
+            print(f"{mod}:")
+            for date, subversions in sorted(versions.items()):
+                for subver in sorted(subversions):
+                    tags: set[str] = {f"refs={count_shared_references(store_dir, mod, date, subver)}"}
+                    if is_adopted_version(store_dir, mod, date, subver):
+                        tags.add("adopted")
+                    print(f"  {date}/{subver}", *sorted(tags))
 
 
-def subcommand_run(args: SubcommandArgDict) -> None:
-    """
-
-    :param args:
-    :type args:
-    """
-    deployment_directory: Path | None = InstanceSettings(args["instance"]).get(
+def get_deployment_directory(instance: Path) -> Path:
+    deployment_directory: Path | None = InstanceSettings(instance).get(
         ValidInstanceSettings.DEPLOYMENT_TARGET_DIR)
     if deployment_directory is None:
-        from sys import stderr
         print("""
         No deployment directory has been configured for this instance. Aborting deployment.
         """.strip(), file=stderr)
         exit(1)
-    if not deployment_directory.is_absolute():
-        deployment_directory = (args["instance"] / deployment_directory).resolve()
+    # Mounts are listed by their canonical path, which may differ from the configured one,
+    # e.g. if the game is installed behind a symbolic link
+    return (instance / deployment_directory).resolve()
+
+
+def get_deployment_layers(instance: Path) -> list[Path]:
+    """
+    :return: the directories of all enabled mods in order of increasing priority
+    """
     mods_to_deploy: OrderedDict[str, tuple[str, str]] = OrderedDict()
     for mod in read_mod_priority().keys():
-        if not ModConfig(mod, args["instance"]).get(ValidModSettings.ENABLED):
+        mod_config = ModConfig(mod, instance).get_all()
+        if not mod_config[ValidModSettings.ENABLED.key]:
             continue
-        version_conf: str = ModConfig(mod).get(ValidModSettings.MOD_VERSION)
+        version_conf: str = mod_config[ValidModSettings.MOD_VERSION.key]
         if version_conf.lower() == "latest":
             version_to_use = select_latest_version(mod)
         else:
@@ -218,7 +262,172 @@ def subcommand_run(args: SubcommandArgDict) -> None:
         if version_to_use is None:
             continue
         mods_to_deploy[mod] = version_to_use
-    run_in_filesystem(deployment_directory, mods_to_deploy, args["command"])
+    archived_versions = [(mod, date, sub) for mod, (date, sub) in mods_to_deploy.items()
+                         if is_version_archived(mod, date, sub)]
+    if len(archived_versions) > 0:
+        print(f"Restoring {len(archived_versions)} versions from cold storage...", file=stderr)
+        try:
+            restore_versions(archived_versions)
+        except ValueError as e:
+            print(e, file=stderr)
+            exit(1)
+    if get_instance_settings().get(ValidInstanceSettings.LAYER_COMPACTION):
+        from code.compaction import compact_deployment_layers
+        from code.deployer import get_layers_in_use
+        return compact_deployment_layers(mods_to_deploy,
+                                         get_layers_in_use(get_deployment_directory(instance)))
+    return resolve_deployment_layers(mods_to_deploy)
+
+
+def deploy_materialized(deployment_directory: Path, layers: list[Path]) -> None:
+    from code.deployer import lock_instance
+    from code.materialize import materialize_deployment
+    deploy_start = monotonic()
+    try:
+        # Concurrent runs would otherwise change the same files and manifest at the same time
+        with lock_instance():
+            stats = materialize_deployment(deployment_directory, layers,
+                                           get_or_create_overflow_dir())
+    except (OSError, ValueError) as e:
+        print(f"Deployment failed: {e}", file=stderr)
+        exit(1)
+    print(f"Deployed {len(layers)} layers in {monotonic() - deploy_start:.1f}s: "
+          f"{stats['placed']} files placed, {stats['removed']} removed, "
+          f"{stats['unchanged']} unchanged, {stats['backed_up']} game files backed up, "
+          f"{stats['restored']} restored, {stats['preserved']} changed files moved to the "
+          "overflow directory", file=stderr)
+
+
+def prewarm_deployed_files(layers: list[Path], deployed_dir: Path | None = None) -> float:
+    """
+    Loads the files of the deployment into the page cache as configured by the prewarm settings.
+
+    :return: the time it took in seconds
+    """
+    from code.prewarm import prewarm_deployment
+    from code.tools import split_pattern_list
+    settings = get_instance_settings()
+    stats = prewarm_deployment(
+        layers,
+        size_limit=settings.get(ValidInstanceSettings.PREWARM_SIZE_LIMIT_MIB) * 1024 * 1024,
+        include_patterns=split_pattern_list(
+            settings.get(ValidInstanceSettings.PREWARM_INCLUDE_PATTERNS)),
+        exclude_patterns=split_pattern_list(
+            settings.get(ValidInstanceSettings.PREWARM_EXCLUDE_PATTERNS)),
+        max_workers=settings.get(ValidInstanceSettings.PREWARM_JOBS),
+        deployed_dir=deployed_dir)
+    print(f"Prewarmed {stats['files']} files ({format_byte_size(stats['bytes'])}) "
+          f"in {stats['seconds']:.2f}s", file=stderr)
+    if stats["skipped_files"] > 0:
+        print(f"Skipped {stats['skipped_files']} files exceeding the limit of "
+              f"{settings.get(ValidInstanceSettings.PREWARM_SIZE_LIMIT_MIB)} MiB", file=stderr)
+    return stats["seconds"]
+
+
+def subcommand_run(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.deployplan import load_deploy_plan, save_deploy_plan
+    from code.journal import sync_journal
+    from code.timings import PhaseTimer
+    timer = None
+    if args["timings"] or get_instance_settings().get(ValidInstanceSettings.RECORD_DEPLOY_TIMINGS):
+        timer = PhaseTimer()
+    instance_dir: Path = args["instance"].resolve()
+    plan_start = monotonic()
+    journal = sync_journal(instance_dir)
+    plan = load_deploy_plan(instance_dir, journal)
+    if plan is None:
+        plan = save_deploy_plan(instance_dir,
+                                target_dir=get_deployment_directory(args["instance"]),
+                                layers=get_deployment_layers(args["instance"]),
+                                overflow_dir=get_or_create_overflow_dir(),
+                                work_dir=get_or_create_work_dir(),
+                                journal=journal)
+    if timer is not None:
+        timer.add("plan", monotonic() - plan_start)
+    deployment_directory = Path(plan["target"]).resolve()
+    layers = [Path(layer) for layer in plan["layers"]]
+    if get_instance_settings().get(ValidInstanceSettings.DEPLOYMENT_BACKEND) == "materialize":
+        if args["read_only"]:
+            print("Read-only sessions require the overlay deployment backend", file=stderr)
+            exit(1)
+        if len(args["command"]) == 0:
+            print("No command was given to run", file=stderr)
+            exit(1)
+        from code.timings import append_timing_record, print_timings
+        materialize_start = monotonic()
+        deploy_materialized(deployment_directory, layers)
+        if args["prewarm"] or get_instance_settings().get(ValidInstanceSettings.PREWARM_FILES):
+            prewarm_seconds = prewarm_deployed_files(layers, deployed_dir=deployment_directory)
+            if timer is not None:
+                timer.add("prewarm", prewarm_seconds)
+            materialize_start += prewarm_seconds
+        from subprocess import call
+        print("Executing: " + " ".join(args["command"]), file=stderr)
+        command_start = monotonic()
+        exit_code = call(args["command"])
+        if timer is not None:
+            timer.add("materialize", command_start - materialize_start)
+            timer.add("command", monotonic() - command_start)
+            details = {"backend": "materialize", "layers": len(layers)}
+            append_timing_record({"event": "run", "phases": timer.phases, "exit_code": exit_code}
+                                 | details)
+            if args["timings"]:
+                print_timings(timer, details)
+        exit(exit_code)
+    if args["prewarm"] or get_instance_settings().get(ValidInstanceSettings.PREWARM_FILES):
+        prewarm_seconds = prewarm_deployed_files(layers)
+        if timer is not None:
+            timer.add("prewarm", prewarm_seconds)
+    run_in_filesystem(deployment_directory, layers, args["command"],
+                      overflow_dir=Path(plan["overflow_dir"]),
+                      work_dir=Path(plan["work_dir"]),
+                      plan_key=plan["key"],
+                      read_only=args["read_only"],
+                      timer=timer,
+                      show_timings=args["timings"],
+                      report_changes=get_instance_settings().get(
+                          ValidInstanceSettings.REPORT_OVERFLOW_CHANGES),
+                      snapshot_changes=get_instance_settings().get(
+                          ValidInstanceSettings.SNAPSHOT_OVERFLOW))
+
+
+def subcommand_deploy(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    deploy_materialized(get_deployment_directory(args["instance"]),
+                        get_deployment_layers(args["instance"]))
+
+
+def subcommand_undeploy(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.materialize import remove_materialized_deployment, read_manifest
+    from code.deployer import lock_instance
+    with lock_instance():
+        stats = remove_materialized_deployment(get_or_create_overflow_dir())
+    if stats is None:
+        print("Nothing is deployed", file=stderr)
+        return
+    print(f"Removed {stats['removed']} files and restored {stats['restored']} game files",
+          file=stderr)
+    if stats["preserved"] > 0:
+        print(f"Moved {stats['preserved']} files changed since the deployment into the overflow "
+              "directory", file=stderr)
+    if read_manifest() is not None:
+        print("Some game files could not be restored, because other files took their place. "
+              "Run undeploy again after removing them.", file=stderr)
+        exit(1)
 
 
 def subcommand_import(args: SubcommandArgDict) -> None:
@@ -228,6 +437,32 @@ def subcommand_import(args: SubcommandArgDict) -> None:
     :type args:
     """
     only_copy: bool = args["preserve_source"]
+    include_patterns, exclude_patterns = get_import_filter_patterns(args["include"], args["exclude"])
+    if args["batch"] is not None:
+        if args["mod_id"] is not None or args["import_path"] is not None:
+            print("--batch cannot be combined with a mod id and import path", file=stderr)
+            exit(1)
+        from code.batchimport import read_import_manifest, run_batch_import, print_batch_results
+        try:
+            entries = read_import_manifest(args["batch"], default_subdir=args["subdir"])
+        except (OSError, ValueError) as e:
+            print(f"Failed to read import manifest: {e}", file=stderr)
+            exit(1)
+        from time import monotonic
+        batch_start = monotonic()
+        results = run_batch_import(entries,
+                                   only_copy=only_copy,
+                                   include_patterns=include_patterns,
+                                   exclude_patterns=exclude_patterns,
+                                   max_workers=args["jobs"])
+        print_batch_results(results, monotonic() - batch_start)
+        if any(result["error"] is not None for result in results):
+            exit(1)
+        return
+    elif args["mod_id"] is None or args["import_path"] is None:
+        print("You must specify a mod id and import path, or use --batch", file=stderr)
+        exit(1)
+
     mod_id: str = args["mod_id"]
     if not validate_mod_id(mod_id):
         print("A mod id may only contain lower case letters a-z, digits 0-9 and the minus sign",
@@ -244,54 +479,155 @@ def subcommand_import(args: SubcommandArgDict) -> None:
 
     source: Path = args["import_path"].resolve(strict=True)
     raw_destination = create_mod_space(mod_id).resolve()
-    processed_subdir = process_mod_subdir_argument(args["subdir"],
-                                                   mod_id=mod_id,
-                                                   src_dir=source)
-    destination: Path = (raw_destination / processed_subdir).resolve()
-    if not destination.is_relative_to(raw_destination):
-        print("Subdirectories must not break out of the assigned mod folder!",
+    try:
+        with ProgressReporter("Importing") as progress:
+            destination, transfer_stats = install_mod_files(mod_id, source, raw_destination,
+                                                            subdir=args["subdir"],
+                                                            only_copy=only_copy,
+                                                            include_patterns=include_patterns,
+                                                            exclude_patterns=exclude_patterns,
+                                                            progress=progress)
+    except ValueError as e:
+        print(e, file=stderr)
+        exit(1)
+    print(f"Successfully installed {mod_id} into {destination}")
+    print(f"Transferred {transfer_stats['files_transferred']} files "
+          f"({format_byte_size(transfer_stats['bytes_transferred'])})")
+    if transfer_stats["files_skipped"] > 0:
+        print(f"Skipped {transfer_stats['files_skipped']} files "
+              f"({format_byte_size(transfer_stats['bytes_skipped'])}) excluded by import filters")
+
+    write_import_metadata(mod_id,
+                          author=args["set_author"],
+                          name=args["set_name"],
+                          link=args["set_link"])
+    deduplicate_after_import(mod_id)
+
+
+def subcommand_promote(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.mod import select_active_version, get_mod_mount_path
+    from code.mountstate import is_deployment_mounted
+    from code.promote import select_overflow_files, promote_overflow_files
+    from code.sharedstore import is_shared_version, release_shared_version
+    mod_id: str = args["mod_id"]
+    if not validate_mod_id(mod_id):
+        print("A mod id may only contain lower case letters a-z, digits 0-9 and the minus sign",
               file=stderr)
         exit(1)
-    destination.mkdir(parents=True, exist_ok=True)
-
-    if source.is_dir():
-        transfer_mod_files(source, destination, only_copy)
-        unspool_dir = source.parent
-        while not only_copy and unspool_dir.is_dir() and not any(unspool_dir.iterdir()) and not Path.cwd().samefile(unspool_dir):
-            unspool_dir.rmdir()
-            unspool_dir = unspool_dir.parent
-    elif source.is_file():
-        with TemporaryDirectory() as tmpdir_str:
-            tmpdir = Path(tmpdir_str)
-            extract_archive(source, tmpdir)
-            if len(set(tmpdir.iterdir())) == 0:
-                raise "Extraction of archive failed. No files in extraction destination."
-            source_subdirs: list[Path] = list(filter(lambda p: p.is_dir(),
-                                                     tmpdir.rglob(f"**/{args['subdir']}")))
-            if len(source_subdirs) == 0:
-                transfer_mod_files(tmpdir, destination, only_copy=False)
-            elif len(source_subdirs) == 1:
-                transfer_mod_files(source_subdirs[0], destination, only_copy=False)
-            else:
-                raise ("Multiple candidates for source within archive. You must prepare these "
-                       "files manually.")
-    else:
-        print("internal logic error: source is neither file nor directory", file=stderr)
+    if is_deployment_mounted(get_deployment_directory(args["instance"])):
+        print("Cannot promote overflow files while the filesystem is active", file=stderr)
+        exit(1)
+    overflow_dir = get_or_create_overflow_dir()
+    selection = select_overflow_files(overflow_dir, args["patterns"])
+    if len(selection["whiteouts"]) > 0:
+        print(f"Skipping {len(selection['whiteouts'])} deleted files, because a mod version "
+              "cannot delete files", file=stderr)
+    if len(selection["files"]) == 0:
+        print("No files in the overflow directory match the given patterns", file=stderr)
+        exit(1)
+    for relative_path in selection["files"]:
+        print(relative_path)
+    print(f"{len(selection['files'])} files ({format_byte_size(selection['bytes'])}) will be "
+          f"promoted into a new version of {mod_id}")
+    if args["dry_run"]:
+        return
+    if mod_at_version_limit(mod_id, current_date(), args["instance"]):
+        print("A mod may only have 100 subversions per day (00-99). Aborting promotion.",
+              file=stderr)
         exit(1)
-    recursive_lower_case_rename(raw_destination)
-    print(f"Successfully installed {mod_id} into {destination}")
 
-    cfg = ModConfig(mod_id)
-    cfg.set(ValidModSettings.LAST_UPDATE_CHECK, current_date())
-    author: str | None = args["set_author"]
-    if author is not None:
-        cfg.set(ValidModSettings.AUTHOR, author)
-    name: str | None = args["set_name"]
-    if name is not None:
-        cfg.set(ValidModSettings.PRETTY_NAME, name)
-    link: str | None = args["set_link"]
-    if link is not None:
-        cfg.set(ValidModSettings.HYPERLINK, link)
+    seed_dir: Path | None = None
+    if mod_exists(mod_id):
+        active_version = select_active_version(mod_id)
+        if active_version is not None:
+            if is_version_archived(mod_id, *active_version):
+                try:
+                    restore_versions([(mod_id, *active_version)])
+                except ValueError as e:
+                    print(e, file=stderr)
+                    exit(1)
+            seed_dir = get_mod_mount_path(mod_id, *active_version)
+        pinned_version: str = ModConfig(mod_id).get(ValidModSettings.MOD_VERSION)
+        if pinned_version.lower() != "latest":
+            print(f"{mod_id} is pinned to version {pinned_version}. Select the promoted version "
+                  "with useversion to deploy it.", file=stderr)
+    version_dir = create_mod_space(mod_id)
+    try:
+        stats = promote_overflow_files(overflow_dir, selection["files"], seed_dir,
+                                       version_dir.resolve())
+    except (OSError, ValueError) as e:
+        print(f"Promotion into {version_dir} failed: {e}", file=stderr)
+        print("The files remain in the overflow directory", file=stderr)
+        if is_shared_version(version_dir):
+            release_shared_version(version_dir)
+        else:
+            version_dir.rmdir()
+        date_dir = version_dir.parent
+        if not any(date_dir.iterdir()):
+            date_dir.rmdir()
+        exit(1)
+    recursive_lower_case_rename(version_dir)
+    write_import_metadata(mod_id,
+                          author=args["set_author"],
+                          name=args["set_name"],
+                          link=args["set_link"])
+    deduplicate_after_import(mod_id)
+    print(f"Promoted {stats['moved_files'] + stats['copied_files']} files into {version_dir}")
+    if stats["seeded_files"] > 0:
+        print(f"Kept {stats['seeded_files']} files of the previous version")
+    if stats["copied_files"] > 0:
+        print(f"{stats['copied_files']} files had to be copied, because the mod is stored on "
+              "another filesystem than the overflow directory", file=stderr)
+
+
+def subcommand_snapshot(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.snapshots import list_snapshots, restore_snapshot, snapshot_overflow
+    if args["snapshotaction"] == "list":
+        snapshots = list_snapshots()
+        if len(snapshots) == 0:
+            print("There are no snapshots of the overflow directory", file=stderr)
+            return
+        print(f"{'ID':<22}  {'TIME':<25}  {'REASON':<8}  {'FILES':>7}  {'CHANGED':>7}  "
+              f"{'WHITEOUTS':>9}  {'DURATION':>8}")
+        for manifest in snapshots:
+            changed = manifest["cloned_files"] + manifest["copied_files"]
+            print(f"{manifest['id']:<22}  {manifest['time']:<25}  {manifest['reason']:<8}  "
+                  f"{len(manifest['files']):>7}  {changed:>7}  {len(manifest['whiteouts']):>9}  "
+                  f"{manifest['seconds'] * 1000:>6.0f}ms")
+        return
+    from code.mountstate import is_deployment_mounted
+    if is_deployment_mounted(get_deployment_directory(args["instance"])):
+        print("Cannot change the overflow directory while the filesystem is active", file=stderr)
+        exit(1)
+    overflow_dir = get_or_create_overflow_dir()
+    if args["snapshotaction"] == "create":
+        snapshot_overflow(overflow_dir, reason="manual")
+    elif args["snapshotaction"] == "restore":
+        if args["snapshot_id"] not in [manifest["id"] for manifest in list_snapshots()]:
+            print(f"There is no snapshot {args['snapshot_id']}. See: snapshot list",
+                  file=stderr)
+            exit(1)
+        # The current state is kept as well, so that the restore can be undone
+        snapshot_overflow(overflow_dir, reason="restore")
+        try:
+            restore_snapshot(args["snapshot_id"], overflow_dir)
+        except (OSError, ValueError) as e:
+            print(f"Restoring snapshot {args['snapshot_id']} failed: {e}", file=stderr)
+            exit(1)
+        print(f"Restored the overflow directory from snapshot {args['snapshot_id']}")
+    else:
+        print("Unknown snapshot action", file=stderr)
+        exit(1)
 
 
 def subcommand_repair(args: SubcommandArgDict) -> None:
@@ -301,61 +637,89 @@ def subcommand_repair(args: SubcommandArgDict) -> None:
     :type args:
     """
     if args["repairaction"] == "filenamecase":
-        from code.mod import resolve_base_dir
+        from code.journal import record_contents_change
+        from code.mod import resolve_base_dir, get_mod_mount_path
+        from code.usage import invalidate_usage_cache
         all_mods: bool = args["all"]
         named_mods: list[str] = args["modids"]
         rename_game_files: bool = args["gamefiles"]
         rename_overflow: bool = args["overflow"]
         mods_to_rename: set[str] = set(named_mods + (get_mod_ids() if all_mods else []))
-        for mod in mods_to_rename:
-            mod_dir = resolve_base_dir() / 'mods' / mod
-            recursive_lower_case_rename(mod_dir)
-        if rename_game_files:
-            recursive_lower_case_rename(
-                get_instance_settings().get(ValidInstanceSettings.DEPLOYMENT_TARGET_DIR)
-            )
-        if rename_overflow:
-            overflow_dir = get_instance_settings().get(
-                ValidInstanceSettings.FILESYSTEM_OVERFLOW_DIR
-            )
-            assert isinstance(overflow_dir, Path)
-            if overflow_dir.is_dir():
-                recursive_lower_case_rename(overflow_dir)
+        with ProgressReporter("Renaming files") as progress:
+            for mod in mods_to_rename:
+                mod_dir = resolve_base_dir() / 'mods' / mod
+                recursive_lower_case_rename(mod_dir, progress)
+                if mod_exists(mod):
+                    # Shared versions are cached by their path in the store
+                    for version_date, subversions in get_mod_versions(mod).items():
+                        for subversion in subversions:
+                            invalidate_usage_cache(get_mod_mount_path(mod, version_date,
+                                                                      subversion))
+                record_contents_change(resolve_base_dir(), mod)
+            if rename_game_files:
+                recursive_lower_case_rename(
+                    get_instance_settings().get(ValidInstanceSettings.DEPLOYMENT_TARGET_DIR),
+                    progress
+                )
+            if rename_overflow:
+                overflow_dir = get_instance_settings().get(
+                    ValidInstanceSettings.FILESYSTEM_OVERFLOW_DIR
+                )
+                assert isinstance(overflow_dir, Path)
+                if overflow_dir.is_dir():
+                    recursive_lower_case_rename(overflow_dir, progress)
     elif args["repairaction"] == "filepriority":
         write_mod_priority(read_mod_priority())
     elif args["repairaction"] == "cleanoverflow":
         from code.mod import resolve_base_dir
         from code.paths import get_all_files, trim_emptied_directory
-        from code.deployer import is_fuse_overlayfs_mounted
-        from hashlib import sha3_512, file_digest
-        deployment_target_dir = get_instance_settings().get(ValidInstanceSettings.DEPLOYMENT_TARGET_DIR)
-        if is_fuse_overlayfs_mounted(deployment_target_dir):
+        from code.mountstate import is_deployment_mounted
+        from code.paths import get_file_hash
+        deployment_target_dir = get_deployment_directory(args["instance"])
+        if is_deployment_mounted(deployment_target_dir):
             print("Cannot safely clean overflow directory while the filesystem is active. Aborting to prevent data loss!", file=stderr)
             exit(1)
-        def hashfile(path: Path) -> str:
-            with path.open(mode='rb') as f:
-                return file_digest(f, sha3_512).hexdigest()
         print("Generating hashes for all installed game and mod files...")
-        installed_file_hashes = frozenset(
-            map(
-                hashfile,
-                get_all_files(resolve_base_dir() / 'mods') | get_all_files(deployment_target_dir)
-            )
-        )
+        installed_files = {file: file.stat().st_size
+                           for file in get_all_files(resolve_base_dir() / 'mods')
+                           | get_all_files(deployment_target_dir)}
+        installed_file_hashes: set[str] = set()
+        with ProgressReporter("Hashing installed files",
+                              total_files=len(installed_files),
+                              total_bytes=sum(installed_files.values())) as progress:
+            for installed_file, file_size in installed_files.items():
+                installed_file_hashes.add(get_file_hash(installed_file))
+                progress.advance(1, file_size)
         print("Successfully calculated " + str(len(installed_file_hashes)) + " file hashes")
         numDeleted = 0
-        for overflow_file in get_all_files(get_instance_settings().get(ValidInstanceSettings.FILESYSTEM_OVERFLOW_DIR)):
-            if overflow_file.is_file():
-                with overflow_file.open(mode='rb') as f:
-                    hash = file_digest(f, sha3_512).hexdigest()
-                    f.close()
-                    if hash in installed_file_hashes:
+        overflow_dir = get_instance_settings().get(ValidInstanceSettings.FILESYSTEM_OVERFLOW_DIR)
+        overflow_files = {file: file.stat().st_size for file in get_all_files(overflow_dir)}
+        with ProgressReporter("Checking overflow files",
+                              total_files=len(overflow_files),
+                              total_bytes=sum(overflow_files.values())) as progress:
+            for overflow_file, file_size in overflow_files.items():
+                if overflow_file.is_file():
+                    if get_file_hash(overflow_file) in installed_file_hashes:
                         parent_dir = overflow_file.parent
-                        print("Deleting " + str(overflow_file))
+                        progress.message("Deleting " + str(overflow_file), file=stdout)
                         overflow_file.unlink(missing_ok=True)
                         numDeleted += 1
                         trim_emptied_directory(parent_dir)
+                progress.advance(1, file_size)
         print("Overflow directory has been cleaned of {} files.".format(numDeleted))
+    elif args["repairaction"] == "dedupe":
+        from code.dedupe import deduplicate_instance
+        print("Searching for identical files in all installed mod versions...")
+        try:
+            stats = deduplicate_instance()
+        except (OSError, ValueError) as e:
+            print(f"Deduplication failed: {e}", file=stderr)
+            exit(1)
+        print(f"Scanned {stats['files_scanned']} files and hashed {stats['files_hashed']} of them")
+        print(f"Deduplicated {stats['files_deduplicated']} files, "
+              f"reclaiming {format_byte_size(stats['bytes_reclaimed'])}")
+        if stats["objects_removed"] > 0:
+            print(f"Removed {stats['objects_removed']} unused objects from the store")
     else:
         print("Unknown repair action", file=stderr)
         exit(1)
@@ -540,11 +904,185 @@ def subcommand_delete(args: SubcommandArgDict) -> None:
     mod_dir: Path = args["instance"] / 'mods' / mod_id
     if mod_dir.is_dir():
         from shutil import rmtree
+        from code.sharedstore import release_shared_versions_of_mod
+        release_shared_versions_of_mod(mod_id)
         rmtree(mod_dir)
     mod_conf: Path = args["instance"] / 'mods' / f"{mod_id}.json"
     mod_conf.unlink(missing_ok=True)
 
 
+def subcommand_prune(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.retention import find_prunable_versions, calculate_reclaimable_bytes, delete_versions
+    keep: int | None = args["keep"]
+    if keep is None:
+        keep = get_instance_settings().get(ValidInstanceSettings.RETAINED_VERSIONS)
+    if keep < 1:
+        print("No retention policy is configured. Use --keep or the retainVersions setting.",
+              file=stderr)
+        exit(1)
+    mod_ids = sorted(set(args["modids"] + (get_mod_ids() if args["all"] else [])))
+    if len(mod_ids) == 0:
+        print("You need to specify mods or give the --all flag to prune versions.", file=stderr)
+        exit(1)
+
+    candidates = find_prunable_versions(mod_ids, keep)
+    mounted_layers: set[Path] = set()
+    if get_instance_settings().get(ValidInstanceSettings.DEPLOYMENT_TARGET_DIR) is not None:
+        from code.mountstate import get_mounted_layers
+        mounted_layers = get_mounted_layers(get_deployment_directory(args["instance"]))
+    for candidate in [candidate for candidate in candidates
+                      if candidate["path"].resolve() in mounted_layers]:
+        print(f"Keeping {candidate['mod_id']} {candidate['version_date']}/"
+              f"{candidate['version_sub']}, because a running session uses it", file=stderr)
+        candidates.remove(candidate)
+    if len(candidates) == 0:
+        print("No versions need to be deleted.")
+        return
+    for candidate in candidates:
+        print(f"{candidate['mod_id']} {candidate['version_date']}/{candidate['version_sub']}"
+              + (" (shared)" if candidate["shared"] else ""))
+    print(f"{len(candidates)} versions will be deleted, reclaiming "
+          f"{format_byte_size(calculate_reclaimable_bytes(candidates))}")
+    if args["dry_run"]:
+        return
+    if not args["yes"]:
+        try:
+            answer = input("Delete these versions? [y/N] ")
+        except EOFError:
+            answer = ""
+        if answer.strip().lower() not in {"y", "yes"}:
+            print("Aborted. No versions were deleted.")
+            return
+    delete_versions(candidates)
+    print("Versions removed. Their files are being deleted in the background.")
+
+
+def subcommand_archive(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.coldstorage import find_inactive_versions, archive_versions
+    mod_ids = sorted(set(args["modids"] + (get_mod_ids() if args["all"] else [])))
+    if len(mod_ids) == 0:
+        print("You need to specify mods or give the --all flag to archive versions.", file=stderr)
+        exit(1)
+    inactive_versions = find_inactive_versions(mod_ids)
+    if len(inactive_versions) == 0:
+        print("There are no inactive versions to archive.")
+        return
+    for mod, date, sub in inactive_versions:
+        print(f"Archiving {mod} {date}/{sub}")
+    archive_size, failures = archive_versions(inactive_versions, max_workers=args["jobs"])
+    print(f"Packed {len(inactive_versions) - len(failures)} versions into "
+          f"{format_byte_size(archive_size)} of archives")
+    if len(failures) > 0:
+        for failure in failures:
+            print(f"Failed to archive {failure}", file=stderr)
+        exit(1)
+
+
+def subcommand_usage(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.coldstorage import get_version_directory, get_version_archive_path
+    from code.usage import UsageCache, UsageRecord, scan_usage, combine_usage_records
+    cache = UsageCache(refresh=args["refresh"])
+    mod_ids: list[str] = args["modids"] if len(args["modids"]) > 0 else get_mod_ids()
+    rows: list[tuple[str, tuple[int, int, int]]] = []
+    all_records: list[UsageRecord] = []
+    for mod in mod_ids:
+        mod_records: list[UsageRecord] = []
+        version_rows: list[tuple[str, tuple[int, int, int]]] = []
+        for date, subversions in sorted(get_mod_versions(mod).items()):
+            for subver in sorted(subversions):
+                label = f"  {date}/{subver}"
+                if is_version_archived(mod, date, subver):
+                    version_path = get_version_archive_path(mod, date, subver)
+                    label += " (archived)"
+                else:
+                    version_path = get_version_directory(mod, date, subver).resolve()
+                record = cache.get_usage(version_path)
+                mod_records.append(record)
+                version_rows.append((label, combine_usage_records([record])))
+        rows.append((mod, combine_usage_records(mod_records)))
+        rows += version_rows
+        all_records += mod_records
+    cache.save()
+    for label, directory in [("overflow", get_or_create_overflow_dir()),
+                             ("work directory", get_or_create_work_dir())]:
+        record = scan_usage(directory)
+        rows.append((label, combine_usage_records([record])))
+        all_records.append(record)
+    rows.append(("total", combine_usage_records(all_records)))
+
+    label_width = max(len(label) for label, _ in rows)
+    print(f"{'':<{label_width}}  {'FILES':>8}  {'APPARENT':>10}  {'ON DISK':>10}")
+    for label, (files, apparent_bytes, disk_bytes) in rows:
+        print(f"{label:<{label_width}}  {files:>8}  {format_byte_size(apparent_bytes):>10}  "
+              f"{format_byte_size(disk_bytes):>10}")
+
+
+def subcommand_serve(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.daemon import serve
+    from code.mod import resolve_base_dir
+    serve(resolve_base_dir(), args["version_string"], args["idle_timeout"])
+
+
+def subcommand_stats(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from json import dumps
+    from code.metrics import read_history, summarize_history, format_prometheus
+    records = read_history()
+    if args["subcommand_filter"] is not None:
+        records = [record for record in records
+                   if record["subcommand"] == args["subcommand_filter"]]
+    summary = summarize_history(records)
+    if args["format"] == "json":
+        print(dumps(summary, indent=2, sort_keys=True))
+        return
+    if args["format"] == "prometheus":
+        print(format_prometheus(summary), end="")
+        return
+    if len(summary) == 0:
+        if not get_instance_settings().get(ValidInstanceSettings.RECORD_HISTORY):
+            print("No history has been recorded. Enable it with: config set recordHistory true",
+                  file=stderr)
+        else:
+            print("No history has been recorded yet", file=stderr)
+        return
+    label_width = max(len("SUBCOMMAND"), max(len(subcommand) for subcommand in summary))
+    print(f"{'SUBCOMMAND':<{label_width}}  {'RUNS':>6}  {'FAILED':>6}  {'MEAN':>9}  "
+          f"{'MEDIAN':>9}  {'MAX':>9}  {'FILES':>9}  {'READ':>10}  {'HASHED':>10}  "
+          f"{'COPIED':>10}  {'PEAK RSS':>10}")
+    for subcommand, entry in sorted(summary.items()):
+        print(f"{subcommand:<{label_width}}  {entry['invocations']:>6}  {entry['failures']:>6}  "
+              f"{entry['duration_secs_mean']:>8.2f}s  {entry['duration_secs_median']:>8.2f}s  "
+              f"{entry['duration_secs_max']:>8.2f}s  {entry['files_scanned']:>9}  "
+              f"{format_byte_size(entry['bytes_read']):>10}  "
+              f"{format_byte_size(entry['bytes_hashed']):>10}  "
+              f"{format_byte_size(entry['bytes_copied']):>10}  "
+              f"{format_byte_size(entry['peak_rss_bytes']):>10}")
+
+
 def subcommand_enable(args: SubcommandArgDict) -> None:
     """
 
@@ -579,6 +1117,9 @@ def subcommand_useversion(args: SubcommandArgDict) -> None:
             version_date, version_subversion = parse_version_tag(version_str)
 
             if version_exists(mod_id, version_date, version_subversion):
+                if is_version_archived(mod_id, version_date, version_subversion):
+                    print(f"Restoring {version_date}/{version_subversion} from cold storage...")
+                    restore_versions([(mod_id, version_date, version_subversion)])
                 ModConfig(mod_id).set(ValidModSettings.MOD_VERSION,
                                       f"{version_date}/{version_subversion}")
             else:
@@ -589,6 +1130,44 @@ def subcommand_useversion(args: SubcommandArgDict) -> None:
         exit(1)
 
 
+def subcommand_adopt(args: SubcommandArgDict) -> None:
+    """
+
+    :param args:
+    :type args:
+    """
+    from code.sharedstore import get_shared_store_directory, get_shared_mod_versions, \
+        adopt_shared_version
+    mod_id: str = args["mod_id"]
+    if not validate_mod_id(mod_id):
+        print("A mod id may only contain lower case letters a-z, digits 0-9 and the minus sign",
+              file=stderr)
+        exit(1)
+    store_dir = get_shared_store_directory()
+    if store_dir is None:
+        print("This instance does not use a shared mod store. See the sharedModStore setting.",
+              file=stderr)
+        exit(1)
+
+    version_str: str = args["version"]
+    if version_str == "latest":
+        shared_versions = get_shared_mod_versions(store_dir).get(mod_id, dict())
+        if len(shared_versions) == 0:
+            print(f"The shared store does not contain any version of {mod_id}", file=stderr)
+            exit(1)
+        version_date = max(shared_versions.keys())
+        version_subversion = max(shared_versions[version_date])
+    else:
+        version_date, version_subversion = parse_version_tag(version_str)
+
+    try:
+        adopt_shared_version(mod_id, version_date, version_subversion)
+    except ValueError as e:
+        print(e, file=stderr)
+        exit(1)
+    print(f"Adopted version {version_date}/{version_subversion} of {mod_id} from the shared store")
+
+
 def subcommand_mod(args: SubcommandArgDict) -> None:
     """
 
@@ -679,6 +1258,8 @@ def get_subcommands_table() -> dict[str, Callable[[SubcommandArgDict], None]]:
     return {
         "list": subcommand_list,
         "run": subcommand_run,
+        "deploy": subcommand_deploy,
+        "undeploy": subcommand_undeploy,
         "import": subcommand_import,
         "repair": subcommand_repair,
         "init": subcommand_init,
@@ -686,10 +1267,18 @@ def get_subcommands_table() -> dict[str, Callable[[SubcommandArgDict], None]]:
         "developer": subcommand_developer,
         "config": subcommand_config,
         "delete": subcommand_delete,
+        "prune": subcommand_prune,
+        "archive": subcommand_archive,
+        "usage": subcommand_usage,
+        "stats": subcommand_stats,
+        "serve": subcommand_serve,
+        "promote": subcommand_promote,
+        "snapshot": subcommand_snapshot,
         "enable": subcommand_enable,
         "disable": subcommand_disable,
         "useversion": subcommand_useversion,
         "mod": subcommand_mod,
+        "adopt": subcommand_adopt,
         "version": subcommand_version,
         "markuptodate": subcommand_markuptodate,
     }
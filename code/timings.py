@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from datetime import datetime
+from json import dumps
+from pathlib import Path
+from sys import stderr
+
+from code.mod import resolve_base_dir
+from code.paths import get_meta_directory
+
+
+def get_log_directory(base_dir: Path | None = None) -> Path:
+    return get_meta_directory(resolve_base_dir(base_dir)) / 'logs'
+
+
+def get_timing_log_path(base_dir: Path | None = None) -> Path:
+    return get_log_directory(base_dir) / 'deploy-timings.jsonl'
+
+
+class PhaseTimer:
+    """
+    Measures the wall-clock time of the consecutive phases of a deployment
+    """
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = dict()
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+
+def append_timing_record(record: dict, base_dir: Path | None = None) -> None:
+    log_path = get_timing_log_path(base_dir)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("at", encoding="UTF-8") as log_file:
+        log_file.write(dumps({"time": datetime.now().astimezone().isoformat(timespec="seconds")}
+                             | record) + "\n")
+
+
+def print_timings(timer: PhaseTimer, details: dict[str, int | str]) -> None:
+    print("Deployment timings:", file=stderr)
+    name_width = max((len(name) for name in timer.phases.keys()), default=0)
+    for name, seconds in timer.phases.items():
+        print(f"  {name.ljust(name_width)}  {seconds * 1000:10.1f} ms", file=stderr)
+    print(f"  {'total'.ljust(name_width)}  {timer.total() * 1000:10.1f} ms", file=stderr)
+    for name, value in details.items():
+        print(f"  {name.replace('_', ' ')}: {value}", file=stderr)
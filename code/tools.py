@@ -5,3 +5,30 @@
 def current_date() -> str:
     from datetime import date
     return date.today().isoformat()
+
+
+def format_byte_size(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return f"{num_bytes} B" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def split_pattern_list(raw_patterns: str | None) -> list[str]:
+    if raw_patterns is None:
+        return []
+    return [pattern.strip() for pattern in raw_patterns.split(",") if len(pattern.strip()) > 0]
+
+
+def is_process_alive(pid: int) -> bool:
+    from os import kill
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to somebody else
+        return True
+    return True
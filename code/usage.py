@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2026 Jonas Tobias Hopusch <git@jotoho.de>
+# SPDX-License-Identifier: AGPL-3.0-only
+from json import load, dump, JSONDecodeError
+from os import scandir, stat
+from pathlib import Path
+from stat import S_ISREG
+from typing import Iterable, TypedDict
+
+from code.metrics import count
+from code.mod import resolve_base_dir
+from code.paths import get_cache_directory
+
+
+class UsageRecord(TypedDict):
+    """
+    disk usage of a directory tree. Inodes with several hardlinks are listed separately, so that
+    they can be counted only once when records are combined.
+    """
+    files: int
+    apparent_bytes: int
+    exclusive_blocks: int
+    shared_inodes: list[list[int]]
+
+
+def empty_usage_record() -> UsageRecord:
+    return UsageRecord(files=0, apparent_bytes=0, exclusive_blocks=0, shared_inodes=[])
+
+
+def add_file_to_record(record: UsageRecord, file_stat) -> None:
+    record["files"] += 1
+    record["apparent_bytes"] += file_stat.st_size
+    if file_stat.st_nlink > 1:
+        record["shared_inodes"].append([file_stat.st_dev, file_stat.st_ino, file_stat.st_blocks])
+    else:
+        record["exclusive_blocks"] += file_stat.st_blocks
+
+
+def scan_usage(path: Path) -> UsageRecord:
+    record = empty_usage_record()
+    if path.is_file():
+        add_file_to_record(record, path.stat())
+        return record
+    pending_dirs = [path]
+    while len(pending_dirs) > 0:
+        try:
+            with scandir(pending_dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(Path(entry.path))
+                    else:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        if S_ISREG(entry_stat.st_mode):
+                            count("files_scanned")
+                            add_file_to_record(record, entry_stat)
+        except (FileNotFoundError, PermissionError):
+            continue
+    return record
+
+
+def combine_usage_records(records: Iterable[UsageRecord]) -> tuple[int, int, int]:
+    """
+    :return: number of files, apparent size and the space actually used on disk, counting every
+             hardlinked inode once
+    """
+    files = 0
+    apparent_bytes = 0
+    blocks = 0
+    shared_inodes: dict[tuple[int, int], int] = dict()
+    for record in records:
+        files += record["files"]
+        apparent_bytes += record["apparent_bytes"]
+        blocks += record["exclusive_blocks"]
+        for dev, ino, inode_blocks in record["shared_inodes"]:
+            shared_inodes[(dev, ino)] = inode_blocks
+    return files, apparent_bytes, (blocks + sum(shared_inodes.values())) * 512
+
+
+def get_usage_cache_path(base_dir: Path | None = None) -> Path:
+    return get_cache_directory(resolve_base_dir(base_dir)) / 'usage.json'
+
+
+def invalidate_usage_cache(below: Path | None = None, base_dir: Path | None = None) -> None:
+    """
+    Forgets the cached results of the versions below a directory or all of them. Must be called
+    by everything that changes files within versions, e.g. renaming or deduplicating them,
+    because such changes do not show up in the top-level directory of the version.
+    """
+    cache_path = get_usage_cache_path(base_dir)
+    if below is None:
+        cache_path.unlink(missing_ok=True)
+        return
+    try:
+        with cache_path.open("rt") as f:
+            entries: dict[str, dict] = load(f)
+    except (FileNotFoundError, JSONDecodeError):
+        return
+    below = below.resolve()
+    kept_entries = {path: entry for path, entry in entries.items()
+                    if not Path(path).is_relative_to(below)}
+    if len(kept_entries) == len(entries):
+        return
+    temporary_path = cache_path.with_suffix(".tmp")
+    with temporary_path.open("wt") as f:
+        dump(kept_entries, f)
+    temporary_path.replace(cache_path)
+
+
+class UsageCache:
+    """
+    Keeps the scan results of mod versions between invocations. Version directories are only
+    modified by their import and by repairs, which invalidate their entries. Otherwise an entry
+    stays valid as long as the inode and timestamps of the version's top-level directory or
+    archive are unchanged.
+    """
+
+    def __init__(self, base_dir: Path | None = None, refresh: bool = False) -> None:
+        self.cache_path = get_usage_cache_path(base_dir)
+        self.entries: dict[str, dict] = dict()
+        self.modified = False
+        if not refresh:
+            try:
+                with self.cache_path.open("rt") as f:
+                    self.entries = load(f)
+            except (FileNotFoundError, JSONDecodeError):
+                self.entries = dict()
+
+    def get_usage(self, path: Path) -> UsageRecord:
+        path_stat = stat(path)
+        key = [path_stat.st_ino, path_stat.st_mtime_ns, path_stat.st_ctime_ns, path_stat.st_size]
+        cached = self.entries.get(str(path))
+        if cached is not None and cached["key"] == key:
+            return cached["record"]
+        record = scan_usage(path)
+        self.entries[str(path)] = {"key": key, "record": record}
+        self.modified = True
+        return record
+
+    def save(self) -> None:
+        if not self.modified:
+            return
+        # Forget versions that have been deleted since they were scanned
+        self.entries = {path: entry for path, entry in self.entries.items() if Path(path).exists()}
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.cache_path.with_suffix(".tmp")
+        with temporary_path.open("wt") as f:
+            dump(self.entries, f)
+        temporary_path.replace(self.cache_path)
@@ -45,6 +45,12 @@ def main() -> None:
     assert get_instance_settings() is not None
     # Warning: mod base path must be known before this can be safely called
     args: SubcommandArgDict = vars(process_commandline_args())
+    from code.daemon import is_forwardable, forward_to_daemon
+    if is_forwardable(args):
+        from sys import argv
+        daemon_exit_code = forward_to_daemon(instance_path, argv[1:])
+        if daemon_exit_code is not None:
+            exit(daemon_exit_code)
     if args["show_args"]:
         from pprint import pprint
         pprint(args)
@@ -55,12 +61,35 @@ def main() -> None:
                                              else app_install_dir())
     subcommands = get_subcommands_table()
     if args["subcommand"] in subcommands:
-        subcommands[args["subcommand"]](args)
+        from code.metrics import begin_invocation, finish_invocation
+        begin_invocation(args["subcommand"])
+        try:
+            dispatch_subcommand(subcommands, args, instance_path)
+        except SystemExit as exit_request:
+            finish_invocation(exit_request.code if isinstance(exit_request.code, int)
+                              else 0 if exit_request.code is None else 1)
+            raise
+        finish_invocation(0)
     else:
         print(f"ERROR: No action has been implemented for subcommand {args['subcommand']}.",
               "This is either a bug or a missing feature!", file=stderr)
         exit(1)
 
 
+def dispatch_subcommand(subcommands: dict, args: SubcommandArgDict, instance_path: Path) -> None:
+    if args["profile"]:
+        from code.profiling import run_profiled, get_default_profile_path
+        output_path = args["profile_output"]
+        if output_path is None:
+            output_path = get_default_profile_path(instance_path, args["subcommand"])
+        run_profiled(subcommands[args["subcommand"]],
+                     args,
+                     subcommand=args["subcommand"],
+                     output_path=output_path,
+                     count_filesystem_calls=args["profile_syscalls"])
+    else:
+        subcommands[args["subcommand"]](args)
+
+
 if __name__ == "__main__":
     main()